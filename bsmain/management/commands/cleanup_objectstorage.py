@@ -4,9 +4,8 @@ import sys
 from django.core.management.base import BaseCommand
 from django.db import transaction
 
-from bugsink.app_settings import get_settings
 from files.object_kinds import get_object_kind_model, get_object_kind_spec
-from files.storage_registry import get_storage
+from files.storage_registry import get_storage, get_storage_names
 
 
 class Command(BaseCommand):
@@ -27,8 +26,7 @@ class Command(BaseCommand):
         model = get_object_kind_model(object_kind)
         key_field = object_kind_spec["key_field"]
 
-        configured_object_storages = get_settings().OBJECT_STORAGES.get(object_kind, {})
-        configured_storage_names = configured_object_storages.keys()
+        configured_storage_names = get_storage_names(object_kind)  # i.e. including the default for chunks
         available_storages = ", ".join(configured_storage_names)
 
         if storage_name not in configured_storage_names:
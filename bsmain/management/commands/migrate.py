@@ -1,4 +1,5 @@
 import time
+from django.db import DEFAULT_DB_ALIAS
 from django.core.management.commands.migrate import Command as DjangoMigrateCommand
 
 from . import monkey_patch_deconstruct
@@ -15,6 +16,17 @@ class Command(DjangoMigrateCommand):
     #
     # AFAIU, "just dropping a file called migrate.py in one of our apps" is good enough to be the override.
 
+    def handle(self, *args, **options):
+        super().handle(*args, **options)
+
+        if options["database"] != DEFAULT_DB_ALIAS:
+            return
+
+        # migrations that rebuild a table (sqlite) drop the search index's triggers; see tags/search_index.py
+        from tags.search_index import recreate_search_index_if_stale
+        for table in recreate_search_index_if_stale():
+            self.stdout.write("Recreated the search index for %s" % table)
+
     def migration_progress_callback(self, action, migration=None, fake=False):
         # Django 4.2's method, with a single change
 
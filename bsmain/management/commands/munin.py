@@ -5,6 +5,7 @@ from django.db.models import Sum, Max
 
 from bugsink.transaction import durable_atomic
 from snappea.models import Stat
+from bsmain.models import StorageDeletion
 
 
 class Command(BaseCommand):
@@ -20,14 +21,22 @@ class Command(BaseCommand):
                 "immediate-avg",
                 "immediate-max",
                 "digested-count",
+                "storage-deletion-backlog",
                 # avg-wall-time (for digest) ... not so relevant, because it mostly expresses waiting
             ],
         )
 
     def handle(self, *args, **options):
         stat = options["stat"]
+        if stat == "storage-deletion-backlog":
+            return self.storage_deletion_backlog()
         return self.snappea_stats(stat)
 
+    def storage_deletion_backlog(self):
+        # items queued for deletion from (event or object) storage but not yet deleted (see drain_storage_deletions)
+        with durable_atomic():
+            print(StorageDeletion.objects.count())
+
     def snappea_stats(self, munin_field):
         FIELD_MAP = {
             "begin-avg": "wait_time",
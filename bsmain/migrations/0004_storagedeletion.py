@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-17 07:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bsmain', '0003_add_description_to_authtoken'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StorageDeletion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False)),
+                ('object_kind', models.CharField(max_length=64)),
+                ('storage_backend', models.CharField(max_length=255)),
+                ('key', models.CharField(max_length=255)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
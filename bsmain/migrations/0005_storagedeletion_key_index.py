@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-17 09:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bsmain', '0004_storagedeletion'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='storagedeletion',
+            index=models.Index(fields=['key'], name='bsmain_stor_key_20cebb_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-17 09:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bsmain', '0005_storagedeletion_key_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='storagedeletion',
+            index=models.Index(fields=['attempts', 'id'], name='bsmain_stor_attempt_e4ac62_idx'),
+        ),
+    ]
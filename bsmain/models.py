@@ -31,3 +31,27 @@ class CachedModelCount(models.Model):
 
     class Meta:
         unique_together = ('app_label', 'model_name')
+
+
+class StorageDeletion(models.Model):
+    """
+    Durable queue of to-be-deleted objects on (event or object) storage, drained in the background by
+    bsmain.tasks.drain_storage_deletions. Rows are created in the same transaction as the deletion of the DB-records
+    that point to the storage, i.e. "if the DB-record is gone, the queue knows about it" (at least once).
+    """
+
+    # object_kind is one of files' object kinds (e.g. "file"), or EVENT_STORAGE_KIND for event storage.
+    object_kind = models.CharField(max_length=64)
+    storage_backend = models.CharField(max_length=255)
+    key = models.CharField(max_length=255)  # event id (as str) or the object's key (e.g. File.checksum)
+    attempts = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True, editable=False)
+
+    def __str__(self):
+        return f"{self.object_kind} {self.key} on {self.storage_backend}"
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["key"]),  # for cancel_storage_deletions
+            models.Index(fields=["attempts", "id"]),  # for drain_storage_deletions' order_by
+        ]
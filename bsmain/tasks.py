@@ -1,10 +1,29 @@
+import logging
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
 from django.apps import apps
+from django.db.models import F
 from django.utils import timezone
 
 from snappea.decorators import shared_task
 
-from bugsink.transaction import durable_atomic, immediate_atomic
-from .models import CachedModelCount
+from bugsink.transaction import durable_atomic, immediate_atomic, delay_on_commit
+from .models import CachedModelCount, StorageDeletion
+
+logger = logging.getLogger("bugsink")
+performance_logger = logging.getLogger("bugsink.performance.storage")
+
+EVENT_STORAGE_KIND = "event"  # the object_kind of StorageDeletion for event storage (as opposed to files' kinds)
+
+STORAGE_DELETION_BATCH_SIZE = 500
+
+# deletions from storage are I/O bound (unlink; or a network call for non-local storages), i.e. they parallelize well
+# over threads (the GIL is released while waiting).
+STORAGE_DELETION_WORKERS = 8
+
+# after this many failed attempts we give up on an item (it's logged; cleanup_objectstorage & friends are the fallback)
+STORAGE_DELETION_MAX_ATTEMPTS = 5
 
 
 @shared_task
@@ -24,3 +43,129 @@ def count_model(app_label, model_name):
                 'last_updated': timezone.now(),
             },
         )
+
+
+def queue_storage_deletions(todos):
+    """
+    Queue (object_kind, key, storage_backend) tuples for deletion from storage. To be called in the transaction in which
+    the DB-records that point to these are deleted: the queue-items are committed (or rolled back) along with that
+    deletion, and the actual deleting happens in the background, after the commit.
+    """
+    deletions = [
+        StorageDeletion(object_kind=object_kind, key=str(key), storage_backend=storage_backend)
+        for object_kind, key, storage_backend in todos]
+
+    if deletions:
+        StorageDeletion.objects.bulk_create(deletions)
+        delay_on_commit(drain_storage_deletions)
+
+
+def cancel_storage_deletions(object_kind, key, storage_backend):
+    """
+    To be called right before (re)writing the object: content-addressed keys (files, chunks) may be written again
+    after their deletion was queued, and the drain must then leave the new object alone.
+    """
+    deletions = StorageDeletion.objects.filter(object_kind=object_kind, key=str(key), storage_backend=storage_backend)
+    if deletions.exists():  # checked first, such that the common case does not need the write lock
+        with immediate_atomic(only_if_needed=True):
+            deletions.delete()
+
+
+def delete_from_storage(object_kind, key, storage_backend):
+    # returns whether the item can be considered deleted.
+    from events.storage_registry import get_storage as get_event_storage
+    from files.storage_registry import get_storage as get_object_storage
+
+    try:
+        if object_kind == EVENT_STORAGE_KIND:
+            get_event_storage(storage_backend).delete(uuid.UUID(key))
+        else:
+            get_object_storage(object_kind, storage_backend).delete(key)
+
+    except FileNotFoundError:
+        # "at least once" implies "possibly more than once", e.g. when we've crashed between deleting and dequeueing
+        pass
+
+    except Exception as e:
+        logger.error("Error during deletion of %s on %s: %s", key, storage_backend, e)
+        return False
+
+    return True
+
+
+def _get_live_objects(batch):
+    # (object_kind, key, storage_backend) for those items in the batch that have a DB-record (again). Keys for files and
+    # chunks are content-addressed (checksums), i.e. the same object may have been written again (e.g. a re-uploaded
+    # bundle) between queueing and draining; the object on storage then belongs to the new record. (Event keys are the
+    # Events' pks, which are not reused.)
+    from files.object_kinds import get_object_kind_spec, get_object_kind_model
+
+    result = set()
+    for object_kind in {item.object_kind for item in batch} - {EVENT_STORAGE_KIND}:
+        key_field = get_object_kind_spec(object_kind)["key_field"]
+        keys = [item.key for item in batch if item.object_kind == object_kind]
+        result.update(
+            (object_kind, key, storage_backend) for key, storage_backend in
+            get_object_kind_model(object_kind).objects.filter(**{key_field + "__in": keys})
+            .values_list(key_field, "storage_backend"))
+    return result
+
+
+def _delete_from_storage_in_parallel(items):
+    # {item.id: whether it can be considered deleted}
+    with ThreadPoolExecutor(max_workers=STORAGE_DELETION_WORKERS) as executor:
+        results = executor.map(
+            lambda item: delete_from_storage(item.object_kind, item.key, item.storage_backend), items)
+        return dict(zip([item.id for item in items], results))
+
+
+@shared_task
+def drain_storage_deletions():
+    # Deletes a single batch from storage (in parallel) and re-enqueues itself until the queue is empty. Items are only
+    # dequeued _after_ they have been deleted.
+    with durable_atomic():
+        # failed items are retried, but not at the cost of the fresh ones (hence ordering by attempts first)
+        batch = list(StorageDeletion.objects.order_by("attempts", "id")[:STORAGE_DELETION_BATCH_SIZE])
+
+    if not batch:
+        return
+
+    # Event keys (the Events' pks) are not reused: these are deleted outside of any transaction, i.e. without holding
+    # the write lock.
+    results = _delete_from_storage_in_parallel([item for item in batch if item.object_kind == EVENT_STORAGE_KIND])
+
+    with immediate_atomic():
+        # File and chunk keys are content-addressed, i.e. they may have been written again since their deletion was
+        # queued. Such writes cancel the deletion (see cancel_storage_deletions); those items, and the ones that are in
+        # use (again), are skipped. Checking and deleting while holding the write lock means no such write can happen
+        # in between.
+        object_items = [item for item in batch if item.object_kind != EVENT_STORAGE_KIND]
+        still_queued = set(
+            StorageDeletion.objects.filter(id__in=[item.id for item in object_items]).values_list("id", flat=True))
+        live = _get_live_objects(object_items)
+        in_use = [item.id for item in object_items
+                  if item.id not in still_queued or (item.object_kind, item.key, item.storage_backend) in live]
+
+        results.update(_delete_from_storage_in_parallel([item for item in object_items if item.id not in in_use]))
+
+        done = [item_id for item_id, ok in results.items() if ok]
+        failed = [item for item in batch if item.id in results and not results[item.id]]
+        given_up = [item.id for item in failed if item.attempts + 1 >= STORAGE_DELETION_MAX_ATTEMPTS]
+
+        StorageDeletion.objects.filter(id__in=done + given_up + in_use).delete()
+        StorageDeletion.objects.filter(id__in=[item.id for item in failed]).update(attempts=F("attempts") + 1)
+        backlog = StorageDeletion.objects.count()
+
+        if len(batch) == STORAGE_DELETION_BATCH_SIZE and (done or given_up or in_use):
+            # i.e. only if there may be more than what we've just seen; and not when nothing but failures remain (which
+            # would just spin); those are retried on the next queueing (which comes with its own drain).
+            delay_on_commit(drain_storage_deletions)
+
+    for item in failed:
+        if item.id in given_up:
+            logger.error("Giving up on deletion of %s on %s after %d attempts", item.key, item.storage_backend,
+                         STORAGE_DELETION_MAX_ATTEMPTS)
+
+    performance_logger.info(
+        "STORAGE DELETION: %d deleted, %d in use, %d failed (%d given up), backlog %d", len(done), len(in_use),
+        len(failed), len(given_up), backlog)
@@ -1,3 +1,6 @@
+import tempfile
+from pathlib import Path
+
 from django.contrib.auth import get_user_model
 from django.conf import settings
 from django.core.checks import run_checks
@@ -7,8 +10,12 @@ from django.test import SimpleTestCase, override_settings
 from django.urls import reverse
 
 from bugsink.test_utils import TransactionTestCase25251 as TransactionTestCase
+from bugsink.transaction import immediate_atomic
+from files.models import File, write_to_storage
+from files.storage_registry import override_object_storages
 
-from .models import AuthToken
+from .models import AuthToken, StorageDeletion
+from .tasks import queue_storage_deletions, drain_storage_deletions, STORAGE_DELETION_MAX_ATTEMPTS
 
 User = get_user_model()
 
@@ -146,3 +153,72 @@ class AuthTokenListTestCase(TransactionTestCase):
         self.assertContains(response, f'id="token-hidden-{token_2.pk}"')
         self.assertContains(response, f'id="token-revealed-{token_2.pk}" class="hidden font-mono"')
         self.assertContains(response, f'id="token-toggle-{token_2.pk}"')
+
+
+class StorageDeletionTestCase(TransactionTestCase):
+
+    def test_queue_is_drained_after_commit(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            Path(tempdir, "present").write_bytes(b"data")
+            storages = {
+                "file": {"local": {"STORAGE": "files.storage.ObjectFileStorage", "OPTIONS": {"basepath": tempdir}}}}
+
+            with override_object_storages(storages):
+                with immediate_atomic():
+                    queue_storage_deletions([
+                        ("file", "present", "local"),
+                        ("file", "already-gone", "local"),  # at least once, i.e. possibly twice: not an error
+                        ("file", "on-unknown-storage", "unknown"),
+                    ])
+                    self.assertTrue(Path(tempdir, "present").exists())  # not before the commit
+
+                # (in EAGER mode the drain-task has run by now)
+                self.assertFalse(Path(tempdir, "present").exists())
+                self.assertEqual(
+                    [("on-unknown-storage", 1)], list(StorageDeletion.objects.values_list("key", "attempts")))
+
+                for i in range(STORAGE_DELETION_MAX_ATTEMPTS - 1):
+                    drain_storage_deletions()
+
+                self.assertEqual(0, StorageDeletion.objects.count())  # given up on
+
+    def test_objects_written_again_are_not_deleted(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            Path(tempdir, "rewritten").write_bytes(b"data")
+            storages = {
+                "file": {"local": {"STORAGE": "files.storage.ObjectFileStorage", "OPTIONS": {"basepath": tempdir}}}}
+
+            with override_object_storages(storages):
+                with immediate_atomic():
+                    queue_storage_deletions([("file", "rewritten", "local")])
+
+                    # content-addressed, i.e. the same key is in use again (e.g. a re-upload) before the drain runs
+                    File.objects.create(
+                        checksum="rewritten", filename="x.js", size=4, data=b"", storage_backend="local")
+
+                self.assertTrue(Path(tempdir, "rewritten").exists())
+                self.assertEqual(0, StorageDeletion.objects.count())
+
+    def test_writing_an_object_cancels_its_queued_deletion(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            storages = {"file": {"local": {
+                "STORAGE": "files.storage.ObjectFileStorage", "OPTIONS": {"basepath": tempdir}, "USE_FOR_WRITE": True}}}
+
+            with override_object_storages(storages):
+                # queued, but not drained yet (e.g. a backlog); created directly, i.e. without the on-commit drain
+                StorageDeletion.objects.create(object_kind="file", key="rewritten", storage_backend="local")
+
+                # content-addressed: the same key is written again, before its File-record exists (see store_unlocked)
+                write_to_storage("file", "rewritten", b"data")
+                self.assertEqual(0, StorageDeletion.objects.count())
+
+                drain_storage_deletions()
+                self.assertTrue(Path(tempdir, "rewritten").exists())
+
+    def test_queue_is_rolled_back_with_the_transaction(self):
+        with self.assertRaises(ZeroDivisionError):
+            with immediate_atomic():
+                queue_storage_deletions([("file", "some-key", "local")])
+                1 / 0
+
+        self.assertEqual(0, StorageDeletion.objects.count())
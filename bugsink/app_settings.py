@@ -79,6 +79,12 @@ DEFAULTS = {
     "MAX_RETENTION_PER_PROJECT_EVENT_COUNT": None,  # None means "no limit"
     "MAX_RETENTION_EVENT_COUNT": None,  # None means "no limit"
     "MAX_EVENT_AGE_DAYS": None,  # None means "disabled"
+
+    # None: evict (up to 500 events) as part of digest, as soon as a project is over its retention max. A (high, low)
+    # pair of fractions of the retention max, e.g. (1.05, 0.95): digest only notices that a project is over the high
+    # watermark, and a snappea task evicts (in small batches, outside of digest) until it is down to the low one. At
+    # twice the retention max (events.retention.WATERMARKS_HARD_CEILING) digest evicts anyway, to stay bounded.
+    "EVICTION_WATERMARKS": None,
     "MAX_STORED_FILE_COUNT": None,  # None means "no max"
     "MAX_STORED_FILE_BYTES": None,  # None means "no max"
 
@@ -89,9 +95,35 @@ DEFAULTS = {
     # many row-writes inside the (single-writer) digest transaction. 100 is well above any realistic event.
     "MAX_EVENT_TAGS": 100,
 
+    # Number of (project, tag key, tag value) and of (issue, tag value) pairs that the digest process keeps in memory to
+    # avoid the TagKey/TagValue/IssueTag upserts on every event (see tags/tag_cache.py). 0 means "no cache".
+    "TAG_CACHE_SIZE": 10_000,
+
+    # Memory budget (estimated, per process) for parsed sourcemaps, kept in memory to avoid reading and parsing them on
+    # every stacktrace page view (see files/sourcemap_cache.py). 0 means "no cache".
+    "SOURCEMAP_CACHE_MAX_BYTES": 64 * _MEBIBYTE,
+
+    # Store tags in a separate (batched) task rather than in the digest transaction itself; tags (search, counts) are
+    # then eventually consistent.
+    "DEFERRED_TAG_DIGESTION": False,
+
+    # Accumulate IssueTag count increments in memory (in the digest process), and write them in a single flush once
+    # digest catches up, rather than once per event (see tags/tag_counts.py). Counts lag during bursts.
+    "COALESCE_ISSUE_TAG_COUNTS": False,
+
     # Locations of files & directories:
     # no_bandit_expl: the usage of this path (via get_filename_for_event_id) is protected with `b108_makedirs`
     "INGEST_STORE_BASE_DIR": "/tmp/bugsink/ingestion",  # nosec
+
+    # Chunks (the parts of sentry-cli uploads, until they are assembled into Files) are stored as files in this
+    # directory rather than in the database, unless OBJECT_STORAGES has an entry for "chunk" (which then takes
+    # precedence). None means: in the database. Like the ingest store, this must be shared by the server and snappea.
+    # no_bandit_expl: the usage of this path (see ChunkFileStorage) is protected with `b108_makedirs`
+    "CHUNK_STORE_BASE_DIR": "/tmp/bugsink/chunks",  # nosec
+
+    # Layout of the ingest store (see ingest/filestore.py): 0 means a file per ingested event (in 256 subdirectories);
+    # any other value means events are appended to shared "segment" files of (at most about) this many bytes.
+    "INGEST_STORE_SEGMENT_SIZE": 0,
     "EVENT_STORAGES": {},
     "OBJECT_STORAGES": {},
 
@@ -0,0 +1,103 @@
+"""
+JSON for the hot paths (event data, envelope headers, snappea Task args): orjson when it's installed (`pip install
+orjson`; optional), Python's json otherwise. Usage: `from bugsink import json`, then loads/dumps/load/dump as usual (but
+without any of the stdlib's keyword arguments; use the stdlib directly for e.g. indent=).
+
+Both backends produce the same (compact, non-ASCII-escaped) output, such that what we store does not depend on what is
+installed. The exceptions are floats in exponent notation (orjson: 1e16; stdlib: 1e+16), which parse to the same value,
+and NaN/Infinity, which orjson writes as null (the stdlib writes NaN, which isn't actually JSON to begin with).
+
+Not everything that the stdlib accepts is accepted by orjson: NaN/Infinity (when parsing), lone surrogates, ints beyond
+64 bits, non-str dict keys. Since we deal with SDK-provided data, which may contain any of these, we fall back to the
+stdlib when orjson refuses; i.e. apart from the above the result is what the stdlib would give, only faster.
+"""
+
+import json as stdlib_json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+JSONDecodeError = stdlib_json.JSONDecodeError  # (orjson.JSONDecodeError is a subclass of this)
+detect_encoding = stdlib_json.detect_encoding
+
+
+class StdlibBackend:
+    name = "json"
+
+    @staticmethod
+    def loads(s):
+        return stdlib_json.loads(s)
+
+    @staticmethod
+    def dumps(obj):
+        result = stdlib_json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+        if result.isascii():
+            return result
+
+        try:
+            # the result is stored and written as utf-8, so it must be encodable as such; this is not the case for lone
+            # surrogates (e.g. parsed from "\ud800"). Escaping them (ensure_ascii) keeps them intact.
+            result.encode("utf-8")
+        except UnicodeEncodeError:
+            return stdlib_json.dumps(obj, separators=(",", ":"))
+        return result
+
+    @staticmethod
+    def dumpb(obj):
+        try:
+            return stdlib_json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        except UnicodeEncodeError:
+            # lone surrogates: as in dumps()
+            return stdlib_json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+
+class OrjsonBackend:
+    name = "orjson"
+
+    @staticmethod
+    def loads(s):
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError:
+            return StdlibBackend.loads(s)  # either something that only the stdlib accepts, or the stdlib's exception
+
+    @classmethod
+    def dumps(cls, obj):
+        return cls.dumpb(obj).decode("utf-8")
+
+    @staticmethod
+    def dumpb(obj):
+        try:
+            return orjson.dumps(obj)
+        except orjson.JSONEncodeError:
+            return StdlibBackend.dumpb(obj)
+
+
+BACKENDS = [StdlibBackend] if orjson is None else [OrjsonBackend, StdlibBackend]
+backend = BACKENDS[0]
+
+
+def loads(s):
+    """str or bytes (utf-8, or any of the other encodings that the stdlib detects) to Python objects."""
+    return backend.loads(s)
+
+
+def dumps(obj):
+    """Python objects to str."""
+    return backend.dumps(obj)
+
+
+def dumpb(obj):
+    """Python objects to (utf-8) bytes; saves an encode() compared to dumps for those cases where bytes are needed."""
+    return backend.dumpb(obj)
+
+
+def load(f):
+    return loads(f.read())
+
+
+def dump(obj, f):
+    f.write(dumps(obj))
@@ -0,0 +1,98 @@
+from collections import OrderedDict
+import threading
+
+
+class LRUCache:
+    """
+    A bounded mapping that evicts the least recently used item when full. Thread-safe, because the typical use is a
+    process-wide cache in snappea (which runs its workers as threads).
+
+    Note that "in-process" means: not shared between gunicorn and snappea (nor between multiple snappea processes).
+    Users of this class must therefore either validate what they get from the cache, or make sure all writes to the
+    underlying data go through the same process.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.d = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.d:
+                return default
+
+            self.d.move_to_end(key)
+            return self.d[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.d[key] = value
+            self.d.move_to_end(key)
+
+            while len(self.d) > self.maxsize:
+                self.d.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.d.pop(key, default)
+
+    def clear(self):
+        with self.lock:
+            self.d.clear()
+
+    def __len__(self):
+        return len(self.d)
+
+
+class SizedLRUCache:
+    """
+    Like LRUCache, but bounded by the total (estimated, caller-provided) size of the values rather than by their number;
+    for caches of items that vary wildly in size (e.g. parsed sourcemaps). An item larger than the whole budget is not
+    cached at all. Keeps hit/miss/eviction counts.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.d = OrderedDict()  # key => (value, size)
+        self.total_bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.d:
+                self.stats["misses"] += 1
+                return default
+
+            self.stats["hits"] += 1
+            self.d.move_to_end(key)
+            return self.d[key][0]
+
+    def put(self, key, value, size):
+        with self.lock:
+            if key in self.d:
+                self.total_bytes -= self.d.pop(key)[1]
+
+            if size > self.max_bytes:
+                return
+
+            self.d[key] = (value, size)
+            self.total_bytes += size
+
+            while self.total_bytes > self.max_bytes:
+                _, (_, evicted_size) = self.d.popitem(last=False)
+                self.total_bytes -= evicted_size
+                self.stats["evictions"] += 1
+
+    def clear(self):
+        with self.lock:
+            self.d.clear()
+            self.total_bytes = 0
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats, entries=len(self.d), bytes=self.total_bytes, max_bytes=self.max_bytes)
+
+    def __len__(self):
+        return len(self.d)
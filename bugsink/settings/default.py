@@ -344,6 +344,13 @@ SILENCED_SYSTEM_CHECKS = [
 # hanging the entire application (or snappea when the workers fill up) when the SMTP server is down/unreachable.
 EMAIL_TIMEOUT = 5
 
+# Snappea's Tasks are deleted right before they're run (at-most-once), i.e. a Foreman that is killed "loses" the Tasks
+# it was running. This hook re-creates Tasks for the events that are left in the ingest dir because of this. NOTE: the
+# settings files that define their own SNAPPEA (e.g. the conf_templates) must include it too.
+SNAPPEA = {
+    "HOOK_STARTUP": "ingest.filestore.recover_spool",
+}
+
 
 LOGGING = deepcopy(DEFAULT_LOGGING)
 
@@ -72,6 +72,8 @@ SNAPPEA = {
     # development.py is precisly the intended use for a non-None PID_FILE: no systemd/Docker, i.e. no process manager
     # no_bandit_expl: usage locations use b108_makedirs;
     "PID_FILE": "/tmp/bugsink/snappea.pid",  # nosec B108
+
+    "HOOK_STARTUP": "ingest.filestore.recover_spool",  # see default.py
 }
 
 EMAIL_BACKEND = "django.core.mail.backends.console.EmailBackend"
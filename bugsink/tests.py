@@ -3,7 +3,7 @@ import pprint
 import re
 import brotli
 
-from unittest import TestCase as RegularTestCase
+from unittest import TestCase as RegularTestCase, skipIf
 from unittest.mock import patch
 from django.test import TestCase as DjangoTestCase
 from django.test import SimpleTestCase
@@ -12,13 +12,19 @@ from django.core.exceptions import SuspiciousOperation
 from django.core import mail
 from django.contrib.auth import get_user_model
 from django.test.utils import CaptureQueriesContext
-from django.db import connection
+from django.db import connection, transaction
 from .wsgi import allowed_hosts_error_message
 
 from .test_utils import TransactionTestCase25251 as TransactionTestCase
-from .transaction import immediate_atomic
+from .transaction import immediate_atomic, delay_on_commit
 from .volume_based_condition import VolumeBasedCondition
 from .utils import email_backend_delivers_mail, send_rendered_email
+from .lru import LRUCache, SizedLRUCache
+from . import json as bugsink_json
+from snappea.models import Task
+from snappea.settings import get_settings as get_snappea_settings, AttrLikeDict
+from issues.tasks import delete_issue_deps
+from projects.tasks import delete_project_deps
 from .streams import (
     compress_with_zlib, GeneratorReader, WBITS_PARAM_FOR_GZIP, WBITS_PARAM_FOR_DEFLATE, MaxDataReader,
     MaxDataWriter, zlib_generator, brotli_generator, BrotliError)
@@ -42,6 +48,41 @@ class VolumeBasedConditionTestCase(RegularTestCase):
         self.assertEqual(vbc, vbc2)
 
 
+class LRUCacheTestCase(RegularTestCase):
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(1, cache.get("a"))  # "a" is now the most recently used
+
+        cache.put("c", 3)
+        self.assertEqual(None, cache.get("b"))
+        self.assertEqual(1, cache.get("a"))
+        self.assertEqual(3, cache.get("c"))
+
+
+class SizedLRUCacheTestCase(RegularTestCase):
+
+    def test_evicts_least_recently_used_within_budget(self):
+        cache = SizedLRUCache(10)
+        cache.put("a", 1, 4)
+        cache.put("b", 2, 4)
+        self.assertEqual(1, cache.get("a"))  # "a" is now the most recently used
+
+        cache.put("c", 3, 4)  # 12 > 10: "b" must go
+        self.assertEqual(None, cache.get("b"))
+        self.assertEqual(1, cache.get("a"))
+        self.assertEqual(8, cache.total_bytes)
+
+        cache.put("d", 4, 11)  # larger than the budget: not cached, nothing evicted
+        self.assertEqual(None, cache.get("d"))
+        self.assertEqual(2, len(cache))
+
+        self.assertEqual({"hits": 2, "misses": 2, "evictions": 1, "entries": 2, "bytes": 8, "max_bytes": 10},
+                         cache.get_stats())
+
+
 class EmailBackendDeliversMailTestCase(SimpleTestCase):
     @override_settings(EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend")
     def test_importable_delivering_backend_delivers_mail(self):
@@ -520,3 +561,75 @@ class TestAtomicTransactions(TransactionTestCase):
         self.assertTrue(User.objects.filter(username="testuser2").exists())
         self.assertEqual([1], [1 for q in queries_context.captured_queries if q['sql'].startswith("BEGIN")])
         self.assertEqual([1], [1 for q in queries_context.captured_queries if q['sql'].startswith("COMMIT")])
+
+
+class DelayOnCommitTestCase(TransactionTestCase):
+    databases = "__all__"
+
+    def test_delay_on_commit_is_collected_per_transaction(self):
+        not_eager = AttrLikeDict(get_snappea_settings(), TASK_ALWAYS_EAGER=False)
+
+        with patch("snappea.decorators.get_settings", return_value=not_eager), \
+                patch("snappea.decorators.wakeup_server") as wakeup_server:
+            with immediate_atomic():
+                delay_on_commit(delete_issue_deps, "project", "issue-1")
+
+                try:
+                    with transaction.atomic():
+                        delay_on_commit(delete_issue_deps, "project", "issue-2")
+                        raise ValueError("rolled back savepoint: no task")
+                except ValueError:
+                    pass
+
+                delay_on_commit(delete_project_deps, "project")
+                self.assertEqual(0, Task.objects.count())
+
+        # a single wake-up call for the single (bulk) insert of the tasks, in order.
+        self.assertEqual(1, wakeup_server.call_count)
+        self.assertEqual([
+            ("issues.tasks.delete_issue_deps", '["project","issue-1"]'),
+            ("projects.tasks.delete_project_deps", '["project"]'),
+        ], list(Task.objects.order_by("id").values_list("task_name", "args")))
+
+
+class JsonTestCase(RegularTestCase):
+
+    def test_roundtrip_and_stdlib_compatible(self):
+        from events.factories import create_event_data
+        import json as stdlib_json
+
+        data = dict(create_event_data(), message="héllo ☃ \n \"quoted\"", extra={"nested": [1, 2.5, None, True]})
+        dumped = bugsink_json.dumpb(data)
+
+        self.assertEqual(data, bugsink_json.loads(dumped))
+        self.assertEqual(data, stdlib_json.loads(dumped))
+        self.assertEqual(dumped.decode("utf-8"), bugsink_json.dumps(data))
+
+    def test_stdlib_only_input(self):
+        # things that orjson refuses but the stdlib accepts (and which SDKs may send) must still work
+        data = bugsink_json.loads('{"a": NaN, "b": "\\ud800", "c": 123456789012345678901234567890}')
+
+        self.assertEqual(123456789012345678901234567890, data["c"])
+        self.assertEqual("\ud800", data["b"])
+        self.assertEqual(data["c"], bugsink_json.loads(bugsink_json.dumpb(data))["c"])
+        self.assertEqual("\ud800", bugsink_json.loads(bugsink_json.dumpb(data))["b"])
+
+    def test_lone_surrogates_dump_to_utf8_encodable_str(self):
+        data = bugsink_json.loads('{"b": "\\ud800", "c": "héllo"}')
+
+        for backend in bugsink_json.BACKENDS:
+            dumped = backend.dumps(data)
+            dumped.encode("utf-8")  # does not raise, i.e. can be written to the DB or a file
+            self.assertEqual(data, bugsink_json.loads(dumped))
+
+    def test_invalid_json_raises_json_decode_error(self):
+        with self.assertRaises(bugsink_json.JSONDecodeError):
+            bugsink_json.loads(b"{not json")
+
+    @skipIf(len(bugsink_json.BACKENDS) < 2, "orjson not installed")
+    def test_backends_give_identical_output(self):
+        from events.factories import create_event_data
+
+        data = dict(create_event_data(), message="héllo ☃", extra={"nested": [1, 2.5, None, True, -17]})
+        outputs = [backend.dumpb(data) for backend in bugsink_json.BACKENDS]
+        self.assertEqual(1, len(set(outputs)))
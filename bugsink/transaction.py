@@ -8,6 +8,7 @@ import threading
 from django.db import transaction as django_db_transaction
 from django.db import DEFAULT_DB_ALIAS
 
+from snappea.decorators import delay_many
 from snappea.settings import get_settings as get_snappea_settings
 
 performance_logger = logging.getLogger("bugsink.performance.db")
@@ -176,8 +177,19 @@ class ImmediateAtomic(SuperDurableAtomic):
 
         self.t0 = time.time()
 
+        if self.using == DEFAULT_DB_ALIAS:
+            # see delay_on_commit; a stack (rather than a single list) because in EAGER mode the delayed tasks (which
+            # may have their own ImmediateAtomic) run from inside our __exit__.
+            _delayed_tasks_stack().append([])
+
     def __exit__(self, exc_type, exc_value, traceback):
-        super(ImmediateAtomic, self).__exit__(exc_type, exc_value, traceback)
+        try:
+            super(ImmediateAtomic, self).__exit__(exc_type, exc_value, traceback)
+        finally:
+            if self.using == DEFAULT_DB_ALIAS:
+                # after the commit (the on_commit callbacks have run by now; on rollback nothing was collected) but
+                # still inside immediate_atomic's SemaphoreContext, just like the on_commit callbacks themselves.
+                delay_many(_delayed_tasks_stack().pop())
 
         took = time.time() - self.t0
         inc_stat(self.using, "immediate_transaction", took)
@@ -245,8 +257,40 @@ def immediate_atomic(using=None, savepoint=True, only_if_needed=False):
             yield
 
 
+def _delayed_tasks_stack():
+    if not hasattr(local_storage, "delayed_tasks_stack"):
+        local_storage.delayed_tasks_stack = []
+    return local_storage.delayed_tasks_stack
+
+
+def _delay_or_collect(function, args, kwargs):
+    stack = _delayed_tasks_stack()
+    if stack:
+        stack[-1].append((function, args, kwargs))
+    else:
+        function.delay(*args, **kwargs)
+
+
+def _delay_or_collect_once(function, args, kwargs):
+    stack = _delayed_tasks_stack()
+    if stack and (function, args, kwargs) in stack[-1]:
+        return
+    _delay_or_collect(function, args, kwargs)
+
+
 def delay_on_commit(function, *args, **kwargs):
-    django_db_transaction.on_commit(partial(function.delay, *args, **kwargs))
+    # Inside an ImmediateAtomic (the typical case: digest, deletions) the tasks are collected (in order) rather than
+    # delayed one by one, and created in a single delay_many() right after the commit, i.e. one INSERT and one wake-up
+    # call for the whole transaction. Collecting happens from the on_commit callback itself, which means we get Django's
+    # handling of rolled-back savepoints and transactions (callbacks are discarded) for free.
+    django_db_transaction.on_commit(partial(_delay_or_collect, function, args, kwargs))
+
+
+def delay_once_on_commit(function, *args, **kwargs):
+    # As delay_on_commit, but at most once per ImmediateAtomic for the same (function, args, kwargs), for tasks that
+    # handle whatever is there at the time they run. Deduplication happens in the collector (rather than through a flag
+    # at the call site) such that a rolled-back savepoint cannot take the single remaining task with it.
+    django_db_transaction.on_commit(partial(_delay_or_collect_once, function, args, kwargs))
 
 
 def inc_stat(using, stat, took):
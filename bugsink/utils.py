@@ -174,7 +174,7 @@ def do_pre_delete(project_id, model, pks_to_delete, is_for_project):
 
     from projects.models import Project
     from events.models import Event
-    from events.retention import cleanup_events_on_storage
+    from events.retention import cleanup_events_on_storage, forget_events_for_eviction
 
     cleanup_events_on_storage(
         Event.objects.filter(pk__in=pks_to_delete).exclude(storage_backend=None)
@@ -182,9 +182,12 @@ def do_pre_delete(project_id, model, pks_to_delete, is_for_project):
     )
 
     if is_for_project:
-        # no need to update the stored_event_count for the project, because the project is being deleted
+        # no need to update the stored_event_count (nor the eviction histogram) for the project, because the project is
+        # being deleted
         return
 
+    forget_events_for_eviction(pks_to_delete)
+
     # Update project stored_event_count to reflect the deletion of the events. note: alternatively, we could do this
     # on issue-delete (issue.stored_event_count is known too); potato, potato though.
     # note: don't bother to do the same thing for Issue.stored_event_count, since we're in the process of deleting Issue
@@ -6,6 +6,7 @@ from django.db.models import Max
 
 from issues.factories import get_or_create_issue
 from .models import Event
+from .retention import record_event_for_eviction
 
 
 def create_event(project=None, issue=None, timestamp=None, event_data=None, **kwargs):
@@ -29,7 +30,9 @@ def create_event(project=None, issue=None, timestamp=None, event_data=None, **kw
     # Grouping.objects.filter(project=project, grouping_key=grouping_key).get()
     grouping = issue.grouping_set.first()
 
-    return Event.objects.create(
+    kwargs.setdefault("irrelevance_for_retention", 0)
+
+    event = Event.objects.create(
         project=project,
         issue=issue,
         grouping=grouping,
@@ -39,10 +42,14 @@ def create_event(project=None, issue=None, timestamp=None, event_data=None, **kw
         event_id=uuid.uuid4().hex,
         data=json.dumps(event_data),
         digest_order=issue_digest_order,
-        irrelevance_for_retention=0,
         **kwargs,
     )
 
+    # as in digest; note that this implies that "later" changes to never_evict/irrelevance_for_retention should be made
+    # by passing them in kwargs rather than setting them on the event afterwards (to keep the histogram in sync).
+    record_event_for_eviction(event)
+    return event
+
 
 def create_event_data(exception_type=None):
     # create minimal event data that is valid as per from_json()
@@ -3,7 +3,8 @@ from django.db.models import Count
 
 from releases.models import Release
 from issues.models import Issue, Grouping, TurningPoint
-from events.models import Event
+from events.models import Event, ProjectEventCountsForEviction
+from events.retention import get_eviction_counts, get_eviction_counts_from_events, rebuild_eviction_counts
 from projects.models import Project
 from tags.models import TagKey, TagValue, EventTag, IssueTag
 
@@ -97,6 +98,8 @@ def make_consistent():
 
     _delete_for_missing_fk(TagKey, 'project')
 
+    _delete_for_missing_fk(ProjectEventCountsForEviction, 'project')
+
     for event in Event.objects.filter(turningpoint__isnull=False, never_evict=False).distinct():
         print("Setting event %s to never_evict because it has a turningpoint" % event)
         event.never_evict = True
@@ -124,6 +127,11 @@ def make_consistent():
             project.issue_count = correct_issue_count
             project.save()
 
+        correct_eviction_counts = get_eviction_counts_from_events(project)
+        if get_eviction_counts(project) != correct_eviction_counts:
+            print("Rebuilding eviction histogram for project %s" % project)
+            rebuild_eviction_counts(project, correct_eviction_counts)
+
     # Alternatively (but does it work in MySQL?)
     # Issue.objects.update(
     #     stored_event_count=Subquery(
@@ -182,13 +190,17 @@ class Command(BaseCommand):
                 # * our tasks have "immediate atomic" on the inside, not a happy marriage with the approach here
                 #   (including dry-run)
 
+                project_args = []
                 for obj in Project.objects.filter(is_deleted=True):
                     print("Enqueuing deletion of project dependencies for %s" % obj)
-                    delete_project_deps.delay(str(obj.pk))
+                    project_args.append((str(obj.pk),))
+                delete_project_deps.delay_many(project_args)
 
+                issue_args = []
                 for obj in Issue.objects.filter(is_deleted=True):
                     print("Enqueuing deletion of issue dependencies for %s" % obj)
-                    delete_issue_deps.delay(str(obj.project_id), str(obj.pk))
+                    issue_args.append((str(obj.project_id), str(obj.pk)))
+                delete_issue_deps.delay_many(issue_args)
 
         except DryRunException:
             print("Changes have been rolled back (dry-run)")
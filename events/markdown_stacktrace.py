@@ -170,7 +170,8 @@ def _thread_lines(threads, stack_of_plates, in_app_only, include_locals):
 def render_stacktrace_md(event, in_app_only=False, include_locals=True):
     parsed = event.get_parsed_data()
     try:
-        apply_sourcemaps(parsed, event.project)
+        if not event.sourcemaps_applied:  # if applied on digest, the stored event is in applied form already
+            apply_sourcemaps(parsed, event.project)
     except Exception as e:
         if settings.DEBUG or settings.I_AM_RUNNING == "TEST":
             # when developing/testing, I _do_ want to get notified
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-17 07:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0030_backfill_event_counts_per_hour'),
+        ('projects', '0019_alter_project_name_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProjectEventCountsForEviction',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False)),
+                ('epoch', models.IntegerField()),
+                ('irrelevance_for_retention', models.PositiveIntegerField()),
+                ('never_evict', models.BooleanField()),
+                ('count', models.IntegerField(default=0)),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.DO_NOTHING, to='projects.project')),
+            ],
+            options={
+                'unique_together': {('project', 'epoch', 'irrelevance_for_retention', 'never_evict')},
+            },
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Backfill the eviction histogram from the stored Event rows. Unlike the hourly reporting buckets (0030) this can be
+# done exactly: the histogram describes what is stored, not what was digested.
+
+from datetime import timezone as dt_timezone
+
+from django.db import migrations
+from django.db.models import Count
+from django.db.models.functions import TruncHour
+
+
+BATCH_SIZE = 1000
+
+
+def backfill_project_event_counts_for_eviction(apps, schema_editor):
+    Event = apps.get_model("events", "Event")
+    ProjectEventCountsForEviction = apps.get_model("events", "ProjectEventCountsForEviction")
+
+    # epochs are hours since 1970 (events.retention.get_epoch); DB datetimes are UTC; truncating to the hour in the DB
+    # keeps the number of rows that we pull into Python to the size of the histogram rather than the number of events.
+    rows = (
+        Event.objects
+        .annotate(bucket=TruncHour("digested_at", tzinfo=dt_timezone.utc))
+        .values("project_id", "bucket", "irrelevance_for_retention", "never_evict")
+        .annotate(count=Count("id"))
+        .order_by()
+    )
+
+    batch = []
+    for row in rows.iterator():
+        batch.append(ProjectEventCountsForEviction(
+            project_id=row["project_id"],
+            epoch=int(row["bucket"].timestamp() / 3600),
+            irrelevance_for_retention=row["irrelevance_for_retention"],
+            never_evict=row["never_evict"],
+            count=row["count"],
+        ))
+        if len(batch) >= BATCH_SIZE:
+            ProjectEventCountsForEviction.objects.bulk_create(batch)
+            batch = []
+
+    if batch:
+        ProjectEventCountsForEviction.objects.bulk_create(batch)
+
+
+def unbackfill_project_event_counts_for_eviction(apps, schema_editor):
+    apps.get_model("events", "ProjectEventCountsForEviction").objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("events", "0031_project_event_counts_for_eviction"),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_project_event_counts_for_eviction, unbackfill_project_event_counts_for_eviction),
+    ]
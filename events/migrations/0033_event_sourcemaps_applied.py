@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 09:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0032_backfill_project_event_counts_for_eviction'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='sourcemaps_applied',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+    ]
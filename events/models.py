@@ -1,5 +1,4 @@
 import re
-import json
 import uuid
 
 from django.db import models
@@ -8,6 +7,7 @@ from django.utils.functional import cached_property
 
 from projects.models import Project
 from compat.timestamp import parse_timestamp
+from bugsink import json
 from bugsink.transaction import delay_on_commit
 
 from issues.utils import get_title_for_exception_type_and_value, LOG_MESSAGE_TYPE
@@ -30,7 +30,7 @@ def maybe_empty(s):
     return "" if not s else s
 
 
-def write_to_storage(event_id, parsed_data):
+def write_to_storage(event_id, parsed_data, raw_data=None):
     """
     event_id means event.id, i.e. the internal one. This saves us from thinking about the security implications of
     using an externally provided ID across storage backends.
@@ -41,7 +41,10 @@ def write_to_storage(event_id, parsed_data):
     # end of the transaction, but [a] Django has no before_commit hook and [b] most validation actually happens as part
     # of the commit anyway, so it wouldn't help much.
     with get_write_storage().open(event_id, "w") as f:
-        json.dump(parsed_data, f)
+        if raw_data is not None:
+            f.write(raw_data)
+        else:
+            json.dump(parsed_data, f)
 
 
 class Event(models.Model):
@@ -142,6 +145,10 @@ class Event(models.Model):
 
     storage_backend = models.CharField(max_length=255, blank=True, null=True, default=None, editable=False)
 
+    # True for events to which sourcemaps were applied at digest time (Project.apply_sourcemaps_on_digest); such events
+    # are stored in applied form, i.e. rendering must not apply them again.
+    sourcemaps_applied = models.BooleanField(default=False, editable=False)
+
     # The following list of attributes are mentioned in the docs but are not attrs on our model (because we don't need
     # them to be [yet]):
     #
@@ -208,7 +215,7 @@ class Event(models.Model):
 
     @classmethod
     def from_ingested(cls, event_metadata, digested_at, digest_order, project_digest_order, stored_event_count, issue,
-                      grouping, parsed_data, denormalized_fields):
+                      grouping, parsed_data, denormalized_fields, raw_data=None, sourcemaps_applied=False):
 
         # 'from_ingested' may be a bit of a misnomer... the full 'from_ingested' is done in 'digest_event' in the views.
         # below at least puts the parsed_data in the right place, and does some of the basic object set up (FKs to other
@@ -216,6 +223,10 @@ class Event(models.Model):
 
         irrelevance_for_retention = get_random_irrelevance(stored_event_count)
 
+        # raw_data: parsed_data as (str) JSON, when available from ingestion: saves serializing what we already have.
+        if raw_data is None:
+            raw_data = json.dumps(parsed_data)
+
         write_storage = get_write_storage()
 
         # A note on truncation (max_length): the fields we truncate here are directly from the SDK, so they "should have
@@ -229,7 +240,7 @@ class Event(models.Model):
                 grouping=grouping,
                 ingested_at=event_metadata["ingested_at"],
                 digested_at=digested_at,
-                data=json.dumps(parsed_data) if write_storage is None else "",
+                data=raw_data if write_storage is None else "",
                 storage_backend=None if write_storage is None else write_storage.name,
 
                 timestamp=parse_timestamp(parsed_data.get("timestamp", event_metadata["ingested_at"])),
@@ -256,13 +267,14 @@ class Event(models.Model):
                 digest_order=digest_order,
                 project_digest_order=project_digest_order,
                 irrelevance_for_retention=irrelevance_for_retention,
+                sourcemaps_applied=sourcemaps_applied,
 
                 **denormalized_fields,
             )
             created = True
 
             if write_storage is not None:
-                write_to_storage(event.id, parsed_data)
+                write_to_storage(event.id, parsed_data, raw_data)
 
             return event, created
         except IntegrityError as e:
@@ -320,3 +332,18 @@ class IssueEventCountsPerHour(models.Model):
         indexes = [
             models.Index(fields=["project", "bucket"]),  # batched issue-list sparklines for a project
         ]
+
+
+class ProjectEventCountsForEviction(models.Model):
+    # A histogram of the project's stored events, by epoch (see events/retention.py) and irrelevance_for_retention, such
+    # that eviction can determine its cut-off value for the total irrelevance without scanning Event. Kept up to date
+    # by digest (+1) and by each of the paths that delete events (see `forget_events_for_eviction`).
+    project = models.ForeignKey(Project, blank=False, null=False, on_delete=models.DO_NOTHING)
+    epoch = models.IntegerField(blank=False, null=False)
+    irrelevance_for_retention = models.PositiveIntegerField(blank=False, null=False)
+    never_evict = models.BooleanField(blank=False, null=False)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        # epoch before the rest: supports both Min("epoch") and the epoch__in of forget_events_for_eviction
+        unique_together = [("project", "epoch", "irrelevance_for_retention", "never_evict")]
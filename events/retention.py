@@ -1,15 +1,18 @@
-from functools import partial
+from collections import Counter, defaultdict
+from contextlib import contextmanager
 import logging
-from django.db.models import Q, Min, Max, Count
-from django.db import transaction
+from django.db.models import Q, Min, Count, F, Sum, Case, When, Value
+from django.db.models.expressions import RawSQL
+from django.db import connection
 
 from datetime import timezone, datetime
 
+from bugsink.app_settings import get_settings
 from bugsink.moreiterutils import pairwise, map_N_until
 from bugsink.utils import assert_, nc_rnd
+from bsmain.tasks import queue_storage_deletions, EVENT_STORAGE_KIND
 from performance.context_managers import time_and_query_count
 
-from .storage_registry import get_storage
 
 bugsink_logger = logging.getLogger("bugsink")
 performance_logger = logging.getLogger("bugsink.performance.retention")
@@ -97,12 +100,39 @@ def should_evict(project, timestamp, stored_event_count):
     #         get_epoch(project.retention_last_eviction) != get_epoch(timestamp)):
     #     return True
 
-    if stored_event_count > project.get_retention_max_event_count():  # > because: do something when _over_ the max
+    if stored_event_count > get_eviction_threshold(project):  # > because: do something when _over_ the max
         return True
 
     return False
 
 
+def get_eviction_threshold(project):
+    """The stored_event_count above which we evict: the retention max, or the high watermark (EVICTION_WATERMARKS)"""
+    if get_settings().EVICTION_WATERMARKS is None:
+        return project.get_retention_max_event_count()
+
+    high, _ = get_settings().EVICTION_WATERMARKS
+    return int(project.get_retention_max_event_count() * high)
+
+
+# With EVICTION_WATERMARKS, digest evicts nothing itself... up to this multiple of the retention max. Background
+# eviction runs behind whatever else is in snappea's queue, so under overload it can fall behind indefinitely; above the
+# hard ceiling digest evicts as it would without watermarks, which keeps the number of stored events bounded.
+WATERMARKS_HARD_CEILING = 2
+
+
+def get_hard_ceiling(project):
+    """The stored_event_count above which digest evicts even when EVICTION_WATERMARKS is set"""
+    high, _ = get_settings().EVICTION_WATERMARKS
+    return int(project.get_retention_max_event_count() * max(high, WATERMARKS_HARD_CEILING))
+
+
+def get_low_watermark(project):
+    """The stored_event_count that background eviction (EVICTION_WATERMARKS) evicts down to"""
+    _, low = get_settings().EVICTION_WATERMARKS
+    return int(project.get_retention_max_event_count() * low)
+
+
 def get_age_for_irrelevance(age_based_irrelevance):
     # age based irrelevance is defined as `log(age + 1, 4)`
     #
@@ -169,19 +199,125 @@ def get_epoch_bounds_with_irrelevance(project, current_timestamp, qs_kwargs={"ne
     return [((lb, ub), age_based_irrelevance) for (age_based_irrelevance, (lb, ub)) in enumerate(bounds)]
 
 
-def get_irrelevance_pairs(project, epoch_bounds_with_irrelevance, qs_kwargs={"never_evict": False}):
-    """tuples of `age_based_irrelevance` and, per associated period, the max observed (evictable) event irrelevance"""
+def record_event_for_eviction(event):
+    """Adds the (just digested) event to the eviction histogram; call once never_evict has its final value."""
+    from .models import ProjectEventCountsForEviction
+
+    key = {
+        "project_id": event.project_id,
+        "epoch": get_epoch(event.digested_at),
+        "irrelevance_for_retention": event.irrelevance_for_retention,
+        "never_evict": event.never_evict,
+    }
+
+    if ProjectEventCountsForEviction.objects.filter(**key).update(count=F("count") + 1) == 0:
+        # no need for try/except here b/c we have single-writer architecture (as in events/usage.py)
+        ProjectEventCountsForEviction.objects.create(**key, count=1)
+
+
+def forget_events_for_eviction(pks_to_delete):
+    """Removes the events from the eviction histogram; to be called _before_ the events themselves are deleted."""
+    from .models import Event, ProjectEventCountsForEviction
+
+    counts = Counter(
+        (project_id, get_epoch(digested_at), irrelevance_for_retention, never_evict)
+        for project_id, digested_at, irrelevance_for_retention, never_evict in Event.objects.filter(
+            pk__in=pks_to_delete).values_list("project_id", "digested_at", "irrelevance_for_retention", "never_evict"))
+
+    # One update per histogram-entry rather than per event; since eviction picks events of (mostly) the same few
+    # irrelevances, this is typically much less than the number of events.
+    for (project_id, epoch, irrelevance_for_retention, never_evict), count in counts.items():
+        ProjectEventCountsForEviction.objects.filter(
+            project_id=project_id, epoch=epoch, irrelevance_for_retention=irrelevance_for_retention,
+            never_evict=never_evict).update(count=F("count") - count)
+
+    for project_id in set(key[0] for key in counts):
+        ProjectEventCountsForEviction.objects.filter(
+            project_id=project_id, epoch__in=set(key[1] for key in counts if key[0] == project_id), count__lte=0,
+        ).delete()
+
+
+def get_eviction_counts_from_events(project):
+    """The eviction histogram (as {(epoch, irrelevance, never_evict): count}) recalculated from the actual Events"""
     from .models import Event
 
-    for (lower_bound, upper_bound), age_based_irrelevance in epoch_bounds_with_irrelevance:
-        d = Event.objects.filter(
-            get_epoch_bounds(lower_bound, upper_bound),
-            project=project,
-            **qs_kwargs,
-        ).aggregate(Max('irrelevance_for_retention'))
-        max_event_irrelevance = d["irrelevance_for_retention__max"] or 0
+    return dict(Counter(
+        (get_epoch(digested_at), irrelevance_for_retention, never_evict)
+        for digested_at, irrelevance_for_retention, never_evict in Event.objects.filter(project=project).values_list(
+            "digested_at", "irrelevance_for_retention", "never_evict").iterator()))
+
+
+def get_eviction_counts(project):
+    """The eviction histogram (as {(epoch, irrelevance, never_evict): count}) as currently maintained"""
+    from .models import ProjectEventCountsForEviction
+
+    return {
+        (epoch, irrelevance_for_retention, never_evict): count
+        for epoch, irrelevance_for_retention, never_evict, count in ProjectEventCountsForEviction.objects.filter(
+            project=project, count__gt=0).values_list("epoch", "irrelevance_for_retention", "never_evict", "count")}
+
+
+def rebuild_eviction_counts(project, counts):
+    from .models import ProjectEventCountsForEviction
+
+    ProjectEventCountsForEviction.objects.filter(project=project).delete()
+    ProjectEventCountsForEviction.objects.bulk_create([
+        ProjectEventCountsForEviction(
+            project=project, epoch=epoch, irrelevance_for_retention=irrelevance_for_retention, never_evict=never_evict,
+            count=count)
+        for (epoch, irrelevance_for_retention, never_evict), count in counts.items()
+    ], batch_size=1000)
+
+
+def get_eviction_histogram(project, epoch_bounds_with_irrelevance, include_never_evict):
+    """
+    {(age_based_irrelevance, event_irrelevance): count} for the project's stored events, in a single query on the
+    eviction histogram (rather than scanning the Events themselves).
+    """
+    from .models import ProjectEventCountsForEviction
+
+    # epoch_bounds_with_irrelevance is newest-first, i.e. the first matching lower bound is the epoch's bucket
+    whens = [When(epoch__gte=lb, then=Value(age_based_irrelevance))
+             for (lb, _), age_based_irrelevance in epoch_bounds_with_irrelevance if lb is not None]
+    oldest_age_based_irrelevance = epoch_bounds_with_irrelevance[-1][1]
+
+    qs = ProjectEventCountsForEviction.objects.filter(project=project, count__gt=0)
+    if not include_never_evict:
+        qs = qs.filter(never_evict=False)
+
+    rows = qs.annotate(
+        age_based_irrelevance=Case(*whens, default=Value(oldest_age_based_irrelevance)),
+    ).values("age_based_irrelevance", "irrelevance_for_retention").annotate(total=Sum("count")).order_by()
+
+    return {(row["age_based_irrelevance"], row["irrelevance_for_retention"]): row["total"] for row in rows}
 
-        yield (age_based_irrelevance, max_event_irrelevance)
+
+def get_irrelevance_pairs(epoch_bounds_with_irrelevance, histogram):
+    """tuples of `age_based_irrelevance` and, per associated period, the max observed (evictable) event irrelevance"""
+    max_per_age = defaultdict(int)
+    for age_based_irrelevance, event_irrelevance in histogram:
+        max_per_age[age_based_irrelevance] = max(max_per_age[age_based_irrelevance], event_irrelevance)
+
+    return [(age_based_irrelevance, max_per_age[age_based_irrelevance])
+            for _, age_based_irrelevance in epoch_bounds_with_irrelevance]
+
+
+def get_eviction_cutoff(histogram, target):
+    """
+    The largest max_total_irrelevance for which evicting everything with a total irrelevance above it evicts at least
+    `target` events (or -1, i.e. "evict whatever can be evicted", if even that is not enough).
+    """
+    count_per_total = defaultdict(int)
+    for (age_based_irrelevance, event_irrelevance), count in histogram.items():
+        count_per_total[age_based_irrelevance + event_irrelevance] += count
+
+    cumulative = 0
+    for total in sorted(count_per_total, reverse=True):
+        cumulative += count_per_total[total]
+        if cumulative >= target:
+            return total - 1
+
+    return -1
 
 
 def filter_for_work(epoch_bounds_with_irrelevance, pairs, max_total_irrelevance):
@@ -226,7 +362,7 @@ def eviction_target(max_event_count, stored_event_count):
            )
 
 
-def evict_for_max_events(project, timestamp, stored_event_count, include_never_evict=False):
+def evict_for_max_events(project, timestamp, stored_event_count, include_never_evict=False, target=None):
     # This function evicts, with a number-based target of events in mind. It does so by repeatedly calling
     # evict_for_irrelevance (i.e. irrelevance-based target), lowering the target irrelevance until the target number of
     # events has been evicted.
@@ -234,23 +370,37 @@ def evict_for_max_events(project, timestamp, stored_event_count, include_never_e
     # Before any actual work is done, we map out the terrain:
     #
     # * epoch_bounds_with_irrelevance: pairs of epoch bounds with their age_based_irrelevance
-    # * pairs: adds to that the observed max irrelevance for each epoch
+    # * histogram: the number of stored events per (age_based_irrelevance, event irrelevance), from the maintained
+    #   ProjectEventCountsForEviction (i.e. without scanning Event)
+    # * pairs: adds to the bounds the observed max irrelevance for each epoch
+    #
+    # epoch bounds are passed to the irrelevance-based eviction; pairs is used in an optimization (skipping epochs where
+    # it's obvious no work is needed). The histogram tells us the exact max irrelevance at which `target` is reached,
+    # i.e. a single round of evict_for_irrelevance is enough (rather than one round per step down from the max).
     #
-    # epoch bounds are passed to the irrelevance-based eviction; pairs is used to determine the starting max irrelevance
-    # and in an optimization (skipping epochs where it's obvious no work is needed).
+    # target: the number of events to evict; by default (digest) as per `eviction_target`; background eviction (see
+    # EVICTION_WATERMARKS) passes its own.
 
     qs_kwargs = {} if include_never_evict else {"never_evict": False}
+    if target is None:
+        target = eviction_target(project.get_retention_max_event_count(), stored_event_count)
 
     with time_and_query_count() as phase0:
         epoch_bounds_with_irrelevance = get_epoch_bounds_with_irrelevance(project, timestamp, qs_kwargs)
 
-        # we start off with the currently observed max total irrelevance
-        pairs = list(get_irrelevance_pairs(project, epoch_bounds_with_irrelevance, qs_kwargs))
-        max_total_irrelevance = orig_max_total_irrelevance = max(sum(pair) for pair in pairs)
+        histogram = get_eviction_histogram(project, epoch_bounds_with_irrelevance, include_never_evict)
+        pairs = get_irrelevance_pairs(epoch_bounds_with_irrelevance, histogram)
+        orig_max_total_irrelevance = max(sum(pair) for pair in pairs)
+
+        # +1, because the loop below starts with -1
+        max_total_irrelevance = get_eviction_cutoff(histogram, target) + 1
 
     with time_and_query_count() as phase1:
         evicted = EvictionCounts(0, {})
-        target = eviction_target(project.get_retention_max_event_count(), stored_event_count)
+
+        # With a correct histogram, the below loop is run exactly once. We keep the loop (rather than a single call) as
+        # a safety net: if the histogram is off for whatever reason, we fall back to stepping down (as we've always
+        # done) until the target is reached.
         while evicted.total < target:
             # -1 at the beginning of the loop; this means the actually observed max value is precisely the first thing
             # that will be evicted (since `evict_for_irrelevance` will evict anything above (but not including) the
@@ -274,7 +424,8 @@ def evict_for_max_events(project, timestamp, stored_event_count, include_never_e
 
                 if not include_never_evict:
                     # everything that remains is 'never_evict'. 'never say never' and evict those as a last measure
-                    return evicted + evict_for_max_events(project, timestamp, stored_event_count - evicted.total, True)
+                    return evicted + evict_for_max_events(
+                        project, timestamp, stored_event_count - evicted.total, True, target - evicted.total)
 
                 # "should not happen", let's log it and break out of the loop
                 # the reason I can think of this happening is when stored_event_count is wrong (too high).
@@ -357,52 +508,71 @@ def evict_for_epoch_and_irrelevance(project, max_epoch, max_irrelevance, max_eve
         # we need to manually ensure that no FKs to the deleted items exist:
         TurningPoint.objects.filter(triggering_event__in=qs).update(triggering_event=None)
 
-    # We generate the list of events-to-delete (including the LIMIT) before proceeding; this allows us:
+    # We stage the ids of the events-to-delete (including the LIMIT) in a temporary table before proceeding; this
+    # allows us:
     #
     # A. to have a portable delete_with_limit (e.g. Django does not support that, nor does Postgres).
-    # B. to apply deletions of Events and their consequences (cleanup_events_on_storage(), EventTag) on the same list.
+    # B. to apply deletions of Events and their consequences (cleanup_events_on_storage(), EventTag) on the same set.
     # C. count per-issue
     #
     # Implementation notes:
-    # 1. We force evaluation here with a `list()`; this means subsequent usages do _not_ try to "just use an inner
-    #    query". Although inner queries are attractive in the abstract, the literature suggests that performance may be
-    #    unpredictable (e.g. on MySQL). By using a list, we lift the (max 500) ids-to-match to the actual query, which
-    #    is quite ugly, but predictable and (at least on sqlite where I tested this) lightning-fast.
-    # 2. order_by: "pick something" to ensure the 2 usages of the "subquery" point to the same thing. (somewhat
-    #    superceded by [1] above; but I like to be defensive and predictable). tie-breaking on digest_order seems
-    #    consistent with the semantics of eviction.
-    pks_to_delete = list(qs.order_by("digest_order")[:max_event_count].values_list("pk", flat=True))
-
-    if len(pks_to_delete) > 0:
-        cleanup_events_on_storage(
-            Event.objects.filter(pk__in=pks_to_delete).exclude(storage_backend=None)
-            .values_list("id", "storage_backend")
-        )
+    # 1. The staging is what makes the subsequent usages "point to the same thing"; we do _not_ "just use an inner
+    #    query" on Event with a LIMIT (the literature suggests that the performance of such queries may be
+    #    unpredictable, e.g. on MySQL). Joining against a small temporary table is predictable; in this we're where we
+    #    were when we lifted the list of ids into Python (which we used to do), but without sending the (max 500) ids to
+    #    the DB 4 times over.
+    # 2. order_by: "pick something" to make the selection predictable; tie-breaking on digest_order seems consistent
+    #    with the semantics of eviction.
+    with staged_pks(qs.order_by("digest_order")[:max_event_count]) as staged:
         deletions_per_issue = {
             d['issue_id']: d['count'] for d in
-            Event.objects.filter(pk__in=pks_to_delete).values("issue_id").annotate(count=Count("issue_id"))}
-
-        # Rather than rely on Django's implementation of CASCADE, we "just do this ourselves"; Reason is: Django does an
-        # extra, expensive (all-column), query on Event[...](id__in=pks_to_delete) to extract the Event ids (which we
-        # already have). If Django ever gets DB-CASCADE, this may change: https://code.djangoproject.com/ticket/21961
-        EventTag.objects.filter(event_id__in=pks_to_delete).delete()
-        nr_of_deletions = Event.objects.filter(pk__in=pks_to_delete).delete()[1].get("events.Event", 0)
-    else:
-        nr_of_deletions = 0
-        deletions_per_issue = {}
+            Event.objects.filter(pk__in=staged).values("issue_id").annotate(count=Count("issue_id"))}
+
+        if deletions_per_issue:
+            cleanup_events_on_storage(
+                Event.objects.filter(pk__in=staged).exclude(storage_backend=None).values_list("id", "storage_backend"))
+            forget_events_for_eviction(staged)
+
+            # Rather than rely on Django's implementation of CASCADE, we "just do this ourselves"; Reason is: Django
+            # does an extra, expensive (all-column), query on Event[...](id__in=...) to extract the Event ids (which we
+            # already have). If Django ever gets DB-CASCADE, this may change:
+            # https://code.djangoproject.com/ticket/21961
+            EventTag.objects.filter(event_id__in=staged).delete()
+            nr_of_deletions = Event.objects.filter(pk__in=staged).delete()[1].get("events.Event", 0)
+        else:
+            nr_of_deletions = 0
 
     return EvictionCounts(nr_of_deletions, deletions_per_issue)
 
 
-def cleanup_events_on_storage(todos):
-    todos = list(todos)  # force evaluation _inside_ the transaction (on_commit the todos will be gone otherwise)
-    transaction.on_commit(partial(_cleanup_events_on_storage, todos))
+STAGED_PKS_TABLE = "bugsink_staged_pks"
+
+
+@contextmanager
+def staged_pks(qs):
+    """
+    Stages the pks of the given (sliced) queryset in a temporary table (on the DB side, i.e. without a round trip of
+    the pks through Python), and yields an expression to be used as `pk__in=...` for each of the dependent queries.
+    """
+    sql, params = qs.values_list("pk", flat=True).query.sql_with_params()
+
+    # MySQL has "DROP TEMPORARY TABLE", which (unlike DROP TABLE) does not commit implicitly; the others have DROP TABLE
+    # (and roll back the CREATE as part of any failing transaction, i.e. the IF EXISTS is for MySQL only in practice).
+    drop = "DROP TEMPORARY TABLE" if connection.vendor == "mysql" else "DROP TABLE"
+
+    with connection.cursor() as cursor:
+        cursor.execute("%s IF EXISTS %s" % (drop, STAGED_PKS_TABLE))
+        cursor.execute("CREATE TEMPORARY TABLE %s AS %s" % (STAGED_PKS_TABLE, sql), params)
 
+    # The column is named after the alias in `sql` ("pk"). Qualified, because an unknown (unqualified) column name in a
+    # subquery is resolved against the outer query, which would silently turn this into "all rows" if we got it wrong.
+    yield RawSQL("SELECT %s.pk FROM %s" % (STAGED_PKS_TABLE, STAGED_PKS_TABLE), [])
 
-def _cleanup_events_on_storage(todos):
-    for event_id, storage_backend in todos:
-        try:
-            get_storage(storage_backend).delete(event_id)
-        except Exception as e:
-            # in a try/except such that we can continue with the rest of the batch
-            bugsink_logger.error("Error during cleanup of %s on %s: %s", event_id, storage_backend, e)
+    with connection.cursor() as cursor:
+        cursor.execute("%s %s" % (drop, STAGED_PKS_TABLE))
+
+
+def cleanup_events_on_storage(todos):
+    # queued (in the current transaction) rather than deleted on-commit: the actual deleting is done in the background,
+    # i.e. not on the time of whoever is holding the write lock (typically: digest).
+    queue_storage_deletions((EVENT_STORAGE_KIND, event_id, storage_backend) for event_id, storage_backend in todos)
@@ -1,15 +1,30 @@
+import logging
+from datetime import datetime
+
 from django.db.models import Count
+from django.utils import timezone
 from snappea.decorators import shared_task
 
 from bugsink.utils import get_model_topography, delete_deps_with_budget
 from bugsink.transaction import immediate_atomic, delay_on_commit
+from performance.context_managers import time_and_query_count
+
+performance_logger = logging.getLogger("bugsink.performance.retention")
 
 DELETE_OLD_EVENTS_BATCH_SIZE = 500
 
+# Small (compared to the 500 of in-digest eviction) because the point of background eviction is to not hold the write
+# lock for long: each batch is its own transaction, and digest can get in between batches. Batches grow with the excess
+# though (a tenth of it, up to the in-digest maximum), because each batch waits for the whole snappea queue before it
+# runs; with a fixed small size, eviction would not keep up under load.
+EVICT_TO_LOW_WATERMARK_BATCH_SIZE = 100
+EVICT_TO_LOW_WATERMARK_MAX_BATCH_SIZE = 500
+
 
 @shared_task
 def delete_event_deps(project_id, event_id):
     from .models import Event   # avoid circular import
+    from .retention import forget_events_for_eviction
     with immediate_atomic():
         # matches what we do in events/retention.py (and for which argumentation exists); in practive I have seen _much_
         # faster deletion times (in the order of .03s per task on my local laptop) when using a budget of 500, _but_
@@ -47,6 +62,7 @@ def delete_event_deps(project_id, event_id):
             # final step: delete the event itself
             issue = Event.objects.get(pk=event_id).issue
 
+            forget_events_for_eviction([event_id])
             Event.objects.filter(pk=event_id).delete()
 
             # issue.stored_event_count is manually decremented here instead of via delete_deps_with_budget's internal
@@ -86,6 +102,53 @@ def delete_by_age_until_under_retention_max(project_id):
             delay_on_commit(delete_by_age_until_under_retention_max, project_id)
 
 
+@shared_task
+def evict_to_low_watermark(project_id, requested_at=None):
+    # Background eviction (EVICTION_WATERMARKS), requested by digest when the project went over its high watermark.
+    # Evicts a single batch (using the regular, irrelevance-based, eviction) and re-enqueues itself until the project is
+    # down to the low watermark. requested_at identifies the chain of tasks (see _request_background_eviction).
+    from projects.models import Project
+    from ingest.views import update_issue_counts
+    from .retention import evict_for_max_events, get_low_watermark
+
+    with immediate_atomic():
+        project = Project.objects.filter(pk=project_id, is_deleted=False).first()
+        if project is None:
+            return  # deleted in the meantime; nothing left to evict for.
+
+        if requested_at is not None and project.eviction_requested_at != datetime.fromisoformat(requested_at):
+            return  # superseded by a newer request (or done already), i.e. some other chain is doing the work.
+
+        excess = project.stored_event_count - get_low_watermark(project)
+        if excess <= 0:
+            project.eviction_requested_at = None
+            project.save(update_fields=["eviction_requested_at"])
+            return
+
+        with time_and_query_count() as phase:
+            evicted = evict_for_max_events(
+                project, timezone.now(), project.stored_event_count,
+                target=min(excess, max(EVICT_TO_LOW_WATERMARK_BATCH_SIZE,
+                                       min(excess // 10, EVICT_TO_LOW_WATERMARK_MAX_BATCH_SIZE))))
+
+        update_issue_counts(evicted.per_issue)
+        project.stored_event_count -= evicted.total
+        remaining = excess - evicted.total
+
+        performance_logger.info(
+            "%6.2fms EVICT (background) for project %s; evicted %d, %d to go until the low watermark",
+            phase.took, project.id, evicted.total, max(remaining, 0))
+
+        if remaining > 0 and evicted.total > 0:
+            # refreshing eviction_requested_at tells digest that we're still at it (see _request_background_eviction)
+            project.eviction_requested_at = timezone.now()
+            delay_on_commit(evict_to_low_watermark, project_id, project.eviction_requested_at.isoformat())
+        else:
+            project.eviction_requested_at = None
+
+        project.save(update_fields=["stored_event_count", "eviction_requested_at"])
+
+
 def delete_events_older_than_sync(cutoff, project_id=None, on_batch=None):
     from projects.models import Project
 
@@ -141,7 +204,7 @@ def _delete_events(project, pks_to_delete):
     from tags.models import EventTag
     from issues.models import TurningPoint
     # section lifted from events/retention.py
-    from events.retention import cleanup_events_on_storage, EvictionCounts
+    from events.retention import cleanup_events_on_storage, EvictionCounts, forget_events_for_eviction
 
     # based on ingest/views.py
     from ingest.views import update_issue_counts
@@ -158,6 +221,7 @@ def _delete_events(project, pks_to_delete):
         deletions_per_issue = {
             d['issue_id']: d['count'] for d in
             Event.objects.filter(pk__in=pks_to_delete).values("issue_id").annotate(count=Count("issue_id"))}
+        forget_events_for_eviction(pks_to_delete)
 
         EventTag.objects.filter(event_id__in=pks_to_delete).delete()
         nr_of_deletions = Event.objects.filter(pk__in=pks_to_delete).delete()[1].get("events.Event", 0)
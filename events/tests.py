@@ -19,7 +19,9 @@ from issues.models import Issue, TurningPoint, TurningPointKind
 from .models import InstallationEventCountsPerHour, IssueEventCountsPerHour, ProjectEventCountsPerHour, Event
 from .factories import create_event
 from .retention import (
-    eviction_target, should_evict, evict_for_max_events, get_epoch_bounds_with_irrelevance, filter_for_work)
+    eviction_target, should_evict, evict_for_max_events, get_epoch_bounds_with_irrelevance, filter_for_work,
+    get_eviction_cutoff, get_eviction_counts, get_eviction_counts_from_events)
+from .tasks import _delete_events
 from .sparklines import (
     get_issue_event_sparkline, get_issue_list_event_sparklines, get_sparkline_range, get_y_labels)
 from .usage import EVENT_COUNTS_PER_HOUR_MAX_AGE, hour_bucket, record_event_counts
@@ -590,14 +592,11 @@ class RetentionTestCase(DjangoTestCase):
 
         for digest_order, irrelevance, digested_at in data:
             project_stored_event_count += 1  # +1 pre-create, as in the ingestion view
-            event = create_event(self.project, self.issue, timestamp=digested_at)
-            event.irrelevance_for_retention = irrelevance
-
             # totally unrealistic scenario of "everything is never_evict" is great for testing: it just means the
             # eviction framework is tested in "include_never_evict" mode which is "normal mode but more cases", i.e. it
             # tests the regular flow but also the special one.
-            event.never_evict = True
-            event.save()
+            create_event(self.project, self.issue, timestamp=digested_at, irrelevance_for_retention=irrelevance,
+                         never_evict=True)
 
         while project_stored_event_count > 1:
             # Just manually set the target a bit lower each time. We take batches of 2 because that's small enough to
@@ -610,6 +609,45 @@ class RetentionTestCase(DjangoTestCase):
 
             project_stored_event_count -= evicted.total
 
+    def test_retention_single_round_and_histogram_in_sync(self):
+        project = Project.objects.create(retention_max_event_count=10)
+        issue, _ = get_or_create_issue(project=project)
+        current_timestamp = datetime.datetime(2022, 1, 1, 0, 0, 0, tzinfo=datetime.timezone.utc)
+
+        for i in range(20):
+            create_event(project, issue, timestamp=current_timestamp - datetime.timedelta(hours=i % 5),
+                         irrelevance_for_retention=i % 4, never_evict=(i == 0))
+
+        self.assertEqual(get_eviction_counts_from_events(project), get_eviction_counts(project))
+
+        # 10 over the max, but eviction_target caps at 5% (of 10), i.e. 1; lower the max to get a more interesting case
+        project.retention_max_event_count = 14
+        project.save()
+
+        # assertNumQueries as a canary: phase 0 is 2 queries (min epoch, histogram), followed by a single round of
+        # eviction which visits 2 epochs (14 and 10 queries, of which 6 and 2 to keep the histogram up to date, and 3 to
+        # manage the temporary table of staged pks).
+        with self.assertNumQueries(2 + 14 + 10):
+            evicted = evict_for_max_events(project, current_timestamp, 20)
+
+        self.assertEqual(6, evicted.total)
+        self.assertEqual(get_eviction_counts_from_events(project), get_eviction_counts(project))
+
+        _delete_events(project, [Event.objects.filter(project=project, never_evict=True).get().id])
+        self.assertEqual(get_eviction_counts_from_events(project), get_eviction_counts(project))
+
+    def test_get_eviction_cutoff(self):
+        # {(age_based_irrelevance, event_irrelevance): count}; i.e. totals 4: 1, 3: 2, 2: 3, 1: 10
+        histogram = {(0, 4): 1, (1, 2): 2, (0, 2): 1, (2, 0): 2, (0, 1): 10}
+
+        self.assertEqual(3, get_eviction_cutoff(histogram, 1))  # evicting "above 3" evicts 1
+        self.assertEqual(2, get_eviction_cutoff(histogram, 2))  # evicting "above 2" evicts 3 (1 is not possible)
+        self.assertEqual(2, get_eviction_cutoff(histogram, 3))
+        self.assertEqual(1, get_eviction_cutoff(histogram, 4))
+        self.assertEqual(0, get_eviction_cutoff(histogram, 16))
+        self.assertEqual(-1, get_eviction_cutoff(histogram, 17))  # more than available
+        self.assertEqual(-1, get_eviction_cutoff({}, 1))
+
     def test_filter_for_work(self):
         # this test is mostly to help clarify how filter_for_work actually works
 
@@ -752,10 +790,10 @@ class DeleteOldEventsCommandTestCase(TransactionTestCase):
         kept_event = create_event(self.project, other_issue, timestamp=timezone.now() - datetime.timedelta(days=1))
         self._sync_counts()
 
-        with patch("events.retention._cleanup_events_on_storage") as cleanup:
+        with patch("bsmain.tasks.delete_from_storage", return_value=True) as cleanup:
             self._run_command(days=10)
 
-        cleanup.assert_called_once_with([(old_event.id, "dummy-storage")])
+        cleanup.assert_called_once_with("event", str(old_event.id), "dummy-storage")
         self.assertFalse(Event.objects.filter(pk=old_event.pk).exists())
         self.assertTrue(Event.objects.filter(pk=kept_event.pk).exists())
         self.assertEqual(0, EventTag.objects.filter(event_id=old_event.id).count())
@@ -1,8 +1,8 @@
 from os.path import basename
+from collections import ChainMap
+from copy import deepcopy
 from datetime import datetime, timezone
 from uuid import UUID
-import json
-import ecma426
 from issues.utils import get_values
 
 from bugsink.transaction import delay_on_commit
@@ -11,6 +11,8 @@ from bugsink.utils import assert_
 from compat.timestamp import format_timestamp
 
 from files.models import get_file_metadata_for_debug_ids
+from files.sourcemap_cache import get_parsed_sourcemap
+from files.sourcemap_index import open_sourcemap_index, SOURCEMAP_INDEX_FILE_TYPE
 from files.tasks import record_file_accesses
 
 
@@ -173,19 +175,32 @@ def annotate_var_with_meta(var, meta_var):
     return var
 
 
-def _postgres_fix(memoryview_or_bytes):
-    if isinstance(memoryview_or_bytes, memoryview):
-        # This is a workaround for the fact that some versions of psycopg return a memoryview instead of bytes;
-        # see https://code.djangoproject.com/ticket/27813. This problem will go away "eventually", but here's the fix
-        # till then (psycopg>=3.0.17 is OK)
-        return bytes(memoryview_or_bytes)
-    return memoryview_or_bytes
+def apply_sourcemaps_on_digest(event_data, project):
+    """
+    Applies sourcemaps to event_data (in place) as part of digestion, but only if sourcemaps for all of its frames have
+    been uploaded. Returns True if so (the Event is to be marked as sourcemaps_applied; event_data was changed, i.e. the
+    original JSON no longer matches it). Otherwise, or when this raises, event_data is left as it was, and rendering
+    applies the sourcemaps (which may have been uploaded by then).
+    """
+    if not event_data.get("debug_meta", {}).get("images", []) or "exception" not in event_data:
+        return False
+
+    # apply_sourcemaps only changes the frames, i.e. "exception"; applying to a copy of that means that failing halfway
+    # does not leave us with a half-applied event.
+    applied = dict(event_data, exception=deepcopy(event_data["exception"]))
+    if not apply_sourcemaps(applied, project):
+        return False
+
+    event_data["exception"] = applied["exception"]
+    return True
 
 
 def apply_sourcemaps(event_data, project):
+    # Returns whether the sourcemaps were fully applied, i.e. there were frames with a debug_id, and sourcemaps for all
+    # of those had been uploaded.
     images = event_data.get("debug_meta", {}).get("images", [])
     if not images:
-        return
+        return False
 
     debug_id_for_filename = {
         image["code_file"]: UUID(image["debug_id"])
@@ -193,9 +208,15 @@ def apply_sourcemaps(event_data, project):
         if "debug_id" in image and "code_file" in image and image["type"] == "sourcemap"
     }
 
-    metadata_obj_lookup = get_file_metadata_for_debug_ids(project, debug_id_for_filename.values(), "source_map")
+    # with_data=False: the File's data is only needed (and read) when the parsed sourcemap is not in the cache.
+    metadata_obj_lookup = get_file_metadata_for_debug_ids(
+        project, debug_id_for_filename.values(), "source_map", with_data=False)
+
+    # the precomputed lookup tables, for sourcemaps uploaded since we started making them (see create_sourcemap_index)
+    index_obj_lookup = get_file_metadata_for_debug_ids(
+        project, metadata_obj_lookup.keys(), SOURCEMAP_INDEX_FILE_TYPE, with_data=False)
 
-    metadata_ids = [metadata_obj.id for metadata_obj in metadata_obj_lookup.values()]
+    metadata_ids = [metadata_obj.id for metadata_obj in [*metadata_obj_lookup.values(), *index_obj_lookup.values()]]
     delay_on_commit(record_file_accesses, metadata_ids, format_timestamp(datetime.now(timezone.utc)))
 
     filenames_with_metas = [
@@ -204,25 +225,24 @@ def apply_sourcemaps(event_data, project):
         if debug_id in metadata_obj_lookup  # if not: sourcemap not uploaded
         ]
 
-    sourcemap_for_filename = {
-        filename: ecma426.loads(_postgres_fix(meta.file.get_raw_data()))
-        for (filename, meta) in filenames_with_metas
-    }
-
-    source_for_filename = {}
+    sourcemap_for_filename = {}
+    all_lines_for_source = []
     for filename, meta in filenames_with_metas:
-        sm_data = json.loads(_postgres_fix(meta.file.get_raw_data()))
-
-        sources = sm_data.get("sources", [])
-        sources_content = sm_data.get("sourcesContent", [])
+        if meta.debug_id in index_obj_lookup:
+            index = open_sourcemap_index(index_obj_lookup[meta.debug_id].file)
+            sourcemap_for_filename[filename], lines_for_source = index, index.lines_for_source
+        else:
+            sourcemap_for_filename[filename], lines_for_source = get_parsed_sourcemap(meta.file)
+        all_lines_for_source.append(lines_for_source)
 
-        for (source_file_name, source_file) in zip(sources, sources_content):
-            if source_file is not None:
-                source_for_filename[source_file_name] = source_file.splitlines()
+    # reversed: for sources that occur in more than one sourcemap, the last one wins (as it did with dict.update)
+    source_for_filename = ChainMap(*reversed(all_lines_for_source))
 
+    mapped, missing = False, False
     for exception in get_values(event_data.get("exception", {})):
         for frame in exception.get("stacktrace", {}).get("frames", []):
             if frame.get("filename") in sourcemap_for_filename:
+                mapped = True
                 if not frame.get("lineno"):
                     continue
 
@@ -256,6 +276,9 @@ def apply_sourcemaps(event_data, project):
                 # could be because the sourcemap was not uploaded. We want to show the debug_id in the stacktrace as
                 # a hint to the user that they should upload the sourcemap.
                 frame["debug_id"] = str(debug_id_for_filename[frame["filename"]])
+                missing = True
+
+    return mapped and not missing
 
 
 def get_sourcemap_images(event_data, project):
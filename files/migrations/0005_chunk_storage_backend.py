@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 08:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0004_alter_filemetadata_unique_together_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chunk',
+            name='storage_backend',
+            field=models.CharField(blank=True, default=None, editable=False, max_length=255, null=True),
+        ),
+    ]
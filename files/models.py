@@ -2,12 +2,10 @@ import logging
 from contextlib import contextmanager
 from io import BytesIO
 from django.db import models
-from django.db import transaction
 from django.db.models import Q
 
-from functools import partial
-
 from bugsink.streams import copy_stream_limited
+from bsmain.tasks import queue_storage_deletions, cancel_storage_deletions
 
 from .storage_registry import get_write_storage, get_storage
 from .object_kinds import (
@@ -24,16 +22,6 @@ def _binary_to_bytes(value):
     return value
 
 
-class Chunk(models.Model):
-    checksum = models.CharField(max_length=40, unique=True)  # unique implies index, which we also use for lookups
-    size = models.PositiveIntegerField()
-    data = models.BinaryField(null=False)  # as with Events, we can "eventually" move this out of the database
-    created_at = models.DateTimeField(auto_now_add=True, editable=False, db_index=True)
-
-    def __str__(self):
-        return self.checksum
-
-
 def get_storage_todo_for_instance(instance):
     object_kind = get_object_kind_for_model(instance.__class__)
     key = get_object_storage_key(instance, object_kind)
@@ -67,6 +55,44 @@ class StorageAwareQuerySet(models.QuerySet):
         return result
 
 
+class Chunk(models.Model):
+    checksum = models.CharField(max_length=40, unique=True)  # unique implies index, which we also use for lookups
+    size = models.PositiveIntegerField()
+
+    # Chunks are write-once, read-once (on assembly): storing them in the main DB means a lot of (WAL) churn for no
+    # benefit, so by default they're in object storage (see CHUNK_STORE_BASE_DIR); data is b"" in that case.
+    data = models.BinaryField(null=False)
+    storage_backend = models.CharField(max_length=255, blank=True, null=True, default=None, editable=False)
+    created_at = models.DateTimeField(auto_now_add=True, editable=False, db_index=True)
+
+    objects = StorageAwareQuerySet.as_manager()
+
+    def __str__(self):
+        return self.checksum
+
+    @contextmanager
+    def open_for_read(self):
+        _, key, _, storage = resolve_storage_for_instance(self)
+
+        if storage is None:
+            yield BytesIO(_binary_to_bytes(self.data))
+            return
+
+        with storage.open(key, "rb") as f:
+            yield f
+
+    def get_raw_data(self):
+        with self.open_for_read() as f:
+            return f.read()
+
+    def delete(self, *args, **kwargs):
+        object_kind, key, storage_backend = get_storage_todo_for_instance(self)
+        if storage_backend is not None:
+            cleanup_objects_on_storage([(object_kind, key, storage_backend)])
+
+        return super().delete(*args, **kwargs)
+
+
 class File(models.Model):
     # NOTE: since we do single-chunk uploads, optimizations are imaginable. Make it work first though
 
@@ -113,26 +139,22 @@ class File(models.Model):
 
 
 def write_to_storage(object_kind, key, data):
-    with get_write_storage(object_kind).open(key, "wb") as f:
+    write_storage = get_write_storage(object_kind)
+    cancel_storage_deletions(object_kind, key, write_storage.name)
+    with write_storage.open(key, "wb") as f:
         f.write(data)
 
 
 def write_fileobj_to_storage(object_kind, key, fileobj):
-    with get_write_storage(object_kind).open(key, "wb") as f:
+    write_storage = get_write_storage(object_kind)
+    cancel_storage_deletions(object_kind, key, write_storage.name)
+    with write_storage.open(key, "wb") as f:
         copy_stream_limited(fileobj, f)
 
 
 def cleanup_objects_on_storage(todos):
-    todos = list(todos)  # force evaluation _inside_ the transaction (on_commit the todos will be gone otherwise)
-    transaction.on_commit(partial(_cleanup_objects_on_storage, todos))
-
-
-def _cleanup_objects_on_storage(todos):
-    for object_kind, key, storage_backend in todos:
-        try:
-            get_storage(object_kind, storage_backend).delete(key)
-        except Exception as e:
-            logger.error("Error during cleanup of %s on %s: %s", key, storage_backend, e)
+    # queued (in the current transaction) rather than deleted on-commit; see bsmain.tasks.drain_storage_deletions.
+    queue_storage_deletions(todos)
 
 
 class FileMetadata(models.Model):
@@ -175,8 +197,11 @@ class FileMetadata(models.Model):
         ]
 
 
-def get_file_metadata_for_debug_ids(project, debug_ids, file_type):
-    """Return {debug_id: FileMetadata} for debug files visible to project."""
+def get_file_metadata_for_debug_ids(project, debug_ids, file_type, with_data=True):
+    """
+    Return {debug_id: FileMetadata} for debug files visible to project. with_data=False defers loading the File's data
+    (it's loaded on first access) for callers that may not need it.
+    """
     # TODO: this function is called in the loop, i.e. once i.e. once per minidump module/frame; this is inefficient and
     # potentially a target for DOS attacks (since the length of the loop is under attacker control).
 
@@ -184,13 +209,17 @@ def get_file_metadata_for_debug_ids(project, debug_ids, file_type):
     if not debug_ids:
         return {}
 
+    base_qs = FileMetadata.objects.select_related("file")
+    if not with_data:
+        base_qs = base_qs.defer("file__data")
+
     result = {
         metadata.debug_id: metadata
-        for metadata in FileMetadata.objects.filter(
+        for metadata in base_qs.filter(
             project=project,
             debug_id__in=debug_ids,
             file_type=file_type,
-        ).select_related("file")
+        )
     }
 
     missing_debug_ids = debug_ids - set(result)
@@ -199,11 +228,11 @@ def get_file_metadata_for_debug_ids(project, debug_ids, file_type):
         # installs working for now, but should be removed after a long transition period, e.g. May 2027.
         result.update({
             metadata.debug_id: metadata
-            for metadata in FileMetadata.objects.filter(
+            for metadata in base_qs.filter(
                 project__isnull=True,
                 debug_id__in=missing_debug_ids,
                 file_type=file_type,
-            ).select_related("file")
+            )
         })
 
     return result
@@ -0,0 +1,96 @@
+import logging
+import sys
+
+import ecma426
+
+from bugsink.app_settings import get_settings
+from bugsink.lru import SizedLRUCache
+
+performance_logger = logging.getLogger("bugsink.performance.sourcemaps")
+
+
+# In-process cache of File.checksum => (MappingIndex, {source: [lines]}), used when rendering stacktraces.
+#
+# Without it, each stacktrace page view reads every matching sourcemap from the database (or storage), parses it, and
+# splits each of its sourcesContent into lines; for multi-megabyte bundles that dominates the page's latency. Files are
+# content-addressed (the checksum is that of the data), i.e. an entry can never go stale and needs no validation; it
+# may outlive its File, which is harmless (the checksum is only looked up for FileMetadata that exist).
+#
+# The cache is bounded by a byte budget (SOURCEMAP_CACHE_MAX_BYTES) rather than by a number of entries, since sourcemaps
+# range from a few KiB to tens of MiB. The sizes are estimates of the in-memory (Python objects) size, which is much
+# larger than that of the JSON: roughly 300 bytes per decoded mapping (the Mapping itself and its entry in the index).
+_cache = None
+
+BYTES_PER_MAPPING = 320  # measured (tracemalloc) on a synthetic 50k-mappings map: ~310
+
+
+def _get_cache():
+    global _cache
+    if _cache is None:
+        _cache = SizedLRUCache(get_settings().SOURCEMAP_CACHE_MAX_BYTES)
+    return _cache
+
+
+def _estimate_size(sourcemap, lines_for_source):
+    return (
+        BYTES_PER_MAPPING * len(sourcemap.tokens) +
+        sum(sys.getsizeof(line) + 8 for lines in lines_for_source.values() for line in lines))
+
+
+def parse_sourcemap(data):
+    """Returns (MappingIndex, {source: [lines]}) for the sourcemap's raw data (bytes)."""
+    if isinstance(data, memoryview):
+        # This is a workaround for the fact that some versions of psycopg return a memoryview instead of bytes;
+        # see https://code.djangoproject.com/ticket/27813. This problem will go away "eventually", but here's the fix
+        # till then (psycopg>=3.0.17 is OK)
+        data = bytes(data)
+
+    # a single parse of the JSON: ecma426 keeps the parsed object around as .raw, which is where sourcesContent is.
+    sourcemap = ecma426.loads(data)
+
+    sources = sourcemap.raw.get("sources", [])
+    sources_content = sourcemap.raw.get("sourcesContent", [])
+
+    lines_for_source = {
+        source: content.splitlines()
+        for (source, content) in zip(sources, sources_content)
+        if content is not None
+    }
+
+    # the parsed JSON (including all of sourcesContent, in unsplit form) is not needed for lookups; we don't want the
+    # cache to hold on to it.
+    sourcemap.raw = None
+
+    return sourcemap, lines_for_source
+
+
+def get_parsed_sourcemap(file):
+    """
+    Returns (MappingIndex, {source: [lines]}) for the File; from the cache if possible. The File's data is only read
+    (i.e. a `File` whose data is deferred is fine) on a miss. The returned objects are shared: don't mutate them.
+    """
+    if get_settings().SOURCEMAP_CACHE_MAX_BYTES == 0:
+        return parse_sourcemap(file.get_raw_data())
+
+    cache = _get_cache()
+    result = cache.get(file.checksum)
+    if result is None:
+        result = parse_sourcemap(file.get_raw_data())
+        cache.put(file.checksum, result, _estimate_size(*result))
+
+    stats = cache.get_stats()
+    performance_logger.info(
+        "sourcemap cache (hits: %d, misses: %d, evictions: %d, entries: %d, bytes: %d/%d)", stats["hits"],
+        stats["misses"], stats["evictions"], stats["entries"], stats["bytes"], stats["max_bytes"])
+
+    return result
+
+
+def get_sourcemap_cache_stats():
+    """hits/misses/evictions, and entries/bytes/max_bytes, for the current process."""
+    return _get_cache().get_stats()
+
+
+def clear_sourcemap_cache():
+    global _cache
+    _cache = None
@@ -0,0 +1,195 @@
+import mmap
+import struct
+from collections.abc import Mapping as MappingABC
+
+import ecma426
+from ecma426.model import Mapping
+
+from .models import resolve_storage_for_instance
+
+
+# A compact, precomputed lookup table for a sourcemap, built at upload time (see assemble_artifact_bundle) and stored as
+# a File of its own (FileMetadata.file_type == SOURCEMAP_INDEX_FILE_TYPE, same debug_id as the sourcemap). Rendering a
+# stacktrace with it takes a binary search per frame: no JSON parsing, no VLQ decoding. When the File is in filesystem
+# object storage the table is memory-mapped, i.e. only the pages that the binary search touches are read.
+#
+# Layout (little-endian):
+#
+#   header                  MAGIC, VERSION, n_mappings, n_sources, n_names
+#   mappings                n_mappings * (generated_line, generated_column, source, original_line, original_column,
+#                           name), sorted by (generated_line, generated_column); source/name are indexes into the
+#                           strings, NONE for "unmapped"/"no name".
+#   has_content             n_sources bytes: whether sourcesContent has an entry for the source
+#   string offsets          (n_strings + 1) offsets, relative to the start of the string data
+#   string data             utf-8: n_sources source names, n_sources source contents, n_names names
+#
+# Lookups have the semantics of ecma426's MappingIndex.lookup_left: an exact hit if present (the last one, for
+# duplicates), otherwise the nearest mapping to the left on the same generated line; IndexError if there is none.
+
+SOURCEMAP_INDEX_FILE_TYPE = "sourcemap_index"
+
+MAGIC = b"BSMX"
+VERSION = 1
+NONE = 0xFFFFFFFF
+
+HEADER = struct.Struct("<4sIIII")
+MAPPING = struct.Struct("<IIIIII")
+OFFSET = struct.Struct("<I")
+
+
+def build_sourcemap_index(data):
+    """Returns the index (bytes) for the sourcemap's raw data; raises like ecma426.loads for invalid sourcemaps."""
+    sourcemap = ecma426.loads(data)
+
+    sources = [source or "" for source in sourcemap.raw.get("sources", [])]
+    sources_content = sourcemap.raw.get("sourcesContent", []) or []
+    contents = [
+        sources_content[i] if i < len(sources_content) and sources_content[i] is not None else None
+        for i in range(len(sources))]
+
+    names = []
+    name_idx = {}
+    source_idx = {source: i for i, source in enumerate(sources)}
+
+    entries = bytearray()
+
+    # sorted() is stable, i.e. for duplicate (generated_line, generated_column) the last one is last, as required above.
+    for token in sorted(sourcemap.tokens, key=lambda t: (t.generated_line, t.generated_column)):
+        if token.name is not None and token.name not in name_idx:
+            name_idx[token.name] = len(names)
+            names.append(token.name)
+
+        if token.source and token.source not in source_idx:
+            # index maps ("sections") have their sources per section rather than at the top level; ecma426 does not
+            # expose their content, so (as in parse_sourcemap) there are no lines for these.
+            source_idx[token.source] = len(sources)
+            sources.append(token.source)
+            contents.append(None)
+
+        entries += MAPPING.pack(
+            token.generated_line,
+            token.generated_column,
+            source_idx[token.source] if token.source else NONE,
+            token.original_line,
+            token.original_column,
+            NONE if token.name is None else name_idx[token.name],
+        )
+
+    strings = [s.encode("utf-8") for s in sources + [c or "" for c in contents] + names]
+    offsets = [0]
+    for s in strings:
+        offsets.append(offsets[-1] + len(s))
+
+    return b"".join([
+        HEADER.pack(MAGIC, VERSION, len(sourcemap.tokens), len(sources), len(names)),
+        bytes(entries),
+        bytes(content is not None for content in contents),
+        b"".join(OFFSET.pack(offset) for offset in offsets),
+        b"".join(strings),
+    ])
+
+
+class SourcemapIndex:
+    """Lookups in an index as built by build_sourcemap_index; buffer is anything that supports the buffer protocol."""
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        magic, version, self.n_mappings, self.n_sources, self.n_names = HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not a sourcemap index (or an unsupported version)")
+
+        self.mappings_start = HEADER.size
+        self.has_content_start = self.mappings_start + self.n_mappings * MAPPING.size
+        self.offsets_start = self.has_content_start + self.n_sources
+        self.strings_start = self.offsets_start + (2 * self.n_sources + self.n_names + 1) * OFFSET.size
+
+        self.lines_for_source = _LinesForSource(self)
+
+    def _mapping_at(self, i):
+        return MAPPING.unpack_from(self.buffer, self.mappings_start + i * MAPPING.size)
+
+    def _string_at(self, i):
+        start, end = struct.unpack_from("<II", self.buffer, self.offsets_start + i * OFFSET.size)
+        return bytes(self.buffer[self.strings_start + start:self.strings_start + end]).decode("utf-8")
+
+    def _content_at(self, i):
+        return self._string_at(self.n_sources + i) if self.buffer[self.has_content_start + i] else None
+
+    def _name_at(self, i):
+        return self._string_at(2 * self.n_sources + i)
+
+    def lookup_left(self, line, column):
+        # binary search for the rightmost mapping <= (line, column)
+        lo, hi = 0, self.n_mappings
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._mapping_at(mid)[:2] <= (line, column):
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo == 0:
+            raise IndexError((line, column))
+
+        generated_line, generated_column, source, original_line, original_column, name = self._mapping_at(lo - 1)
+        if generated_line != line:
+            raise IndexError((line, column))
+
+        return Mapping(
+            generated_line=generated_line,
+            generated_column=generated_column,
+            source="" if source == NONE else self._string_at(source),
+            original_line=original_line,
+            original_column=original_column,
+            name=None if name == NONE else self._name_at(name),
+        )
+
+
+class _LinesForSource(MappingABC):
+    """
+    {source: [lines]} for the sources that have content; computed on first access (only for the sources that are used),
+    and remembered: apply_sourcemaps asks for the lines once per frame, and many frames map into the same (big) source.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self._positions = None
+        self._lines = {}
+
+    def _get_positions(self):
+        if self._positions is None:
+            self._positions = {}
+            for i in range(self.index.n_sources):
+                if self.index.buffer[self.index.has_content_start + i]:
+                    # for duplicate sources the last one wins, as in (the dict of) parse_sourcemap
+                    self._positions[self.index._string_at(i)] = i
+        return self._positions
+
+    def __getitem__(self, source):
+        if source not in self._lines:
+            self._lines[source] = self.index._content_at(self._get_positions()[source]).splitlines()
+        return self._lines[source]
+
+    def __contains__(self, source):
+        return source in self._get_positions()
+
+    def __iter__(self):
+        return iter(self._get_positions())
+
+    def __len__(self):
+        return len(self._get_positions())
+
+
+def open_sourcemap_index(file):
+    """
+    Returns a SourcemapIndex for the File; memory-mapped if it's in (local) filesystem storage, read in full otherwise.
+    """
+    _, key, _, storage = resolve_storage_for_instance(file)
+    local_path = None if storage is None else storage.local_path(key)
+
+    if local_path is None:
+        return SourcemapIndex(file.get_raw_data())
+
+    with open(local_path, "rb") as f:
+        # the mapping stays valid after the file is closed (and is unmapped when it's garbage collected)
+        return SourcemapIndex(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
@@ -4,6 +4,8 @@ from pathlib import Path
 
 from django.utils._os import safe_join
 
+from bsmain.utils import b108_makedirs
+
 
 logger = logging.getLogger("bugsink.objectstorage")
 
@@ -25,6 +27,10 @@ class ObjectStorage:
     def list(self):
         raise NotImplementedError()
 
+    def local_path(self, key):
+        """The path of the object on the local filesystem for storages that have one (e.g. for mmap); None otherwise."""
+        return None
+
 
 class ObjectFileStorage(ObjectStorage):
     def __init__(self, name, object_kind, basepath=None, get_basepath=None, **kwargs):
@@ -56,6 +62,9 @@ class ObjectFileStorage(ObjectStorage):
     def exists(self, key):
         return os.path.exists(self._path(key))
 
+    def local_path(self, key):
+        return self._path(key)
+
     def delete(self, key):
         os.remove(self._path(key))
 
@@ -64,3 +73,15 @@ class ObjectFileStorage(ObjectStorage):
             return []
 
         return (p.name for p in os.scandir(self.get_basepath(self.object_kind)))
+
+
+class ChunkFileStorage(ObjectFileStorage):
+    """
+    The storage for Chunks when OBJECT_STORAGES has no entry for them (see CHUNK_STORE_BASE_DIR). Since that directory
+    defaults to a location in /tmp, it gets the same hardening as the ingest store.
+    """
+
+    def open(self, key, mode="rb"):
+        if mode == "wb":
+            b108_makedirs(self.get_basepath(self.object_kind))
+        return super().open(key, mode)
@@ -4,6 +4,8 @@ import importlib
 from bugsink.app_settings import get_settings, override_settings
 
 
+DEFAULT_CHUNK_STORAGE_NAME = "chunk_store"
+
 _storages = None
 _write_storages = None
 
@@ -15,11 +17,13 @@ def _ensure_storages():
     if _storages is not None:
         return
 
-    _storages = {}
-    _write_storages = {}
+    # built locally and published only when complete: other threads (e.g. drain_storage_deletions' workers) may call in
+    # concurrently, and must not see a half-filled registry.
+    storages = {}
+    write_storages = {}
 
     for object_kind, object_kind_conf in get_settings().OBJECT_STORAGES.items():
-        _storages[object_kind] = {
+        storages[object_kind] = {
             name: _resolve(object_kind, name, conf)
             for name, conf in object_kind_conf.items()
         }
@@ -27,11 +31,22 @@ def _ensure_storages():
         matching = [name for name, conf in object_kind_conf.items() if conf.get("USE_FOR_WRITE", False)]
 
         if len(matching) == 1:
-            _write_storages[object_kind] = _storages[object_kind][matching[0]]
+            write_storages[object_kind] = storages[object_kind][matching[0]]
         elif len(matching) > 1:
             raise ValueError(f"Multiple USE_FOR_WRITE storages found for {object_kind}.")
         else:
-            _write_storages[object_kind] = None
+            write_storages[object_kind] = None
+
+    if "chunk" not in storages and get_settings().CHUNK_STORE_BASE_DIR is not None:
+        # the default for chunks, see CHUNK_STORE_BASE_DIR
+        storages["chunk"] = {DEFAULT_CHUNK_STORAGE_NAME: _resolve("chunk", DEFAULT_CHUNK_STORAGE_NAME, {
+            "STORAGE": "files.storage.ChunkFileStorage",
+            "OPTIONS": {"basepath": get_settings().CHUNK_STORE_BASE_DIR},
+        })}
+        write_storages["chunk"] = storages["chunk"][DEFAULT_CHUNK_STORAGE_NAME]
+
+    _write_storages = write_storages  # first, because _storages is what's checked for "ready"
+    _storages = storages
 
 
 def get_write_storage(object_kind):
@@ -39,6 +54,11 @@ def get_write_storage(object_kind):
     return _write_storages.get(object_kind)
 
 
+def get_storage_names(object_kind):
+    _ensure_storages()
+    return list(_storages.get(object_kind, {}).keys())
+
+
 def get_storage(object_kind, storage_name):
     _ensure_storages()
     return _storages[object_kind][storage_name]
@@ -5,20 +5,22 @@ from datetime import timedelta
 from zipfile import ZipFile
 import json
 from hashlib import sha1
-from os.path import basename
+from os.path import basename, join
 from django.utils import timezone
 from django.db.models import Count, Sum
 
 from compat.timestamp import parse_timestamp
 from snappea.decorators import shared_task
+from snappea.processes import run_cpu_bound_many
 
 from bugsink.transaction import immediate_atomic, delay_on_commit
 from bugsink.app_settings import get_settings
-from bugsink.streams import copy_stream_limited
+from bugsink.streams import copy_stream_limited, MaxLengthExceeded
 from bugsink.timed_sqlite_backend.base import allow_long_running_queries
 
-from .models import Chunk, File, FileMetadata, write_fileobj_to_storage, _binary_to_bytes
+from .models import Chunk, File, FileMetadata, write_fileobj_to_storage
 from .storage_registry import get_write_storage
+from .sourcemap_index import build_sourcemap_index, SOURCEMAP_INDEX_FILE_TYPE, VERSION as SOURCEMAP_INDEX_VERSION
 
 logger = logging.getLogger("bugsink.api")
 
@@ -37,7 +39,9 @@ IN_CODE_DEBUG_ID_REGEX = re.compile(
 DEBUG_ID_SCAN_TAIL_SIZE = 64 * 1024
 
 
-def create_file_from_local_file(checksum, filename, size, local_file):
+def create_file_from_local_file(checksum, filename, size, local_file, stored=False):
+    # stored: the object has already been written to the write-storage (i.e. outside of the transaction, see
+    # store_unlocked); storage keys are content-addressed, so that write is good for whoever creates the row.
     write_storage = get_write_storage("file")
     file, created = File.objects.get_or_create(
         checksum=checksum,
@@ -48,13 +52,27 @@ def create_file_from_local_file(checksum, filename, size, local_file):
             "storage_backend": None if write_storage is None else write_storage.name,
         })
 
-    if created and write_storage is not None:
+    if created and write_storage is not None and not stored:
         local_file.seek(0)
         write_fileobj_to_storage("file", checksum, local_file)
 
     return file, created
 
 
+def store_unlocked(checksum, path):
+    """
+    Writes the file at path to the write-storage (if any, and if there's no File for it yet) without holding the write
+    lock; returns whether it did. The File-row itself is created later (under the lock) by create_file_from_local_file.
+    If that never happens (crash, error) we're left with an orphan, which cleanup_objectstorage takes care of.
+    """
+    if get_write_storage("file") is None or File.objects.filter(checksum=checksum).exists():
+        return False
+
+    with open(path, "rb") as f:
+        write_fileobj_to_storage("file", checksum, f)
+    return True
+
+
 def read_limited_bytes(input_stream, max_bytes):
     with tempfile.SpooledTemporaryFile(max_size=max_bytes + 1) as output_stream:
         bytes_read = copy_stream_limited(
@@ -108,81 +126,224 @@ def find_in_code_debug_ids(local_file):
     return matches
 
 
+class ExtractedEntry:
+    """The result of process_bundle_entry; plain values only, since it may be returned from a pool process."""
+
+    def __init__(self, checksum, size, in_code_debug_ids, index_checksum, index_size, index_error):
+        self.checksum = checksum
+        self.size = size
+        self.in_code_debug_ids = in_code_debug_ids
+        self.index_checksum = index_checksum  # None if no index was built (not a sourcemap, or index_error)
+        self.index_size = index_size
+        self.index_error = index_error
+
+        # whether the entry/index was written to the write-storage before the File was created (see store_unlocked)
+        self.stored = False
+        self.index_stored = False
+
+
+def process_bundle_entry(bundle_path, zip_entry_name, file_type, entry_path, index_path, max_file_size):
+    """
+    The per-entry work of assemble_artifact_bundle that needs neither the DB nor the write lock: extraction (to
+    entry_path) and hashing, scanning for in-code debug ids, and building the sourcemap's lookup index (to index_path).
+    Runs in snappea's process pool when there is one (see run_cpu_bound_many), i.e. one entry per process in parallel.
+    """
+    index_checksum, index_size, index_error = None, None, None
+
+    with ZipFile(bundle_path) as bundle_zip, open(entry_path, "w+b") as local_file:
+        checksum, size = extract_zip_entry_to_file(bundle_zip, zip_entry_name, local_file, max_file_size)
+
+        # the in-code regexes show up in the _minified_ source only (the sourcemap's original source code will not have
+        # been "polluted" with it yet, since it's the original).
+        in_code_debug_ids = find_in_code_debug_ids(local_file) if file_type == "minified_source" else set()
+
+        if file_type == "source_map":
+            # Precomputes the lookup table for the sourcemap (see sourcemap_index.py), such that rendering stacktraces
+            # does not need to parse the sourcemap. Failure to do so is not fatal: without an index, the sourcemap
+            # itself is used. Hence the broad except: uploads may contain anything (e.g. JSON that's not an object).
+            local_file.seek(0)
+            try:
+                index_data = build_sourcemap_index(local_file.read())
+            except Exception as e:
+                index_error = str(e)
+            else:
+                index_checksum = sha1(index_data, usedforsecurity=False).hexdigest()
+                index_size = len(index_data)
+                with open(index_path, "wb") as f:
+                    f.write(index_data)
+
+    return ExtractedEntry(checksum, size, in_code_debug_ids, index_checksum, index_size, index_error)
+
+
+def store_sourcemap_index(extracted, index_path, filename, debug_id, project_ids):
+    with open(index_path, "rb") as f:
+        index_file, _ = create_file_from_local_file(
+            extracted.index_checksum, f"{filename}.index"[:255], extracted.index_size, f, stored=extracted.index_stored)
+
+    for project_id in project_ids:
+        FileMetadata.objects.get_or_create(
+            project_id=project_id,
+            debug_id=debug_id,
+            file_type=SOURCEMAP_INDEX_FILE_TYPE,
+            defaults={
+                "file": index_file,
+                "data": json.dumps({"version": SOURCEMAP_INDEX_VERSION}),
+            }
+        )
+
+
 @shared_task
 def assemble_artifact_bundle(bundle_checksum, chunk_checksums, project_ids):
-    # arguably, you could just wrap-around each operation, "around everything" guarantees a fully consistent update on
-    # the data and we don't do this that often that it's assumed to matter.
-    with immediate_atomic():
-        # NOTE: as it stands we don't store the (optional) extra info of release/dist.
-
-        # NOTE: there's also the concept of an artifact bundle as _tied_ to a release, i.e. without debug_ids. We don't
-        # support that, but if we ever were to support it we'd need a separate method/param to distinguish it.
-
-        bundle_file, _ = assemble_file(bundle_checksum, chunk_checksums, filename=f"{bundle_checksum}.zip")
-
-        max_file_size = get_settings().MAX_FILE_SIZE
-        with tempfile.TemporaryDirectory() as tempdir:
-            with bundle_file.open_for_read() as f:
-                with ZipFile(f) as bundle_zip:
-                    with bundle_zip.open("manifest.json") as manifest_stream:
-                        manifest_bytes, _ = read_limited_bytes(manifest_stream, max_file_size)
-                    manifest = json.loads(manifest_bytes.decode("utf-8"))
-
-                    for zip_entry_name, manifest_entry in manifest["files"].items():
-                        with tempfile.TemporaryFile(dir=tempdir) as local_file:
-                            checksum, size = extract_zip_entry_to_file(
-                                bundle_zip, zip_entry_name, local_file, max_file_size,
-                            )
-
-                            local_file.seek(0)
-                            filename = basename(manifest_entry.get("url", zip_entry_name))[:255]
-                            file, _ = create_file_from_local_file(checksum, filename, size, local_file)
-
-                            debug_id = manifest_entry.get("headers", {}).get("debug-id", None)
-                            file_type = manifest_entry.get("type", None)
-                            if debug_id is None or file_type is None:
-                                because = (
-                                    "it has neither Debug ID nor file-type"
-                                    if debug_id is None and file_type is None else
-                                    "it has no Debug ID" if debug_id is None else "it has no file-type")
-
-                                logger.warning(
-                                    "Uploaded file %s will be ignored by Bugsink because %s.",
-                                    filename,
-                                    because,
-                                )
-
-                                continue
-
-                            for project_id in project_ids:
-                                FileMetadata.objects.get_or_create(
-                                    project_id=project_id,
-                                    debug_id=debug_id,
-                                    file_type=file_type,
-                                    defaults={
-                                        "file": file,
-                                        "data": json.dumps(manifest_entry),
-                                    }
-                                )
-
-                            # the in-code regexes show up in the _minified_ source only (the sourcemap's original source
-                            # code will not have been "polluted" with it yet, since it's the original).
-                            if file_type == "minified_source":
-                                mismatches = find_in_code_debug_ids(local_file) - {debug_id}
-                                if mismatches:
-                                    logger.warning(
-                                        (
-                                            "Uploaded file %s contains multiple Debug IDs. "
-                                            "Uploaded as %s, but also found: %s."
-                                        ),
-                                        filename,
-                                        debug_id,
-                                        ", ".join(sorted(mismatches)),
-                                    )
-
-        if not get_settings().KEEP_ARTIFACT_BUNDLES:
-            # delete the bundle file after processing, since we don't need it anymore.
-            bundle_file.delete()
+    # A staged pipeline, such that a large upload does not block digestion (or anything else that writes) for the whole
+    # of its processing. Only the last stage holds the write lock:
+    #
+    # 1. (unlocked) the bundle is assembled from its chunks into a local file, and its manifest is read.
+    # 2. (unlocked) per entry: extraction, hashing, debug-id scanning and sourcemap indexing (see process_bundle_entry);
+    #    in parallel in snappea's process pool if there is one. The results are written to the write-storage (if any).
+    # 3. (immediate_atomic) the File and FileMetadata rows are created, and the used chunks are deleted.
+    #
+    # Since rows are created in stage 3 only, a bundle is still added "all or nothing". Whatever is done in stages 1 and
+    # 2 is idempotent (local temp files, content-addressed storage keys); races with a concurrent upload of the same
+    # files are resolved by the get_or_create calls in stage 3.
+
+    # NOTE: as it stands we don't store the (optional) extra info of release/dist.
+
+    # NOTE: there's also the concept of an artifact bundle as _tied_ to a release, i.e. without debug_ids. We don't
+    # support that, but if we ever were to support it we'd need a separate method/param to distinguish it.
+
+    max_file_size = get_settings().MAX_FILE_SIZE
+    with tempfile.TemporaryDirectory() as tempdir:
+        # stage 1. Note that (as elsewhere) we never use the checksums (user input) in temp filenames.
+        bundle_path = join(tempdir, "bundle.zip")
+        with open(bundle_path, "w+b") as local_file:
+            existing_bundle = File.objects.filter(checksum=bundle_checksum).first()
+            if existing_bundle is not None:
+                with existing_bundle.open_for_read() as f:
+                    bundle_size = copy_stream_limited(f, local_file)
+            else:
+                bundle_size = assemble_chunks_to_local_file(bundle_checksum, chunk_checksums, local_file)
+
+        with ZipFile(bundle_path) as bundle_zip:
+            with bundle_zip.open("manifest.json") as manifest_stream:
+                manifest_bytes, _ = read_limited_bytes(manifest_stream, max_file_size)
+        manifest = json.loads(manifest_bytes.decode("utf-8"))
+
+        # stage 2
+        entries = [
+            (zip_entry_name, manifest_entry, join(tempdir, f"{i}.entry"), join(tempdir, f"{i}.index"))
+            for i, (zip_entry_name, manifest_entry) in enumerate(manifest["files"].items())]
+
+        extracted_entries = run_cpu_bound_many(process_bundle_entry, [
+            (bundle_path, zip_entry_name, manifest_entry.get("type", None), entry_path, index_path, max_file_size)
+            for zip_entry_name, manifest_entry, entry_path, index_path in entries])
+
+        bundle_stored = (
+            existing_bundle is None and get_settings().KEEP_ARTIFACT_BUNDLES
+            and store_unlocked(bundle_checksum, bundle_path))
+
+        for (_, _, entry_path, index_path), extracted in zip(entries, extracted_entries):
+            extracted.stored = store_unlocked(extracted.checksum, entry_path)
+            extracted.index_stored = (
+                extracted.index_checksum is not None and store_unlocked(extracted.index_checksum, index_path))
+
+        # stage 3
+        with immediate_atomic():
+            if existing_bundle is None:
+                if get_settings().KEEP_ARTIFACT_BUNDLES:
+                    with open(bundle_path, "rb") as f:
+                        create_file_from_local_file(
+                            bundle_checksum, f"{bundle_checksum}.zip", bundle_size, f, stored=bundle_stored)
+
+                # as in assemble_file: chunks are basically use-once.
+                Chunk.objects.filter(checksum__in=chunk_checksums).delete()
+
+            elif not get_settings().KEEP_ARTIFACT_BUNDLES:
+                # delete the bundle file after processing, since we don't need it anymore.
+                existing_bundle.delete()
+
+            for (zip_entry_name, manifest_entry, entry_path, index_path), extracted in zip(entries, extracted_entries):
+                filename = basename(manifest_entry.get("url", zip_entry_name))[:255]
+                with open(entry_path, "rb") as local_file:
+                    file, _ = create_file_from_local_file(
+                        extracted.checksum, filename, extracted.size, local_file, stored=extracted.stored)
+
+                debug_id = manifest_entry.get("headers", {}).get("debug-id", None)
+                file_type = manifest_entry.get("type", None)
+                if debug_id is None or file_type is None:
+                    because = (
+                        "it has neither Debug ID nor file-type"
+                        if debug_id is None and file_type is None else
+                        "it has no Debug ID" if debug_id is None else "it has no file-type")
+
+                    logger.warning(
+                        "Uploaded file %s will be ignored by Bugsink because %s.",
+                        filename,
+                        because,
+                    )
+
+                    continue
+
+                project_ids_for_file = []
+                for project_id in project_ids:
+                    metadata, _ = FileMetadata.objects.get_or_create(
+                        project_id=project_id,
+                        debug_id=debug_id,
+                        file_type=file_type,
+                        defaults={
+                            "file": file,
+                            "data": json.dumps(manifest_entry),
+                        }
+                    )
+                    if metadata.file_id == file.id:
+                        project_ids_for_file.append(project_id)
+
+                if file_type == "source_map" and project_ids_for_file:
+                    # only for the projects where the debug_id actually points to this file (get_or_create does not
+                    # replace existing metadata), such that index and sourcemap always agree.
+                    if extracted.index_error is not None:
+                        logger.warning(
+                            "Could not build a lookup index for sourcemap %s: %s", filename, extracted.index_error)
+                    else:
+                        store_sourcemap_index(extracted, index_path, filename, debug_id, project_ids_for_file)
+
+                mismatches = extracted.in_code_debug_ids - {debug_id}
+                if mismatches:
+                    logger.warning(
+                        (
+                            "Uploaded file %s contains multiple Debug IDs. "
+                            "Uploaded as %s, but also found: %s."
+                        ),
+                        filename,
+                        debug_id,
+                        ", ".join(sorted(mismatches)),
+                    )
+
+
+def assemble_chunks_to_local_file(checksum, chunk_checksums, local_file):
+    """Writes the chunks to local_file (in order), checking size and checksum; returns the size."""
+    chunks = Chunk.objects.filter(checksum__in=chunk_checksums)
+    chunks_dicts = {chunk.checksum: chunk for chunk in chunks}
+    chunks_in_order = [chunks_dicts[checksum] for checksum in chunk_checksums]  # implicitly checks chunk availability
+    max_file_size = get_settings().MAX_FILE_SIZE
+
+    # usedforsecurity=false: sha1 is not used cryptographically, and it's part of the protocol, so we use it as is.
+    checksum_state = sha1(usedforsecurity=False)
+    size = 0
+
+    for chunk in chunks_in_order:
+        # streamed (from the chunk storage, or from memory for chunks in the DB). A kernel-side copy (sendfile and the
+        # like) would not save us anything: the checksum (of the whole, as claimed by the client) must be verified
+        # anyway, i.e. each byte passes through here regardless.
+        with chunk.open_for_read() as f:
+            try:
+                size += copy_stream_limited(f, local_file, max_bytes=max_file_size - size, digest=checksum_state)
+            except MaxLengthExceeded:
+                raise ValueError("Assembled file exceeds MAX_FILE_SIZE")
+
+    if checksum_state.hexdigest() != checksum:
+        raise Exception("checksum mismatch")
+
+    return size
 
 
 def assemble_file(checksum, chunk_checksums, filename):
@@ -197,30 +358,9 @@ def assemble_file(checksum, chunk_checksums, filename):
     except File.DoesNotExist:
         pass  # i.e. continue below
 
-    chunks = Chunk.objects.filter(checksum__in=chunk_checksums)
-    chunks_dicts = {chunk.checksum: chunk for chunk in chunks}
-    chunks_in_order = [chunks_dicts[checksum] for checksum in chunk_checksums]  # implicitly checks chunk availability
-    max_file_size = get_settings().MAX_FILE_SIZE
-
     with tempfile.TemporaryDirectory() as tempdir:
         with tempfile.TemporaryFile(dir=tempdir) as local_file:
-            # usedforsecurity=false: sha1 is not used cryptographically, and it's part of the protocol, so we use it
-            # as is.
-            checksum_state = sha1(usedforsecurity=False)
-            size = 0
-
-            for chunk in chunks_in_order:
-                chunk_data = _binary_to_bytes(chunk.data)
-                next_size = size + len(chunk_data)
-                if next_size > max_file_size:
-                    raise ValueError("Assembled file exceeds MAX_FILE_SIZE")
-
-                local_file.write(chunk_data)
-                checksum_state.update(chunk_data)
-                size = next_size
-
-            if checksum_state.hexdigest() != checksum:
-                raise Exception("checksum mismatch")
+            size = assemble_chunks_to_local_file(checksum, chunk_checksums, local_file)
 
             local_file.seek(0)
             file, created = create_file_from_local_file(checksum, filename, size, local_file)
@@ -228,7 +368,7 @@ def assemble_file(checksum, chunk_checksums, filename):
             # the assumption here is: chunks are basically use-once, so we can delete them after use. "in theory" a
             # chunk may be used in multiple files (which are still being assembled) but with chunksizes in the order
             # of 1MiB, I'd say this is unlikely.
-            chunks.delete()
+            Chunk.objects.filter(checksum__in=chunk_checksums).delete()
             return file, created
 
 
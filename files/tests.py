@@ -11,6 +11,10 @@ import subprocess
 import tempfile
 from pathlib import Path
 from types import SimpleNamespace
+import mmap
+
+import ecma426
+from ecma426.model import Mapping
 from zipfile import ZipFile, ZIP_DEFLATED
 
 from django.test import tag
@@ -18,7 +22,9 @@ from django.contrib.auth import get_user_model
 from django.test import LiveServerTestCase, override_settings
 from django.core.management.base import CommandError
 from django.core.management import call_command
+from django.db import connection
 from unittest.mock import patch
+from unittest import TestCase as RegularTestCase
 
 from compat.dsn import get_header_value
 from bugsink.test_utils import TransactionTestCase25251 as TransactionTestCase
@@ -33,7 +39,9 @@ from bugsink.streams import MaxLengthExceeded
 from .models import Chunk, File, FileMetadata, get_file_metadata_for_debug_ids
 from .minidump import event_threads_for_process_state
 from .storage_registry import override_object_storages
-from .tasks import assemble_file
+from .tasks import assemble_file, process_bundle_entry, write_fileobj_to_storage as real_write_fileobj_to_storage
+from .sourcemap_cache import get_parsed_sourcemap, get_sourcemap_cache_stats, clear_sourcemap_cache, parse_sourcemap
+from .sourcemap_index import build_sourcemap_index, open_sourcemap_index, SourcemapIndex
 from .views import CHUNK_UPLOAD_SIZE
 
 
@@ -138,6 +146,32 @@ class FilesTests(TransactionTestCase):
                 self.assertEqual(data, file.get_raw_data())
                 self.assertEqual(data, Path(tempdir, checksum).read_bytes())
 
+    def test_chunks_are_stored_outside_of_the_database(self):
+        data = b"hello world"
+        checksum = sha1(data, usedforsecurity=False).hexdigest()
+        upload = BytesIO(gzip.compress(data))
+        upload.name = checksum
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            with override_object_storages({}), bugsink_override_settings(CHUNK_STORE_BASE_DIR=tempdir):
+                response = self.client.post(
+                    "/api/0/organizations/anyorg/chunk-upload/",
+                    data={"file_gzip": upload},
+                    headers=self.token_headers,
+                )
+                self.assertEqual(200, response.status_code)
+
+                chunk = Chunk.objects.get()
+                self.assertEqual(("chunk_store", b""), (chunk.storage_backend, bytes(chunk.data)))
+                self.assertEqual(data, Path(tempdir, checksum).read_bytes())
+
+                file, _ = assemble_file(checksum, [checksum], filename="hello.txt")
+                self.assertEqual(data, file.get_raw_data())
+
+                # the chunk is deleted from the storage too (after commit, via the queue of storage deletions)
+                self.assertFalse(Chunk.objects.exists())
+                self.assertFalse(Path(tempdir, checksum).exists())
+
     def test_open_for_read_works_for_db_and_object_storage(self):
         data = b"hello world"
         checksum = sha1(data, usedforsecurity=False).hexdigest()
@@ -213,6 +247,62 @@ class FilesTests(TransactionTestCase):
                             headers=self.token_headers,
                         )
 
+    def test_artifact_bundle_heavy_lifting_is_done_outside_of_the_transaction(self):
+        minified_debug_id, sourcemap_debug_id = str(uuid4()), str(uuid4())
+        other_debug_id = str(uuid4())
+        minified_data = f'e._sentryDebugIds[n]="{other_debug_id}";function a(){{}}'.encode("utf-8")
+        sourcemap = ecma426.encode([Mapping(0, 0, "src/app.ts", 0, 0, "a")])
+        sourcemap["sourcesContent"] = ["function a() {}"]
+        manifest = {
+            "files": {
+                "~/app.min.js": {
+                    "url": "~/app.min.js", "type": "minified_source", "headers": {"debug-id": minified_debug_id}},
+                "~/app.min.js.map": {
+                    "url": "~/app.min.js.map", "type": "source_map", "headers": {"debug-id": sourcemap_debug_id}},
+            },
+        }
+
+        bundle = BytesIO()
+        with ZipFile(bundle, "w", compression=ZIP_DEFLATED) as zf:
+            zf.writestr("manifest.json", json.dumps(manifest))
+            zf.writestr("~/app.min.js", minified_data)
+            zf.writestr("~/app.min.js.map", json.dumps(sourcemap))
+        bundle_data = bundle.getvalue()
+        checksum = sha1(bundle_data, usedforsecurity=False).hexdigest()
+        Chunk.objects.create(checksum=checksum, size=len(bundle_data), data=bundle_data)
+
+        in_atomic_block_on_write = []
+
+        def write_fileobj_to_storage(object_kind, key, fileobj):
+            in_atomic_block_on_write.append(connection.in_atomic_block)
+            return real_write_fileobj_to_storage(object_kind, key, fileobj)
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            with bugsink_override_settings(KEEP_ARTIFACT_BUNDLES=True), override_object_storages(
+                    get_test_object_storages(tempdir, use_for_write=True)):
+                with patch("files.tasks.write_fileobj_to_storage", side_effect=write_fileobj_to_storage):
+                    with self.assertLogs("bugsink.api", level="WARNING") as cm:
+                        response = self.client.post(
+                            "/api/0/organizations/anyorg/artifactbundle/assemble/",
+                            json.dumps({"checksum": checksum, "chunks": [checksum], "projects": [self.project.slug]}),
+                            content_type="application/json",
+                            headers=self.token_headers,
+                        )
+                self.assertEqual(200, response.status_code)
+
+                # bundle, entry, sourcemap and index; all written before the transaction that creates the rows
+                self.assertEqual([False, False, False, False], in_atomic_block_on_write)
+
+                self.assertEqual(minified_data, FileMetadata.objects.get(
+                    project=self.project, debug_id=minified_debug_id).file.get_raw_data())
+                index_metadata = FileMetadata.objects.get(
+                    project=self.project, debug_id=sourcemap_debug_id, file_type="sourcemap_index")
+                self.assertEqual("a", open_sourcemap_index(index_metadata.file).lookup_left(0, 0).name)
+
+        self.assertIn(other_debug_id, "\n".join(cm.output))  # the in-code debug id mismatch
+        self.assertFalse(Chunk.objects.exists())
+        self.assertTrue(File.objects.filter(checksum=checksum).exists())  # KEEP_ARTIFACT_BUNDLES
+
     def test_artifact_bundle_assemble_does_not_use_checksum_as_temp_filename(self):
         data = b"hello world"
         real_checksum = sha1(data, usedforsecurity=False).hexdigest()
@@ -370,12 +460,12 @@ class FilesTests(TransactionTestCase):
                     storage_backend="local",
                 )
 
-                with patch("files.models._cleanup_objects_on_storage") as cleanup:
+                with patch("bsmain.tasks.delete_from_storage", return_value=True) as cleanup:
                     with immediate_atomic():
                         file.delete()
                         cleanup.assert_not_called()
 
-                    cleanup.assert_called_once_with([("file", checksum, "local")])
+                    cleanup.assert_called_once_with("file", checksum, "local")
 
     def test_external_file_queryset_cleanup_is_not_run_on_rollback(self):
         checksum = "a" * 40
@@ -392,7 +482,7 @@ class FilesTests(TransactionTestCase):
                     storage_backend="local",
                 )
 
-                with patch("files.models._cleanup_objects_on_storage") as cleanup:
+                with patch("bsmain.tasks.delete_from_storage", return_value=True) as cleanup:
                     with self.assertRaises(Exception):
                         with immediate_atomic():
                             File.objects.filter(checksum=checksum).delete()
@@ -676,6 +766,117 @@ class FilesTests(TransactionTestCase):
                 filename, response.content if response.status_code != 302 else response.url))
 
 
+class SourcemapCacheTestCase(RegularTestCase):
+
+    def setUp(self):
+        clear_sourcemap_cache()
+        self.addCleanup(clear_sourcemap_cache)
+
+    def _file(self, source_content):
+        sourcemap = ecma426.encode([Mapping(0, 0, "src/app.ts", 1, 2, "main")])
+        sourcemap["sourcesContent"] = [source_content]
+        data = json.dumps(sourcemap).encode("utf-8")
+
+        # a stand-in for File: checksum and get_raw_data() are all that's used
+        return SimpleNamespace(checksum=sha1(data).hexdigest(), get_raw_data=lambda: data)
+
+    def test_parsed_once(self):
+        file = self._file("line 1\nline 2")
+
+        for i in range(2):
+            sourcemap, lines_for_source = get_parsed_sourcemap(file)
+            self.assertEqual("main", sourcemap.lookup_left(0, 0).name)
+            self.assertEqual({"src/app.ts": ["line 1", "line 2"]}, lines_for_source)
+
+        stats = get_sourcemap_cache_stats()
+        self.assertEqual((1, 1, 1), (stats["hits"], stats["misses"], stats["entries"]))
+        self.assertTrue(stats["bytes"] > 0)
+
+    def test_byte_budget(self):
+        big, small = self._file("x" * 1000), self._file("y")
+
+        with bugsink_override_settings(SOURCEMAP_CACHE_MAX_BYTES=1000):
+            get_parsed_sourcemap(big)  # larger than the whole budget: not cached
+            get_parsed_sourcemap(small)
+            get_parsed_sourcemap(small)
+
+            stats = get_sourcemap_cache_stats()
+            self.assertEqual((1, 2, 1), (stats["hits"], stats["misses"], stats["entries"]))
+            self.assertTrue(stats["bytes"] <= 1000)
+
+
+class SourcemapIndexTestCase(TransactionTestCase):
+
+    def _sourcemap_data(self):
+        tokens = [
+            Mapping(line, column * 10, f"src/{line % 3}.ts", line * 2, column, f"fn{column}" if column % 2 else None)
+            for line in range(20) for column in range(1, 8)]
+        tokens.append(Mapping(3, 0))  # unmapped
+
+        sourcemap = ecma426.encode(tokens)
+        sourcemap["sourcesContent"] = ["\n".join(f"{source} line {i}" for i in range(50)) for source in
+                                       sourcemap["sources"][:2]] + [None]
+        return json.dumps(sourcemap).encode("utf-8")
+
+    def _as_tuple(self, lookup, line, column):
+        try:
+            m = lookup(line, column)
+        except (IndexError, KeyError):
+            return "not found"
+        return (m.generated_line, m.generated_column, m.source, m.original_line, m.original_column, m.name)
+
+    def test_same_lookups_as_ecma426(self):
+        data = self._sourcemap_data()
+        sourcemap, lines_for_source = parse_sourcemap(data)
+        index = SourcemapIndex(build_sourcemap_index(data))
+
+        for line in range(22):
+            for column in range(80):
+                self.assertEqual(self._as_tuple(sourcemap.lookup_left, line, column),
+                                 self._as_tuple(index.lookup_left, line, column))
+
+        self.assertEqual(dict(lines_for_source), dict(index.lines_for_source))
+        self.assertNotIn("src/2.ts", index.lines_for_source)  # no content for that one
+
+    def test_lines_are_split_once_per_source(self):
+        index = SourcemapIndex(build_sourcemap_index(self._sourcemap_data()))
+
+        with patch.object(index, "_content_at", wraps=index._content_at) as content_at:
+            for i in range(3):
+                self.assertEqual("src/0.ts line 4", index.lines_for_source["src/0.ts"][4])
+
+        self.assertEqual(1, content_at.call_count)
+
+    def test_process_bundle_entry_with_broken_sourcemap(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            bundle_path = os.path.join(tempdir, "bundle.zip")
+            for i, data in enumerate([b"[1]", b"null", b"not json"]):
+                with ZipFile(bundle_path, "w") as bundle_zip:
+                    bundle_zip.writestr("app.js.map", data)
+
+                entry = process_bundle_entry(
+                    bundle_path, "app.js.map", "source_map", os.path.join(tempdir, f"entry-{i}"),
+                    os.path.join(tempdir, f"index-{i}"), 1024)
+
+                # not fatal: the entry itself is processed, only without an index
+                self.assertEqual(len(data), entry.size)
+                self.assertEqual(None, entry.index_checksum)
+                self.assertNotEqual(None, entry.index_error)
+
+    def test_memory_mapped_from_filesystem_storage(self):
+        index_data = build_sourcemap_index(self._sourcemap_data())
+        checksum = sha1(index_data).hexdigest()
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            with override_object_storages(get_test_object_storages(tempdir, use_for_write=True)):
+                Chunk.objects.create(checksum=checksum, size=len(index_data), data=index_data)
+                file, _ = assemble_file(checksum, [checksum], filename="app.js.map.index")
+
+                index = open_sourcemap_index(File.objects.defer("data").get(pk=file.pk))
+                self.assertIsInstance(index.buffer, mmap.mmap)
+                self.assertEqual("fn3", index.lookup_left(4, 35).name)
+
+
 class EnterContextMixin:
     # https://docs.python.org/3.11/library/unittest.html#unittest.TestCase.enterContext but we support 3.10 too
     def enterContext(self, cm):
@@ -17,7 +17,8 @@ from bugsink.streams import handle_request_content_encoding, copy_stream_limited
 from bsmain.models import AuthToken
 from projects.models import Project
 
-from .models import Chunk, File, FileMetadata
+from .models import Chunk, File, FileMetadata, write_to_storage
+from .storage_registry import get_write_storage
 from .tasks import assemble_artifact_bundle, assemble_file
 from .minidump import extract_dif_metadata
 
@@ -157,6 +158,27 @@ def get_artifact_bundle_projects(data):
     return [projects_by_slug[slug] for slug in dict.fromkeys(project_slugs)], None
 
 
+def store_chunk(checksum, data):
+    if Chunk.objects.filter(checksum=checksum).exists():
+        return  # NOTE: further possible optimization: don't even read the file when already existing
+
+    # the data is written to the chunk storage (see CHUNK_STORE_BASE_DIR) before taking the write lock; storage keys are
+    # content-addressed, i.e. a concurrent upload of the same chunk writes the same thing.
+    write_storage = get_write_storage("chunk")
+    if write_storage is not None:
+        write_to_storage("chunk", checksum, data)
+
+    # a snug fit around the only DB-writing thing we do here to ensure minimal blocking
+    with immediate_atomic():
+        _, _ = Chunk.objects.get_or_create(
+            checksum=checksum,
+            defaults={
+                "size": len(data),
+                "data": b"" if write_storage is not None else data,
+                "storage_backend": None if write_storage is None else write_storage.name,
+            })
+
+
 @csrf_exempt
 @requires_auth_token
 def chunk_upload(request, organization_slug):
@@ -185,15 +207,7 @@ def chunk_upload(request, organization_slug):
             if sha1(data, usedforsecurity=False).hexdigest() != chunk.name:
                 raise Exception("checksum mismatch")
 
-            # a snug fit around the only DB-writing thing we do here to ensure minimal blocking
-            with immediate_atomic():
-                _, _ = Chunk.objects.get_or_create(
-                    checksum=chunk.name,
-                    defaults={
-                        "size": len(data),
-                        # NOTE: further possible optimization: don't even read the file when already existing
-                        "data": data,
-                    })
+            store_chunk(chunk.name, data)
 
         for chunk in request.FILES.getlist("file_gzip"):
             output_stream = BytesIO()
@@ -209,15 +223,7 @@ def chunk_upload(request, organization_slug):
             if sha1(data, usedforsecurity=False).hexdigest() != chunk.name:
                 raise Exception("checksum mismatch")
 
-            # a snug fit around the only DB-writing thing we do here to ensure minimal blocking
-            with immediate_atomic():
-                _, _ = Chunk.objects.get_or_create(
-                    checksum=chunk.name,
-                    defaults={
-                        "size": len(data),
-                        # NOTE: further possible optimization: don't even read the file when already existing
-                        "data": data,
-                    })
+            store_chunk(chunk.name, data)
     except MaxLengthExceeded as e:
         return JsonResponse({"error": str(e)}, status=413)
 
@@ -1,22 +1,441 @@
+import contextlib
+import io
+import logging
+import os
+import struct
+import threading
+import time
 import uuid
 
 from django.utils._os import safe_join
+
+from bugsink import json
 from bugsink.app_settings import get_settings
+from bsmain.utils import b108_makedirs
 
+logger = logging.getLogger("bugsink.ingest")
+
+
+# The "spool" is where ingested-but-not-yet-digested data lives (in INGEST_STORE_BASE_DIR), in the time between the
+# ingest view writing it and the digest task reading (and removing) it. Per ingested event there are up to 3 entries,
+# identified by the ingestion_id and a filetype: the "event" (json), the "minidump" (optional) and the "meta" (the
+# event_metadata, i.e. the args of the digest Task; written right before that Task is created; see below).
+#
+# There are 2 layouts, chosen by INGEST_STORE_SEGMENT_SIZE:
+#
+# * 0 (the default): a file per entry, in a subdirectory named after the first 2 (hex) chars of the ingestion_id, i.e.
+#   256 subdirectories. This keeps directories small even with a large backlog.
+#
+# * >0: entries are appended to "segment" files (in a "segments" subdirectory) of up to this many bytes; each process
+#   appends to its own segment. An entry is addressed by its location [segment, offset, length], which is stored in
+#   event_metadata["spool"]. A segment is removed when all of its entries have been removed (see remove_spooled).
+#
+# In neither layout do we fsync: the spool is a hand-off between 2 processes on the same machine; the OS's page cache is
+# shared between them, and a crash of either of them does not lose written data. (An OS crash may, but the same is true
+# for the in-flight HTTP requests at that moment).
+#
+# Recovery: a Task is deleted from the DB-as-MQ before it is run (at-most-once), i.e. when the Foreman is killed while
+# digesting, or when the server fails to create the Task after writing its files, entries are left behind without any
+# Task referencing them. recover_spool() (run by the Foreman on startup) re-creates the Tasks for such "accepted" (i.e.
+# with a "meta" entry) events. Re-digesting an event that was in fact already digested is harmless (the duplicate
+# event_id is refused on digest). Segments of writers that are idle (rather than gone) are sealed and removed by
+# reap_idle_segments(), which vacuum_ingest_dir calls.
+
+SEGMENTS_DIR = "segments"
+SEGMENT_MAX_AGE = 60  # seconds; a segment is sealed (which allows its removal) when it's this old (on the next write)
+
+_HEADER_LENGTH = struct.Struct(">I")
+_DONE_OFFSET = struct.Struct(">Q")
 
-def get_filename_for_event_id(event_id, filetype="event"):
-    # The idea of having some levels of directories here (to avoid too many files in a single dir) is not yet
-    # implemented. However, counterpoint: when doing stress tests, it was quite hard to get a serious backlog going
-    # (snappea was very well able to play catch-up). So this might not be necessary.
 
+def _normalized(event_id):
     # ensure that event_id is a uuid, and remove dashes if present; also doubles as a security-check (event_id is
     # user-provided (but at this point already validated to be a valid UUID), but b/c of the below the
     # security-implications of path-joining (even though we use safe_join) can be understood right here in the code
     # without needing to inspect all call-sites)
-    event_id_normalized = uuid.UUID(event_id).hex
+    return uuid.UUID(event_id).hex
 
-    basename = event_id_normalized
+
+def _basename(event_id_normalized, filetype):
     if filetype == "minidump":
-        basename += ".dmp"
+        return event_id_normalized + ".dmp"
+    if filetype == "meta":
+        return event_id_normalized + ".meta"
+    return event_id_normalized
+
+
+def get_filename_for_event_id(event_id, filetype="event"):
+    event_id_normalized = _normalized(event_id)
+    return safe_join(
+        get_settings().INGEST_STORE_BASE_DIR, event_id_normalized[:2], _basename(event_id_normalized, filetype))
+
+
+def get_legacy_filename_for_event_id(event_id, filetype="event"):
+    # the un-sharded (flat) layout of Bugsink versions before the sharded one; only read from, for files that are in
+    # transit across an upgrade.
+    event_id_normalized = _normalized(event_id)
+    return safe_join(get_settings().INGEST_STORE_BASE_DIR, _basename(event_id_normalized, filetype))
+
+
+def is_segmented():
+    return get_settings().INGEST_STORE_SEGMENT_SIZE > 0
+
+
+def _segment_filename(segment, suffix=""):
+    # segment names are generated by us (uuid-hex), but they pass through the Task args, so we check anyway.
+    return safe_join(get_settings().INGEST_STORE_BASE_DIR, SEGMENTS_DIR, uuid.UUID(segment).hex + ".seg" + suffix)
+
+
+class SegmentWriter:
+    """Appends entries to the current segment of this process; thread-safe."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.fd = None
+
+    def append(self, ingestion_id, filetype, data):
+        # An entry is a header (its length as 4 bytes, and the json-encoded header itself) followed by the data; the
+        # headers are only used by recover_spool.
+        header = json.dumpb({"ingestion_id": ingestion_id, "filetype": filetype, "length": len(data)})
+
+        with self.lock:
+            if self.fd is None or self.pid != os.getpid():
+                # (also after a fork: the child must not append to the parent's segment)
+                self._open()
+            elif self.size >= get_settings().INGEST_STORE_SEGMENT_SIZE or time.time() - self.t0 > SEGMENT_MAX_AGE:
+                self._seal()
+                self._open()
+
+            offset = self.size + _HEADER_LENGTH.size + len(header)
+            self._write(_HEADER_LENGTH.pack(len(header)) + header + data)
+            self.count += 1
+
+            return [self.segment, offset, len(data)]
+
+    def _write(self, data):
+        view = memoryview(data)
+        while view:
+            written = os.write(self.fd, view)
+            view = view[written:]
+            self.size += written
+
+    def _open(self):
+        self.segment = uuid.uuid4().hex
+        filename = _segment_filename(self.segment)
+        b108_makedirs(os.path.dirname(filename))
+        self.fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_APPEND, 0o600)
+        self.pid = os.getpid()
+        self.t0 = time.time()
+        self.size = 0
+        self.count = 0
+
+    def _seal(self):
+        # From here on, no more entries are added, i.e. the segment can be removed when `count` entries are removed.
+        os.close(self.fd)
+        with open(_segment_filename(self.segment, ".sealed"), "w") as f:
+            f.write(str(self.count))
+        _remove_segment_if_done(self.segment)
+
+
+_segment_writer = SegmentWriter()
+
+
+def _read_done_offsets(segment):
+    try:
+        with open(_segment_filename(segment, ".done"), "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return set()
+    return {_DONE_OFFSET.unpack_from(data, i)[0] for i in range(0, len(data) - len(data) % 8, 8)}
+
+
+def _remove_segment_if_done(segment):
+    try:
+        with open(_segment_filename(segment, ".sealed")) as f:
+            count = int(f.read())
+    except (FileNotFoundError, ValueError):
+        return  # not sealed (yet), or sealing not complete
+
+    try:
+        if os.path.getsize(_segment_filename(segment, ".done")) < count * _DONE_OFFSET.size:
+            return  # cheap check first: fewer removals than entries
+    except FileNotFoundError:
+        if count > 0:
+            return
+
+    # entries may be removed more than once (e.g. by recovery of a partially cleaned up event), so we count distinct
+    if len(_read_done_offsets(segment)) < count:
+        return
+
+    for suffix in ["", ".done", ".sealed"]:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(_segment_filename(segment, suffix))
+
+
+class _SegmentEntryWriter(io.BytesIO):
+    # streaming-write counterpart of write_spooled: buffers in memory, and appends on close(). Entries are bounded by
+    # the MaxDataWriter around this; buffering means we don't hold the segment's lock while reading from the network.
+
+    def __init__(self, ingestion_id, filetype):
+        super().__init__()
+        self.ingestion_id = ingestion_id
+        self.filetype = filetype
+        self.spool_location = None
+
+    def close(self):
+        if not self.closed:
+            self.spool_location = _segment_writer.append(self.ingestion_id, self.filetype, self.getvalue())
+        super().close()
+
+
+def open_spooled_for_writing(ingestion_id, filetype="event"):
+    """
+    Returns a (binary) file-like to write the given entry to. In the segment layout, the entry's location is available
+    as `.spool_location` after close(); in the file-per-entry layout there's no such attribute (the location is
+    implied by the ingestion_id).
+    """
+    if is_segmented():
+        return _SegmentEntryWriter(ingestion_id, filetype)
+
+    filename = get_filename_for_event_id(ingestion_id, filetype)
+    b108_makedirs(os.path.dirname(filename))
+    return open(filename, "wb")
+
+
+def write_spooled(ingestion_id, data, filetype="event"):
+    """Writes data (bytes) to the spool; returns the location (None for the file-per-entry layout)."""
+    if is_segmented():
+        return _segment_writer.append(ingestion_id, filetype, data)
+
+    filename = get_filename_for_event_id(ingestion_id, filetype)
+    b108_makedirs(os.path.dirname(filename))
+    with open(filename, "wb") as f:
+        f.write(data)
+    return None
+
+
+def get_spool_location(event_metadata, filetype):
+    return event_metadata.get("spool", {}).get(filetype)
+
+
+def set_spool_locations(event_metadata, locations):
+    # locations: {filetype: location}; locations of the file-per-entry layout (None) are implied, i.e. not stored.
+    for filetype, location in locations.items():
+        if location is not None:
+            event_metadata.setdefault("spool", {})[filetype] = location
+
+
+def read_spooled(ingestion_id, location, filetype="event"):
+    if location is not None:
+        segment, offset, length = location
+        fd = os.open(_segment_filename(segment), os.O_RDONLY)
+        try:
+            return os.pread(fd, length, offset)
+        finally:
+            os.close(fd)
+
+    try:
+        with open(get_filename_for_event_id(ingestion_id, filetype), "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        legacy_filename = get_legacy_filename_for_event_id(ingestion_id, filetype)
+        if not os.path.exists(legacy_filename):
+            raise
+        with open(legacy_filename, "rb") as f:
+            return f.read()
+
+
+def remove_spooled(ingestion_id, location, filetype="event"):
+    """Removes the given entry; raises FileNotFoundError for an entry that does not exist (file-per-entry only)."""
+    if location is not None:
+        segment, offset, length = location
+        fd = os.open(_segment_filename(segment, ".done"), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        try:
+            os.write(fd, _DONE_OFFSET.pack(offset))  # 8 bytes, O_APPEND: no interleaving with other processes
+        finally:
+            os.close(fd)
+        _remove_segment_if_done(segment)
+        return
+
+    try:
+        os.unlink(get_filename_for_event_id(ingestion_id, filetype))
+    except FileNotFoundError:
+        legacy_filename = get_legacy_filename_for_event_id(ingestion_id, filetype)
+        if not os.path.exists(legacy_filename):
+            raise
+        os.unlink(legacy_filename)
+
+
+def accept_spooled(event_metadata):
+    """
+    Writes the "meta" entry for the event; to be called right before the digest Task is created. The meta entry's own
+    location is added to event_metadata afterwards (i.e. it's in the Task's args, but not in the entry itself).
+    """
+    location = write_spooled(
+        event_metadata["ingestion_id"], json.dumpb(event_metadata), filetype="meta")
+    set_spool_locations(event_metadata, {"meta": location})
+
+
+def _iter_segment_entries(segment):
+    # yields (header, location) for all (completely written) entries in the segment.
+    with open(_segment_filename(segment), "rb") as f:
+        data = f.read()
+
+    position = 0
+    while position + _HEADER_LENGTH.size <= len(data):
+        header_length, = _HEADER_LENGTH.unpack_from(data, position)
+        header_end = position + _HEADER_LENGTH.size + header_length
+        try:
+            header = json.loads(data[position + _HEADER_LENGTH.size:header_end])
+        except ValueError:
+            return  # partially written (crash mid-append)
+        if header_end + header["length"] > len(data):
+            return  # idem
+        yield header, [segment, header_end, header["length"]]
+        position = header_end + header["length"]
+
+
+def _seal_on_behalf(segment):
+    # for segments that their writer will not seal: it's gone, or idle (a writer only seals on its next write). Only for
+    # segments that haven't been written to for SEGMENT_MAX_AGE, i.e. that their writer will not append to anymore.
+    count = sum(1 for _ in _iter_segment_entries(segment))
+    with open(_segment_filename(segment, ".sealed"), "w") as f:
+        f.write(str(count))
+    _remove_segment_if_done(segment)
+
+
+def reap_idle_segments(min_age=SEGMENT_MAX_AGE):
+    """
+    Seals the segments that have not been written to for min_age (seconds), and removes those of which all entries are
+    done. Without this, the segment of a writer that goes idle would only be removed when recover_spool runs. Returns
+    the number of removed segments.
+    """
+    min_age = max(min_age, SEGMENT_MAX_AGE)
+
+    segments_dir = safe_join(get_settings().INGEST_STORE_BASE_DIR, SEGMENTS_DIR)
+    if not os.path.isdir(segments_dir):
+        return 0
+
+    removed = 0
+    for basename in os.listdir(segments_dir):
+        if _is_recent(safe_join(segments_dir, basename), min_age):
+            continue
+
+        if basename.endswith(".seg"):
+            segment = basename[:-len(".seg")]
+            if os.path.exists(_segment_filename(segment, ".sealed")):
+                _remove_segment_if_done(segment)
+            else:
+                _seal_on_behalf(segment)
+            removed += not os.path.exists(_segment_filename(segment))
+
+        elif basename.endswith((".seg.done", ".seg.sealed")):
+            segment = basename.split(".")[0]
+            if not os.path.exists(_segment_filename(segment)):
+                # left behind: e.g. an idle writer sealing (on its next write) a segment that was reaped already
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(safe_join(segments_dir, basename))
+
+    return removed
+
+
+def _get_queued_ingestion_ids():
+    # normalized (i.e. as in the spool's filenames); in the Tasks' args they are as generated, i.e. str(uuid4()).
+    from snappea.models import Task
+
+    result = set()
+    for args in Task.objects.filter(task_name="ingest.tasks.digest").values_list("args", flat=True):
+        event_id, event_metadata = json.loads(args)
+        result.add(_normalized(event_metadata.get("ingestion_id", event_id)))
+    return result
+
+
+def _is_recent(filename, min_age):
+    try:
+        return os.path.getmtime(filename) > time.time() - min_age
+    except FileNotFoundError:
+        return True  # removed in the meantime: certainly not ours to deal with
+
+
+def recover_spool(min_age=60):
+    """
+    Re-creates digest Tasks for accepted events that are in the spool but not in the DB-as-MQ, and removes what's left
+    of events that were digested but not fully cleaned up. Entries of events that were never accepted are removed in
+    the segment layout (where they'd keep their segment around); in the file-per-entry layout they're left for
+    vacuum_ingest_dir. Only entries older than min_age (seconds) are considered, to leave the server the time to create
+    the Tasks for what it is currently writing. Returns the number of re-created Tasks.
+    """
+    from .tasks import digest
+
+    # segments are sealed by their writer on the first write after SEGMENT_MAX_AGE; i.e. a segment that hasn't been
+    # written to for this long will not be written to anymore (its writer may be gone, in which case we seal it below).
+    min_age = max(min_age, SEGMENT_MAX_AGE)
+
+    base_dir = get_settings().INGEST_STORE_BASE_DIR
+    if not os.path.isdir(base_dir):
+        return 0
+
+    queued = _get_queued_ingestion_ids()
+    to_enqueue = []
+
+    # file-per-entry layout: only the shards (the flat layout predates the "meta" entries, i.e. is not recoverable)
+    for shard in os.listdir(base_dir):
+        shard_dir = safe_join(base_dir, shard)
+        if len(shard) != 2 or not os.path.isdir(shard_dir):
+            continue
+
+        for basename in os.listdir(shard_dir):
+            if not basename.endswith(".meta") or _is_recent(safe_join(shard_dir, basename), min_age):
+                continue
+
+            ingestion_id = basename[:-len(".meta")]
+            if _normalized(ingestion_id) in queued:
+                continue
+
+            with open(safe_join(shard_dir, basename), "rb") as f:
+                event_metadata = json.loads(f.read())
+
+            if not os.path.exists(safe_join(shard_dir, ingestion_id)):
+                # digested, but not fully cleaned up
+                os.unlink(safe_join(shard_dir, basename))
+                continue
+
+            to_enqueue.append(event_metadata)
+
+    # segment layout
+    segments_dir = safe_join(base_dir, SEGMENTS_DIR)
+    for basename in (os.listdir(segments_dir) if os.path.isdir(segments_dir) else []):
+        if not basename.endswith(".seg") or _is_recent(safe_join(segments_dir, basename), min_age):
+            continue
+
+        segment = basename[:-len(".seg")]
+        done = _read_done_offsets(segment)
+
+        entries_by_ingestion_id = {}
+        for header, location in _iter_segment_entries(segment):
+            if location[1] not in done:
+                entries_by_ingestion_id.setdefault(header["ingestion_id"], {})[header["filetype"]] = location
+
+        for ingestion_id, entries in entries_by_ingestion_id.items():
+            if _normalized(ingestion_id) in queued:
+                continue
+
+            if "meta" in entries and "event" in entries:
+                event_metadata = json.loads(read_spooled(ingestion_id, entries["meta"], "meta"))
+                set_spool_locations(event_metadata, {"meta": entries["meta"]})
+                to_enqueue.append(event_metadata)
+            else:
+                # never accepted, or digested but not fully cleaned up
+                for filetype, location in entries.items():
+                    remove_spooled(ingestion_id, location, filetype)
+
+        if not os.path.exists(_segment_filename(segment, ".sealed")):
+            # the process that wrote it is gone (if it wasn't, min_age would have made us skip it); which means we
+            # must seal it on its behalf for it to ever be removed.
+            _seal_on_behalf(segment)
+
+    if to_enqueue:
+        logger.warning("Re-creating %s digest Tasks for orphaned entries in the ingest spool", len(to_enqueue))
+        digest.delay_many([(event_metadata["event_id"], event_metadata) for event_metadata in to_enqueue])
 
-    return safe_join(get_settings().INGEST_STORE_BASE_DIR, basename)
+    return len(to_enqueue)
@@ -7,13 +7,38 @@ from django.core.management.base import BaseCommand, CommandError
 from django.utils._os import safe_join
 
 from bugsink.app_settings import get_settings
+from ingest.filestore import reap_idle_segments
 
 
 logger = logging.getLogger("bugsink.ingest")
 
 # Pattern for temporary ingest files, as generated by `get_filename_for_event_id`.
 #
-INGEST_FILENAME_PATTERN = re.compile(r'^[0-9a-f]{32}(?:\.dmp)?$')
+INGEST_FILENAME_PATTERN = re.compile(r'^[0-9a-f]{32}(?:\.dmp|\.meta)?$')
+
+# Pattern for the subdirectories of the ingest dir (see ingest/filestore.py), with the pattern for the files in them.
+INGEST_SUBDIR_PATTERNS = [
+    (re.compile(r'^[0-9a-f]{2}$'), INGEST_FILENAME_PATTERN),
+    (re.compile(r'^segments$'), re.compile(r'^[0-9a-f]{32}\.seg(?:\.done|\.sealed)?$')),
+]
+
+
+def _iter_ingest_files(ingest_dir):
+    # yields (name, path, pattern) for the files in the ingest dir (the flat layout of older Bugsink versions) and its
+    # known subdirectories; other subdirectories are skipped (as they have always been).
+    for filename in os.listdir(ingest_dir):
+        filepath = safe_join(ingest_dir, filename)
+
+        if not os.path.isdir(filepath):
+            yield filename, filepath, INGEST_FILENAME_PATTERN
+            continue
+
+        for subdir_pattern, pattern in INGEST_SUBDIR_PATTERNS:
+            if subdir_pattern.match(filename):
+                for sub_filename in os.listdir(filepath):
+                    sub_filepath = safe_join(filepath, sub_filename)
+                    if not os.path.isdir(sub_filepath):
+                        yield os.path.join(filename, sub_filename), sub_filepath, pattern
 
 
 class Command(BaseCommand):
@@ -51,21 +76,19 @@ def vacuum_ingest_dir_sync(*, stdout, stderr, days=7, dry_run=False):
     # Calculate cutoff time (files older than this will be removed)
     cutoff_time = time.time() - (days * 24 * 60 * 60)
 
+    # segments are sealed (which allows for their removal) by their writer on its next write; for idle writers that
+    # may take arbitrarily long, which is why we do it here.
+    segments_reaped = 0 if dry_run else reap_idle_segments()
+
     files_processed = 0
     files_removed = 0
     unexpected_files = []
 
-    for filename in os.listdir(ingest_dir):
-        filepath = safe_join(ingest_dir, filename)
-
-        # Skip directories
-        if os.path.isdir(filepath):
-            continue
-
+    for filename, filepath, pattern in _iter_ingest_files(ingest_dir):
         files_processed += 1
 
         # Check if filename matches the expected ingest file format.
-        if not INGEST_FILENAME_PATTERN.match(filename):
+        if not pattern.match(os.path.basename(filename)):
             unexpected_files.append(filename)
             continue
 
@@ -91,6 +114,7 @@ def vacuum_ingest_dir_sync(*, stdout, stderr, days=7, dry_run=False):
     else:
         stdout.write("\nTemporary ingest directory checked:")
 
+    stdout.write("  Idle segments removed: {}".format(segments_reaped))
     stdout.write("  Temporary ingest files checked: {}".format(files_processed))
     stdout.write(
         "  Stale temporary ingest files {}: {}".format('would be removed' if dry_run else 'removed', files_removed))
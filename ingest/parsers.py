@@ -1,6 +1,6 @@
-import json
 import io
 
+from bugsink import json
 from bugsink.streams import MaxDataWriter, UnclosableBytesIO
 
 from .exceptions import ParseError
@@ -1,46 +1,166 @@
-import os
+import contextlib
 import logging
-import json
 
 from django.core.exceptions import ValidationError
 
-from snappea.decorators import shared_task
+from bugsink import json
+from snappea.decorators import shared_task, batch_handler
+from snappea.processes import run_cpu_bound, run_cpu_bound_many
 
-from .filestore import get_filename_for_event_id
+from .filestore import get_spool_location, read_spooled, remove_spooled
 
 logger = logging.getLogger("bugsink.ingest")
 
 
-@shared_task
-def digest(event_id, event_metadata):
-    from .views import BaseIngestAPIView
+def _read_ingested(event_id, event_metadata):
+    # returns raw_data (the event's JSON, as str), minidump_bytes (if any) and the list of spool entries that were read
+    # (for cleanup)
     if "ingestion_id" in event_metadata:
         ingestion_id = event_metadata["ingestion_id"]  # the normal case
     else:
         ingestion_id = event_id  # for bugsink<=2.0.11 events in-transit in snappea queue cross version upgrade
 
-    with open(get_filename_for_event_id(ingestion_id), "rb") as f:
-        event_data = json.loads(f.read().decode("utf-8"))
-        opened = [get_filename_for_event_id(ingestion_id)]
+    location = get_spool_location(event_metadata, "event")
+    raw_data = read_spooled(ingestion_id, location).decode("utf-8")
+    opened = [(ingestion_id, location, "event")]
 
     if event_metadata.get("has_minidump"):
-        with open(get_filename_for_event_id(ingestion_id, filetype="minidump"), "rb") as f:
-            minidump_bytes = f.read()
-            opened += [get_filename_for_event_id(ingestion_id, filetype="minidump")]
+        location = get_spool_location(event_metadata, "minidump")
+        minidump_bytes = read_spooled(ingestion_id, location, filetype="minidump")
+        opened += [(ingestion_id, location, "minidump")]
     else:
         minidump_bytes = None
 
+    # the "meta" entry is not read (its content is event_metadata), but it's removed (last: see recover_spool)
+    opened += [(ingestion_id, get_spool_location(event_metadata, "meta"), "meta")]
+
+    return raw_data, minidump_bytes, opened
+
+
+def _read_and_prepare(event_id, event_metadata, preparation):
+    # Reads the ingested event and, if preparation (the args of prepare_event_data other than event_data; see
+    # get_pool_preparation) is given, parses and prepares it. This is the CPU-bound part of digest, i.e. it's done in
+    # snappea's process pool (if configured), in a single call such that what crosses the process boundary is cheap to
+    # pickle: the raw JSON (a str) and the (small) PreparedEvent. The parsed event_data does not cross it: pickling and
+    # unpickling it costs (the GIL-holding parent) about as much as parsing the JSON, which is what the parent does.
+    #
+    # Failing preparation is left to the caller, which redoes it outside of the pool (with its own error handling).
+    from .views import prepare_event_data
+
+    raw_data, minidump_bytes, opened = _read_ingested(event_id, event_metadata)
+
+    prepared = None
+    if preparation is not None:
+        with contextlib.suppress(Exception):
+            prepared = prepare_event_data(json.loads(raw_data), *preparation)
+
+    return raw_data, minidump_bytes, opened, prepared
+
+
+def _try_read_and_prepare(event_id, event_metadata, preparation):
+    # version of _read_and_prepare for batches: returns (result, exception) such that a single failing read does not
+    # stop the rest of the batch (the exception is returned rather than raised to keep the run_cpu_bound boundary
+    # simple).
     try:
-        BaseIngestAPIView.digest_event(event_metadata, event_data, minidump_bytes=minidump_bytes)
+        return _read_and_prepare(event_id, event_metadata, preparation), None
+    except (OSError, ValueError) as e:
+        return None, e
+
+
+def _get_preparation(event_metadata):
+    # (project, preparation) for _read_and_prepare; project is None for events that digest will drop.
+    from .views import BaseIngestAPIView
+
+    project = BaseIngestAPIView.get_project_to_prepare_for(event_metadata)
+    if project is None:
+        return None, None
+    return project, BaseIngestAPIView.get_pool_preparation(project, event_metadata.get("has_minidump", False))
+
+
+def _cleanup_ingested(opened):
+    # "Robustly" remove all opened entries (don't stop on failure), but still report any errors at the end
+    errors = []
+    for ingestion_id, location, filetype in opened:
+        try:
+            remove_spooled(ingestion_id, location, filetype)
+        except FileNotFoundError as e:
+            if filetype != "meta":  # meta-less: events in-transit across the upgrade that introduced them
+                errors.append(e)
+    if errors:
+        raise Exception(errors)
+
+
+@shared_task
+def digest(event_id, event_metadata):
+    from .views import BaseIngestAPIView
+
+    project, preparation = _get_preparation(event_metadata)
+    raw_data, minidump_bytes, opened, prepared = run_cpu_bound(_read_and_prepare, event_id, event_metadata, preparation)
+
+    try:
+        event_data = json.loads(raw_data)
+        if prepared is None and project is not None:
+            prepared = BaseIngestAPIView.prepare_event_for_project(project, event_data, minidump_bytes)
+
+        BaseIngestAPIView.digest_event(
+            event_metadata, event_data, minidump_bytes=minidump_bytes if prepared is None else None, prepared=prepared,
+            raw_data=raw_data if minidump_bytes is None else None)  # minidumps are merged into event_data
     except ValidationError as e:
         logger.warning("ValidationError in digest_event", exc_info=e)
     finally:
-        # "Robustly" remove all opened files (don't stop on failure), but still report any errors at the end
-        errors = []
-        for filename in opened:
+        _cleanup_ingested(opened)
+
+
+@batch_handler(digest)
+def digest_batch(args_list):
+    # Digests a run of `digest` tasks in a single transaction (see BaseIngestAPIView.digest_events); args_list contains
+    # the (event_id, event_metadata) args of the individual tasks.
+    from .views import BaseIngestAPIView
+
+    items = []
+    opened = []
+    try:
+        projects_and_preparations = [_get_preparation(event_metadata) for _, event_metadata in args_list]
+
+        # reading/parsing/preparing is CPU-bound for large events: done in parallel in snappea's process pool (if
+        # configured)
+        results = run_cpu_bound_many(_try_read_and_prepare, [
+            (event_id, event_metadata, preparation)
+            for (event_id, event_metadata), (_, preparation) in zip(args_list, projects_and_preparations)])
+
+        for (event_id, event_metadata), (project, _), (result, e) in zip(args_list, projects_and_preparations, results):
+            if e is None:
+                raw_data, minidump_bytes, opened_for_event, prepared = result
+                try:
+                    event_data = json.loads(raw_data)
+                except ValueError as parse_error:
+                    e = parse_error
+
+            if e is not None:
+                # a single unreadable event should not stop the rest of the batch (in the non-batched case, this is
+                # the error that the Foreman would log); as in that case, the file is left for vacuum_ingest_dir.
+                logger.error("Could not read ingested event %s: %s", event_id, e)
+                continue
+
+            opened += opened_for_event
+
+            # preparation (outside of the transaction) is per-event; as in digest_events, a single failing event does
+            # not stop the batch: the Tasks of the batch are gone already, and so (in the `finally` below) are the
+            # spool entries, i.e. an exception escaping from here would lose all of the batch's events.
             try:
-                os.unlink(filename)
-            except FileNotFoundError as e:
-                errors.append(e)
-        if errors:
-            raise Exception(errors)
+                if prepared is None and project is not None:
+                    prepared = BaseIngestAPIView.prepare_event_for_project(project, event_data, minidump_bytes)
+            except ValidationError as e:
+                logger.warning("ValidationError in prepare_event", exc_info=e)
+                continue
+            except Exception as e:
+                logger.error("Could not prepare ingested event %s", event_id, exc_info=e)
+                continue
+
+            items.append((
+                event_metadata, event_data, minidump_bytes if prepared is None else None, prepared,
+                raw_data if minidump_bytes is None else None))  # minidumps are merged into event_data
+
+        BaseIngestAPIView.digest_events(items)
+    finally:
+        _cleanup_ingested(opened)
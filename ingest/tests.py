@@ -7,23 +7,31 @@ import time
 import tempfile
 
 import datetime
+from hashlib import sha1
 from unittest.mock import patch
 from unittest import TestCase as RegularTestCase
 from dateutil.relativedelta import relativedelta
+import ecma426
+from ecma426.model import Mapping
 
 from django.test import tag
 from django.utils import timezone
 from django.test.client import RequestFactory
 from django.core.exceptions import ValidationError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
 from bugsink.test_utils import TransactionTestCase25251 as TransactionTestCase
 from bugsink.transaction import immediate_atomic
 from projects.models import Project
 from events.factories import create_event_data, create_event
-from events.retention import evict_for_max_events
+from events.retention import evict_for_max_events, get_eviction_counts, get_eviction_counts_from_events
 from events.storage_registry import override_event_storages
+from events.tasks import evict_to_low_watermark
 from events.models import InstallationEventCountsPerHour, IssueEventCountsPerHour, ProjectEventCountsPerHour, Event
 from events.usage import hour_bucket
+from events.markdown_stacktrace import render_stacktrace_md
+from files.models import File, FileMetadata
 from issues.factories import get_or_create_issue
 from issues.grouping_mechanisms import (
     GROUPING_TRANSITION_PERIOD,
@@ -34,6 +42,7 @@ from issues.grouping_mechanisms import (
     GroupingMechanism,
     MECHANISM_INDEPENDENT_GROUPING,
 )
+from tags.models import EventTag
 from issues.models import IssueStateManager, Issue, TurningPoint, TurningPointKind, Grouping
 from issues.utils import get_values
 from bugsink.app_settings import override_settings
@@ -42,10 +51,17 @@ from compat.timestamp import format_timestamp
 from compat.dsn import get_header_value
 from bsmain.management.commands.send_json import Command as SendJsonCommand
 from phonehome.models import Installation
+from snappea.models import Task
 
-from .views import BaseIngestAPIView, IngestSecurityAPIView, MinidumpAPIView, get_grouping_key_hash
+from .views import (
+    BaseIngestAPIView, IngestSecurityAPIView, MinidumpAPIView, PreparedEvent, get_existing_grouping,
+    get_grouping_key_hash, installation_digest_counter, prepare_event_data as real_prepare_event_data)
 from .parsers import readuntil, NewlineFinder, ParseError, LengthFinder, StreamingEnvelopeParser
 from .event_counter import check_for_thresholds
+from .tasks import _get_preparation, _read_and_prepare, digest_batch
+from .filestore import (
+    SegmentWriter, write_spooled, read_spooled, remove_spooled, set_spool_locations, accept_spooled, recover_spool,
+    reap_idle_segments)
 from .header_validators import (
     validate_envelope_headers, validate_item_headers, filter_valid_item_headers, filter_valid_envelope_headers)
 
@@ -74,6 +90,11 @@ def _readlines(filename):
         return f.readlines()
 
 
+def _files_in(directory):
+    # the ingest dir has (shard) subdirectories, which are not cleaned up; the files in them are.
+    return [f for f in glob(os.path.join(directory, "**"), recursive=True) if os.path.isfile(f)]
+
+
 class IngestViewTestCase(TransactionTestCase):
     # this TestCase started out as focussed on alert-sending, but has grown beyond that. Sometimes simply by extending
     # existing tests. This is not a problem in itself, but may be slightly confusing if you don't realize that.
@@ -335,6 +356,64 @@ class IngestViewTestCase(TransactionTestCase):
             # second time
             BaseIngestAPIView().digest_event(**_digest_params(event_data, project, request))
 
+    def test_digest_events_batch(self):
+        request = self.request_factory.post("/api/1/store/")
+        project = self.quiet_project
+
+        event_data = create_event_data()
+        items = [
+            (params["event_metadata"], params["event_data"], None, None, None) for params in [
+                _digest_params(event_data, project, request),
+                _digest_params(event_data, project, request),  # double event_id: rolled back, rest of batch proceeds
+                _digest_params(create_event_data(), project, request),
+            ]
+        ]
+
+        BaseIngestAPIView.digest_events(items)
+
+        self.assertEqual(2, Event.objects.count())
+        project.refresh_from_db()
+        self.assertEqual(2, project.digested_event_count)
+        self.assertEqual(2, project.stored_event_count)
+
+    def test_digest_event_with_prepared_event(self):
+        request = self.request_factory.post("/api/1/store/")
+        event_data = create_event_data()
+        event_data["tags"] = {"foo": "bar"}
+
+        BaseIngestAPIView().digest_event(**_digest_params(event_data, self.quiet_project, request))
+
+        # same grouping (i.e. the prepared key is the same as the one calculated in-transaction), and prepared tags
+        params = _digest_params(create_event_data(), self.quiet_project, request)
+        params["event_data"]["tags"] = {"foo": "baz"}
+        prepared = BaseIngestAPIView.prepare_event(params["event_metadata"], params["event_data"])
+        self.assertEqual({"foo": "baz"}, {k: v for k, v in prepared.tags.items() if k == "foo"})
+
+        BaseIngestAPIView().digest_event(**params, prepared=prepared)
+
+        self.assertEqual(1, Issue.objects.count())
+        self.assertEqual(2, Event.objects.count())
+        self.assertEqual(
+            {"bar", "baz"}, set(EventTag.objects.filter(value__key__key="foo").values_list("value__value", flat=True)))
+
+    def test_existing_grouping_and_issue_in_a_single_query(self):
+        request = self.request_factory.post("/api/1/store/")
+        params = _digest_params(create_event_data(), self.quiet_project, request)
+        BaseIngestAPIView().digest_event(**params)
+
+        key_with_mechanism = BaseIngestAPIView.prepare_event(
+            params["event_metadata"], params["event_data"]).get_key_with_mechanism(
+                params["event_data"], self.quiet_project.grouping_mechanism)
+
+        issue = Issue.objects.get()
+        with self.assertNumQueries(1):
+            grouping = get_existing_grouping(self.quiet_project.id, key_with_mechanism)
+            self.assertEqual(issue.id, grouping.issue.id)
+
+        # deleted issues (whose groupings have their hash cleared) are not found
+        issue.delete_deferred()
+        self.assertIsNone(get_existing_grouping(self.quiet_project.id, key_with_mechanism))
+
     def test_ingest_view_stores_events_at(self):
         request = self.request_factory.post("/api/1/store/")
 
@@ -477,7 +556,7 @@ class IngestViewTestCase(TransactionTestCase):
             self.assertFalse("prod" in ([tag.value.value for tag in event.tags.all()]))  # no sample event, so False
 
             self.assertEqual('SIGABRT: Fatal Error: SIGABRT', Event.objects.get().title())
-            self.assertEqual([], os.listdir(tempdir))
+            self.assertEqual([], _files_in(tempdir))
 
     @tag("samples")
     @override_settings(FEATURE_MINIDUMPS=False)
@@ -600,6 +679,142 @@ class IngestViewTestCase(TransactionTestCase):
         self.assertIn("id", response.json())
         uuid.UUID(response.json()["id"])
 
+    def test_store_endpoint_stores_event_data_as_sent(self):
+        # the JSON as sent is passed on to the Event as-is (no re-serialization), as long as nothing was changed.
+        project = Project.objects.create(name="test")
+        sentry_auth_header = get_header_value(f"http://{ project.sentry_key }@hostisignored/{ project.id }")
+
+        data_bytes = json.dumps(create_event_data(), indent=2, ensure_ascii=False).encode("utf-8")
+
+        response = self.client.post(
+            f"/api/{ project.id }/store/",
+            content_type="application/json",
+            headers={
+                "X-Sentry-Auth": sentry_auth_header,
+            },
+            data=data_bytes,
+        )
+        self.assertEqual(
+            200, response.status_code, response.content if response.status_code != 302 else response.url)
+        self.assertEqual(data_bytes.decode("utf-8"), Event.objects.get().get_raw_data())
+
+    def test_store_endpoint_applies_sourcemaps_on_digest(self):
+        project = Project.objects.create(name="test", apply_sourcemaps_on_digest=True)
+        sentry_auth_header = get_header_value(f"http://{ project.sentry_key }@hostisignored/{ project.id }")
+
+        debug_id = uuid.uuid4()
+        sourcemap = ecma426.encode([Mapping(5, 11, "src/original.ts", 2, 4, "originalFunction")])
+        sourcemap["sourcesContent"] = ["line 1\nline 2\nline 3\nline 4"]
+        sourcemap = json.dumps(sourcemap).encode("utf-8")
+        file = File.objects.create(
+            checksum=sha1(sourcemap).hexdigest(), filename="app.js.map", size=len(sourcemap), data=sourcemap)
+        FileMetadata.objects.create(
+            project=project, file=file, debug_id=debug_id, file_type="source_map", data="{}")
+
+        event_data = create_event_data()
+        event_data["exception"] = {"values": [{
+            "type": "Error",
+            "value": "test",
+            "stacktrace": {"frames": [{"filename": "app.js", "function": "a", "lineno": 6, "colno": 12}]},
+        }]}
+        event_data["debug_meta"] = {"images": [{"type": "sourcemap", "code_file": "app.js", "debug_id": str(debug_id)}]}
+
+        response = self.client.post(
+            f"/api/{ project.id }/store/",
+            content_type="application/json",
+            headers={
+                "X-Sentry-Auth": sentry_auth_header,
+            },
+            data=json.dumps(event_data),
+        )
+        self.assertEqual(
+            200, response.status_code, response.content if response.status_code != 302 else response.url)
+
+        # stored in applied form (i.e. not the JSON as sent), and grouping/denormalized fields use the original frame
+        event = Event.objects.get()
+        stored = event.get_parsed_data()
+        self.assertTrue(event.sourcemaps_applied)
+        frame = stored["exception"]["values"][0]["stacktrace"]["frames"][0]
+        self.assertEqual(("src/original.ts", "originalFunction", 3, "line 3"),
+                         (frame["filename"], frame["function"], frame["lineno"], frame["context_line"]))
+        self.assertEqual("src/original.ts", Issue.objects.get().last_frame_filename)
+
+        # rendering does not apply the sourcemap again
+        with patch("events.markdown_stacktrace.apply_sourcemaps") as apply_sourcemaps:
+            render_stacktrace_md(event)
+        self.assertEqual(0, apply_sourcemaps.call_count)
+
+    def test_store_endpoint_sourcemap_uploaded_after_digest(self):
+        project = Project.objects.create(name="test", apply_sourcemaps_on_digest=True)
+        sentry_auth_header = get_header_value(f"http://{ project.sentry_key }@hostisignored/{ project.id }")
+
+        debug_id = uuid.uuid4()
+        event_data = create_event_data()
+        event_data["exception"] = {"values": [{
+            "type": "Error",
+            "value": "test",
+            "stacktrace": {"frames": [{"filename": "app.js", "function": "a", "lineno": 6, "colno": 12}]},
+        }]}
+        event_data["debug_meta"] = {"images": [{"type": "sourcemap", "code_file": "app.js", "debug_id": str(debug_id)}]}
+
+        response = self.client.post(
+            f"/api/{ project.id }/store/",
+            content_type="application/json",
+            headers={
+                "X-Sentry-Auth": sentry_auth_header,
+            },
+            data=json.dumps(event_data),
+        )
+        self.assertEqual(
+            200, response.status_code, response.content if response.status_code != 302 else response.url)
+
+        # no sourcemap (yet) at digest time: stored as sent, and not marked as applied
+        event = Event.objects.get()
+        self.assertFalse(event.sourcemaps_applied)
+        self.assertEqual(event_data["exception"], event.get_parsed_data()["exception"])
+
+        # the sourcemap is uploaded afterwards (the common order of things); rendering applies it.
+        sourcemap = ecma426.encode([Mapping(5, 11, "src/original.ts", 2, 4, "originalFunction")])
+        sourcemap["sourcesContent"] = ["line 1\nline 2\nline 3\nline 4"]
+        sourcemap = json.dumps(sourcemap).encode("utf-8")
+        file = File.objects.create(
+            checksum=sha1(sourcemap).hexdigest(), filename="app.js.map", size=len(sourcemap), data=sourcemap)
+        FileMetadata.objects.create(
+            project=project, file=file, debug_id=debug_id, file_type="source_map", data="{}")
+
+        self.assertIn("src/original.ts", render_stacktrace_md(event))
+
+    def test_store_endpoint_applying_sourcemaps_on_digest_fails(self):
+        project = Project.objects.create(name="test", apply_sourcemaps_on_digest=True)
+        sentry_auth_header = get_header_value(f"http://{ project.sentry_key }@hostisignored/{ project.id }")
+
+        event_data = create_event_data()
+        event_data["exception"] = {"values": [{
+            "type": "Error",
+            "value": "test",
+            "stacktrace": {"frames": [{"filename": "app.js", "function": "a", "lineno": 6, "colno": 12}]},
+        }]}
+        event_data["debug_meta"] = {"images": [
+            {"type": "sourcemap", "code_file": "app.js", "debug_id": str(uuid.uuid4())}]}
+
+        with patch("events.utils.get_file_metadata_for_debug_ids", side_effect=RuntimeError("broken")), \
+                self.assertLogs("bugsink.ingest", level="ERROR"):
+            response = self.client.post(
+                f"/api/{ project.id }/store/",
+                content_type="application/json",
+                headers={
+                    "X-Sentry-Auth": sentry_auth_header,
+                },
+                data=json.dumps(event_data),
+            )
+        self.assertEqual(
+            200, response.status_code, response.content if response.status_code != 302 else response.url)
+
+        # the event is stored as sent, and not marked as applied (i.e. rendering will apply the sourcemaps)
+        event = Event.objects.get()
+        self.assertFalse(event.sourcemaps_applied)
+        self.assertEqual(event_data["exception"], event.get_parsed_data()["exception"])
+
     def test_envelope_endpoint_cleans_up_oversized_event_file(self):
         project = Project.objects.create(name="test")
         sentry_auth_header = get_header_value(f"http://{ project.sentry_key }@hostisignored/{ project.id }")
@@ -624,7 +839,7 @@ class IngestViewTestCase(TransactionTestCase):
             )
 
             self.assertEqual(413, response.status_code)
-            self.assertEqual([], os.listdir(tempdir))
+            self.assertEqual([], _files_in(tempdir))
 
     def test_envelope_endpoint_cleans_up_multiple_event_files(self):
         project = Project.objects.create(name="test")
@@ -651,7 +866,7 @@ class IngestViewTestCase(TransactionTestCase):
             )
 
             self.assertEqual(200, response.status_code)
-            self.assertEqual([], os.listdir(tempdir))
+            self.assertEqual([], _files_in(tempdir))
             self.assertEqual(0, Event.objects.count())
 
     @tag("samples")
@@ -886,6 +1101,9 @@ class IngestViewTestCase(TransactionTestCase):
             # subtracting the full deletion count from event.issue); thus, as a regression test this is good enough.
             self.assertEqual(issue.stored_event_count, issue.event_set.all().count())
 
+        # the maintained eviction histogram matches what's actually stored
+        self.assertEqual(get_eviction_counts_from_events(project), get_eviction_counts(project))
+
     @override_settings(MAX_EVENTS_PER_PROJECT_PER_5_MINUTES=0)
     @patch("ingest.views.check_for_thresholds")
     def test_count_project_periods_and_act_on_it_zero(self, patched_check_for_thresholds):
@@ -1075,6 +1293,22 @@ class IngestViewTestCase(TransactionTestCase):
         self.assertEqual(now + relativedelta(months=1), installation.quota_exceeded_until)
         self.assertEqual('["month", 1, 3]', installation.quota_exceeded_reason)
 
+    def test_installation_quota_check_uses_in_process_counter(self):
+        request = self.request_factory.post("/api/1/store/")
+        BaseIngestAPIView().digest_event(**_digest_params(create_event_data(), self.quiet_project, request))
+        self.assertEqual(1, installation_digest_counter.get())
+
+        with CaptureQueriesContext(connection) as queries:
+            BaseIngestAPIView().digest_event(**_digest_params(create_event_data(), self.quiet_project, request))
+
+        self.assertFalse([q for q in queries.captured_queries if "SUM(" in q["sql"].upper()])
+        self.assertEqual(2, installation_digest_counter.get())
+
+        # an overestimate (e.g. a rolled back digest) is corrected when the counter's value is acted upon
+        installation_digest_counter.total = Installation.objects.get().next_quota_check + 10
+        BaseIngestAPIView().digest_event(**_digest_params(create_event_data(), self.quiet_project, request))
+        self.assertEqual(3, installation_digest_counter.get())
+
     def test_ingest_updates_stored_event_counts(self):
         request = self.request_factory.post("/api/1/store/")
         first_hour = datetime.datetime(2026, 6, 14, 12, 34, tzinfo=datetime.timezone.utc)
@@ -1111,6 +1345,84 @@ class IngestViewTestCase(TransactionTestCase):
             IssueEventCountsPerHour.objects.get(issue=Issue.objects.get(), bucket=hour_bucket(first_hour)).count,
         )
 
+    @override_settings(EVICTION_WATERMARKS=(1.2, 0.5))
+    @patch("events.tasks.EVICT_TO_LOW_WATERMARK_BATCH_SIZE", 2)
+    def test_ingest_eviction_with_watermarks(self):
+        request = self.request_factory.post("/api/1/store/")
+        project = Project.objects.create(name="watermarks", retention_max_event_count=10)
+
+        for i in range(12):
+            BaseIngestAPIView().digest_event(**_digest_params(create_event_data(), project, request))
+
+        # at (but not over) the high watermark of 12: nothing happens.
+        project.refresh_from_db()
+        self.assertEqual(12, project.stored_event_count)
+        self.assertEqual(None, project.eviction_requested_at)
+
+        # over the high watermark: digest itself does not evict, but evict_to_low_watermark is enqueued (and, given
+        # TASK_ALWAYS_EAGER, runs on-commit); it evicts in batches of 2, re-enqueueing itself until the low watermark.
+        BaseIngestAPIView().digest_event(**_digest_params(create_event_data(), project, request))
+
+        project.refresh_from_db()
+        self.assertEqual(5, project.stored_event_count)
+        self.assertEqual(5, Event.objects.filter(project=project).count())
+        self.assertEqual(5, Issue.objects.get(project=project).stored_event_count)
+        self.assertEqual(None, project.eviction_requested_at)
+
+    @override_settings(EVICTION_WATERMARKS=(1.2, 0.5))
+    @patch("ingest.views.evict_to_low_watermark")
+    def test_ingest_eviction_with_watermarks_requests_once(self, evict_to_low_watermark):
+        request = self.request_factory.post("/api/1/store/")
+        project = Project.objects.create(name="watermarks", retention_max_event_count=10)
+
+        for i in range(15):
+            BaseIngestAPIView().digest_event(**_digest_params(create_event_data(), project, request))
+
+        # requested when going over the watermark (event 13), and not again for the 2 events after that
+        self.assertEqual(1, evict_to_low_watermark.delay.call_count)
+        self.assertEqual(15, Project.objects.get(pk=project.pk).stored_event_count)
+
+        # a request that has not been refreshed in a while is made again
+        Project.objects.filter(pk=project.pk).update(
+            eviction_requested_at=timezone.now() - datetime.timedelta(minutes=10))
+        BaseIngestAPIView().digest_event(**_digest_params(create_event_data(), project, request))
+        self.assertEqual(2, evict_to_low_watermark.delay.call_count)
+
+    @override_settings(EVICTION_WATERMARKS=(1.2, 0.5))
+    @patch("ingest.views.evict_to_low_watermark")
+    def test_ingest_eviction_with_watermarks_hard_ceiling(self, evict_to_low_watermark):
+        # background eviction not keeping up (here: not running at all); at twice the retention max digest evicts.
+        request = self.request_factory.post("/api/1/store/")
+        project = Project.objects.create(name="watermarks", retention_max_event_count=10)
+
+        for i in range(20):
+            BaseIngestAPIView().digest_event(**_digest_params(create_event_data(), project, request))
+        self.assertEqual(20, Project.objects.get(pk=project.pk).stored_event_count)
+
+        BaseIngestAPIView().digest_event(**_digest_params(create_event_data(), project, request))
+
+        project.refresh_from_db()
+        self.assertEqual(10, project.stored_event_count)
+        self.assertEqual(10, Event.objects.filter(project=project).count())
+        self.assertEqual(10, Issue.objects.get(project=project).stored_event_count)
+
+    @override_settings(EVICTION_WATERMARKS=(1.2, 0.5))
+    def test_evict_to_low_watermark_superseded_chain_stops(self):
+        request = self.request_factory.post("/api/1/store/")
+        project = Project.objects.create(name="watermarks", retention_max_event_count=10)
+
+        with patch("ingest.views.evict_to_low_watermark"):
+            for i in range(15):
+                BaseIngestAPIView().digest_event(**_digest_params(create_event_data(), project, request))
+        project.refresh_from_db()
+
+        stale = (project.eviction_requested_at - datetime.timedelta(minutes=10)).isoformat()
+        evict_to_low_watermark(str(project.pk), stale)
+        self.assertEqual(15, Project.objects.get(pk=project.pk).stored_event_count)
+
+        evict_to_low_watermark(str(project.pk), project.eviction_requested_at.isoformat())
+        self.assertEqual(5, Project.objects.get(pk=project.pk).stored_event_count)
+
     def test_ingest_stores_current_grouping_mechanism(self):
         request = self.request_factory.post("/api/1/store/")
 
@@ -1574,6 +1886,171 @@ class MinidumpAPIViewTestCase(TransactionTestCase):
         self.assertEqual(result, {"release": "1.2.3", "tags": {"a": "b"}})
 
 
+class SpoolTestCase(TransactionTestCase):
+    databases = "__all__"
+
+    def test_segments_are_removed_when_all_entries_are(self):
+        with tempfile.TemporaryDirectory() as tempdir, \
+                override_settings(INGEST_STORE_BASE_DIR=tempdir, INGEST_STORE_SEGMENT_SIZE=1), \
+                patch("ingest.filestore._segment_writer", SegmentWriter()):
+            ingestion_id_1, ingestion_id_2 = str(uuid.uuid4()), str(uuid.uuid4())
+
+            location_1 = write_spooled(ingestion_id_1, b"first")
+            location_2 = write_spooled(ingestion_id_2, b"second")  # SEGMENT_SIZE=1: seals the first segment
+            self.assertNotEqual(location_1[0], location_2[0])
+
+            self.assertEqual(b"first", read_spooled(ingestion_id_1, location_1))
+            self.assertEqual(b"second", read_spooled(ingestion_id_2, location_2))
+
+            remove_spooled(ingestion_id_1, location_1)
+            self.assertFalse(os.path.exists(os.path.join(tempdir, "segments", location_1[0] + ".seg")))
+
+            # the second segment is not sealed (it's still being written to), i.e. it stays
+            remove_spooled(ingestion_id_2, location_2)
+            self.assertTrue(os.path.exists(os.path.join(tempdir, "segments", location_2[0] + ".seg")))
+
+    def test_idle_segments_are_reaped(self):
+        with tempfile.TemporaryDirectory() as tempdir, \
+                override_settings(INGEST_STORE_BASE_DIR=tempdir, INGEST_STORE_SEGMENT_SIZE=1024), \
+                patch("ingest.filestore._segment_writer", SegmentWriter()):
+            ingestion_id_1, ingestion_id_2 = str(uuid.uuid4()), str(uuid.uuid4())
+            location_1 = write_spooled(ingestion_id_1, b"first")
+            location_2 = write_spooled(ingestion_id_2, b"second")
+            remove_spooled(ingestion_id_1, location_1)
+
+            # the writer goes idle, i.e. does not seal the segment (which it only does on its next write)
+            an_hour_ago = time.time() - 3600
+            for filename in _files_in(tempdir):
+                os.utime(filename, (an_hour_ago, an_hour_ago))
+
+            self.assertEqual(0, reap_idle_segments())  # sealed, but an entry is still pending
+            self.assertEqual(b"second", read_spooled(ingestion_id_2, location_2))
+
+            remove_spooled(ingestion_id_2, location_2)  # removes the (now sealed) segment
+            self.assertEqual([], _files_in(tempdir))
+
+            with patch("ingest.filestore._segment_writer", SegmentWriter()):
+                location_3 = write_spooled(ingestion_id_1, b"third")
+                remove_spooled(ingestion_id_1, location_3)
+                for filename in _files_in(tempdir):
+                    os.utime(filename, (an_hour_ago, an_hour_ago))
+
+                self.assertEqual(1, reap_idle_segments())  # all done: sealed and removed
+                self.assertEqual([], _files_in(tempdir))
+
+    def test_read_and_prepare_returns_no_parsed_event_data(self):
+        # what crosses the process pool boundary must be cheap to pickle: the JSON as str, and the PreparedEvent.
+        project = Project.objects.create(name="Test Project")
+
+        with tempfile.TemporaryDirectory() as tempdir, override_settings(INGEST_STORE_BASE_DIR=tempdir):
+            event_data = create_event_data()
+            raw_data = json.dumps(event_data)
+            ingestion_id = str(uuid.uuid4())
+            event_metadata = {"project_id": project.id, "ingestion_id": ingestion_id}
+            set_spool_locations(event_metadata, {"event": write_spooled(ingestion_id, raw_data.encode("utf-8"))})
+
+            _, preparation = _get_preparation(event_metadata)
+            result_raw_data, minidump_bytes, _, prepared = _read_and_prepare(
+                event_data["event_id"], event_metadata, preparation)
+
+        self.assertEqual((raw_data, None), (result_raw_data, minidump_bytes))
+        self.assertIsInstance(prepared, PreparedEvent)
+
+    def test_digest_batch_isolates_failing_preparation(self):
+        project = Project.objects.create(name="Test Project")
+
+        with tempfile.TemporaryDirectory() as tempdir, override_settings(INGEST_STORE_BASE_DIR=tempdir):
+            args_list = []
+            for message in ["ok 1", "fails", "ok 2"]:
+                event_data = create_event_data()
+                event_data["message"] = message
+                ingestion_id = str(uuid.uuid4())
+                event_metadata = {
+                    "event_id": event_data["event_id"],
+                    "project_id": project.id,
+                    "ingested_at": format_timestamp(datetime.datetime.now(datetime.timezone.utc)),
+                    "ingestion_id": ingestion_id,
+                    "remote_addr": "127.0.0.1",
+                }
+                set_spool_locations(
+                    event_metadata, {"event": write_spooled(ingestion_id, json.dumps(event_data).encode("utf-8"))})
+                args_list.append((event_data["event_id"], event_metadata))
+
+            def prepare_event_data(event_data, *args):
+                if event_data["message"] == "fails":
+                    raise RuntimeError("not a ValidationError")
+                return real_prepare_event_data(event_data, *args)
+
+            with patch("ingest.views.prepare_event_data", side_effect=prepare_event_data), \
+                    self.assertLogs("bugsink.ingest", level="ERROR"):
+                digest_batch(args_list)
+
+        self.assertEqual(["ok 1", "ok 2"], sorted(Event.objects.values_list("calculated_value", flat=True)))
+
+    def test_recover_spool(self):
+        project = Project.objects.create(name="Test Project")
+
+        with tempfile.TemporaryDirectory() as tempdir, override_settings(INGEST_STORE_BASE_DIR=tempdir):
+            # an event that was accepted (has a "meta" entry) but has no Task, e.g. because the Foreman was killed
+            event_data = create_event_data()
+            ingestion_id = str(uuid.uuid4())
+            location = write_spooled(ingestion_id, json.dumps(event_data).encode("utf-8"))
+            event_metadata = {
+                "event_id": event_data["event_id"],
+                "project_id": project.id,
+                "ingested_at": format_timestamp(datetime.datetime.now(datetime.timezone.utc)),
+                "ingestion_id": ingestion_id,
+                "remote_addr": "127.0.0.1",
+            }
+            set_spool_locations(event_metadata, {"event": location})
+            accept_spooled(event_metadata)
+
+            self.assertEqual(0, recover_spool())  # recent entries are left alone: the server may still be writing
+
+            an_hour_ago = time.time() - 3600
+            for filename in _files_in(tempdir):
+                os.utime(filename, (an_hour_ago, an_hour_ago))
+
+            self.assertEqual(1, recover_spool())
+
+            # tests run w/ TASK_ALWAYS_EAGER, i.e. the re-created Task has run.
+            self.assertEqual(1, Event.objects.count())
+            self.assertEqual([], _files_in(tempdir))
+
+    def test_recover_spool_leaves_queued_events_alone(self):
+        project = Project.objects.create(name="Test Project")
+
+        for segment_size in [0, 1]:
+            with tempfile.TemporaryDirectory() as tempdir, \
+                    override_settings(INGEST_STORE_BASE_DIR=tempdir, INGEST_STORE_SEGMENT_SIZE=segment_size), \
+                    patch("ingest.filestore._segment_writer", SegmentWriter()):
+                event_data = create_event_data()
+                ingestion_id = str(uuid.uuid4())  # i.e. with dashes, as in the views
+                location = write_spooled(ingestion_id, json.dumps(event_data).encode("utf-8"))
+                event_metadata = {
+                    "event_id": event_data["event_id"],
+                    "project_id": project.id,
+                    "ingested_at": format_timestamp(datetime.datetime.now(datetime.timezone.utc)),
+                    "ingestion_id": ingestion_id,
+                    "remote_addr": "127.0.0.1",
+                }
+                set_spool_locations(event_metadata, {"event": location})
+                accept_spooled(event_metadata)
+
+                # the digest Task is still queued (in the DB-as-MQ), e.g. because of a large backlog
+                Task.objects.create(
+                    task_name="ingest.tasks.digest", args=json.dumps([event_data["event_id"], event_metadata]),
+                    kwargs="{}")
+
+                an_hour_ago = time.time() - 3600
+                for filename in _files_in(tempdir):
+                    os.utime(filename, (an_hour_ago, an_hour_ago))
+
+                self.assertEqual(0, recover_spool())
+                self.assertEqual(1, Task.objects.count())
+                Task.objects.all().delete()
+
+
 class TestParser(RegularTestCase):
 
     def test_readuntil_newline_everything_in_initial_chunk(self):
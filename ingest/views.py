@@ -2,16 +2,17 @@ from collections import defaultdict
 from enum import Enum
 import uuid
 import hashlib
-import os
+import time
 import logging
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
 import json
 import jsonschema
 import fastjsonschema
 
 from django.conf import settings
 from django.shortcuts import get_object_or_404
-from django.db.models import Max, F, Sum
+from django.db import transaction
+from django.db.models import Max, F, Sum, Case, When, Value, IntegerField
 from django.views import View
 from django.core.exceptions import ValidationError, PermissionDenied
 from django.http import HttpResponse, JsonResponse
@@ -29,6 +30,7 @@ from issues.grouping_mechanisms import (
 from issues.utils import get_type_and_value_for_data, get_key_with_mechanism_for_data, get_denormalized_fields_for_data
 from issues.regressions import issue_is_regression
 
+from bugsink import json as bugsink_json
 from bugsink.transaction import immediate_atomic, delay_on_commit
 from bugsink.exceptions import ViolatedExpectation
 from bugsink.streams import (
@@ -38,20 +40,25 @@ from bugsink.app_settings import get_settings
 from bugsink.utils import set_path
 
 from events.models import Event
-from events.retention import evict_for_max_events, should_evict, EvictionCounts
+from events.retention import (
+    evict_for_max_events, should_evict, EvictionCounts, record_event_for_eviction, get_hard_ceiling)
 from events.usage import record_event_counts
+from events.utils import apply_sourcemaps_on_digest
+from events.tasks import evict_to_low_watermark
 from releases.models import create_release_if_needed
 from alerts.tasks import send_new_issue_alert, send_regression_alert
 from compat.timestamp import format_timestamp, parse_timestamp
-from tags.models import digest_tags
-from bsmain.utils import b108_makedirs
+from tags.models import digest_tags, get_tags_for_data
+from performance.context_managers import time_to_logger
 from phonehome.models import Installation
 
 from sentry_sdk_extensions import capture_or_log_exception
 from sentry.minidump import merge_minidump_event
 
 from .parsers import StreamingEnvelopeParser, ParseError
-from .filestore import get_filename_for_event_id
+from .filestore import (
+    is_segmented, open_spooled_for_writing, write_spooled, read_spooled, remove_spooled, set_spool_locations,
+    accept_spooled)
 from .tasks import digest
 from .event_counter import check_for_thresholds, count_for_thresholds, filter_for_periods, state_for_threshold
 from .models import StoreEnvelope, DontStoreEnvelope, Envelope
@@ -82,19 +89,23 @@ QUOTA_THRESHOLDS = {
     ],
 }
 
+# see _request_background_eviction; generous compared to the time a single batch of evict_to_low_watermark takes.
+BACKGROUND_EVICTION_REQUEST_TIMEOUT = timedelta(minutes=5)
+
 logger = logging.getLogger("bugsink.ingest")
 performance_logger = logging.getLogger("bugsink.performance.ingest")
 
 
 def update_issue_counts(per_issue):
-    # we minimize the number of queries by grouping them by count; in the worst case we'll need 32 queries for 500
-    # event evictions (because 1 + 2 + ... + 31 + 32 > 500)
-    by_count = {}
-    for issue_id, count in per_issue.items():
-        by_count.setdefault(count, []).append(issue_id)
+    # a single UPDATE for all issues, with the per-issue count as a CASE (we used to group by count, which in the worst
+    # case meant 32 queries for 500 event evictions). CASE rather than UPDATE ... FROM (VALUES ...) for portability.
+    if not per_issue:
+        return
 
-    for count, issue_ids in by_count.items():
-        Issue.objects.filter(id__in=issue_ids).update(stored_event_count=F("stored_event_count") - count)
+    Issue.objects.filter(id__in=per_issue.keys()).update(stored_event_count=F("stored_event_count") - Case(
+        *[When(id=issue_id, then=Value(count)) for issue_id, count in per_issue.items()],
+        output_field=IntegerField(),
+    ))
 
 
 def get_grouping_key_hash(grouping_key):
@@ -102,8 +113,10 @@ def get_grouping_key_hash(grouping_key):
 
 
 def get_existing_grouping(project_id, key_with_mechanism):
-    # helper to get the existing grouping for a given key/mechanism pair, if it exists.
-    return Grouping.objects.filter(
+    # helper to get the existing grouping for a given key/mechanism pair, if it exists. The Issue is joined in: digest
+    # needs it right after, and (being updated on each event) it must be read fresh anyway, i.e. this is the minimum of
+    # a single query per lookup.
+    return Grouping.objects.select_related("issue").filter(
         project_id=project_id,
         grouping_key=key_with_mechanism.key,
         grouping_key_hash=get_grouping_key_hash(key_with_mechanism.key),
@@ -121,13 +134,14 @@ def get_legacy_grouping_for_mechanism_independent_key(project_id, key_with_mecha
 
 
 def create_grouping(project_id, key_with_mechanism, issue):
-    return Grouping.objects.create(
+    grouping = Grouping.objects.create(
         project_id=project_id,
         grouping_key=key_with_mechanism.key,
         grouping_key_hash=get_grouping_key_hash(key_with_mechanism.key),
         grouping_mechanism=key_with_mechanism.mechanism,
         issue=issue,
     )
+    return grouping
 
 
 def grouping_transition_is_active(project, digested_at):
@@ -137,10 +151,9 @@ def grouping_transition_is_active(project, digested_at):
     return digested_at <= project.grouping_mechanism_upgraded_at + GROUPING_TRANSITION_PERIOD
 
 
-def get_grouping_path_for_event(project, event_data, digested_at):
+def get_grouping_path_for_event(project, event_data, digested_at, prepared):
     # First try the project's current mechanism.
-    current_key_with_mechanism = get_key_with_mechanism_for_data(
-        event_data, grouping_mechanism=project.grouping_mechanism)
+    current_key_with_mechanism = prepared.get_key_with_mechanism(event_data, project.grouping_mechanism)
     if (current_grouping := get_existing_grouping(project.id, current_key_with_mechanism)) is not None:
         return GroupingPath.FOUND, (current_grouping,)
 
@@ -161,8 +174,7 @@ def get_grouping_path_for_event(project, event_data, digested_at):
         return GroupingPath.NEW, (current_key_with_mechanism,)
 
     # During the transition window, retry the previous mechanism.
-    previous_key_with_mechanism = get_key_with_mechanism_for_data(
-        event_data, grouping_mechanism=project.previous_grouping_mechanism)
+    previous_key_with_mechanism = prepared.get_key_with_mechanism(event_data, project.previous_grouping_mechanism)
     if (previous_grouping := get_existing_grouping(project.id, previous_key_with_mechanism)) is not None:
         return GroupingPath.ATTACH, (current_key_with_mechanism, previous_grouping)
 
@@ -190,6 +202,134 @@ def check_for_thresholds_on_installation(qs, now, thresholds, add_for_current=0)
     return states
 
 
+class PreparedEvent:
+    """
+    What digest needs that can be derived from the event data alone, i.e. without the DB. Computing this is a fair
+    amount of (CPU-bound) work, which we do before starting the digest transaction, i.e. without holding the global
+    write lock. See BaseIngestAPIView.prepare_event.
+    """
+
+    def __init__(self, denormalized_fields, keys_with_mechanism, tags):
+        self.denormalized_fields = denormalized_fields
+        self.keys_with_mechanism = keys_with_mechanism  # grouping_mechanism => KeyWithMechanism
+        self.tags = tags
+
+        # whether preparing changed event_data itself (i.e. the JSON it was parsed from no longer matches it)
+        self.event_data_changed = False
+        self.sourcemaps_applied = False
+
+    def get_key_with_mechanism(self, event_data, grouping_mechanism):
+        # keys are prepared for the project's mechanism(s) at the time of preparation; in the (rare) case that these
+        # have changed by the time we digest, we calculate the key on the spot.
+        if grouping_mechanism not in self.keys_with_mechanism:
+            self.keys_with_mechanism[grouping_mechanism] = get_key_with_mechanism_for_data(
+                event_data, grouping_mechanism=grouping_mechanism)
+        return self.keys_with_mechanism[grouping_mechanism]
+
+
+def get_grouping_mechanisms(project):
+    if project.previous_grouping_mechanism is None:
+        return [project.grouping_mechanism]
+    return [project.grouping_mechanism, project.previous_grouping_mechanism]
+
+
+def prepare_event_data(event_data, grouping_mechanisms, validate_on_digest):
+    # The pure (no DB) part of preparing an event, which means it can be done in snappea's process pool.
+    if validate_on_digest in ["warn", "strict"]:
+        BaseIngestAPIView.validate_event_data(event_data, validate_on_digest)
+
+    # I resisted the temptation to put `get_denormalized_fields_for_data` in an if-statement: you basically "always"
+    # need this info... except when duplicate event-ids are sent. But the latter is the exception, and putting this
+    # in an if-statement would require more rework (and possibly extra queries) than it's worth.
+    denormalized_fields = get_denormalized_fields_for_data(event_data)
+
+    # the 3 lines below are suggestive of a further inlining of the get_type_and_value_for_data function
+    calculated_type, calculated_value = get_type_and_value_for_data(event_data)
+    denormalized_fields["calculated_type"] = calculated_type
+    denormalized_fields["calculated_value"] = calculated_value
+
+    keys_with_mechanism = {
+        grouping_mechanism: get_key_with_mechanism_for_data(event_data, grouping_mechanism=grouping_mechanism)
+        for grouping_mechanism in grouping_mechanisms
+    }
+
+    return PreparedEvent(denormalized_fields, keys_with_mechanism, get_tags_for_data(event_data))
+
+
+class DigestState:
+    """
+    The rows that digest_event reads for (nearly) every event: the Project and the Installation. A DigestState lives
+    for the duration of a single digest-transaction; inside it we are the single writer, so the objects (which are saved
+    by digest_event itself) cannot go stale. For batched digestion this means these rows are read once per batch rather
+    than once per event.
+
+    When an event's digestion is rolled back (to its savepoint) the in-memory objects no longer match the DB, so they
+    must be discarded using reset().
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.projects = {}
+        self.installation = None
+
+    def get_project(self, project_id):
+        # returns None for deleted projects (as well as for projects with deletion in progress)
+        if project_id not in self.projects:
+            try:
+                self.projects[project_id] = Project.objects.get(pk=project_id, is_deleted=False)
+            except Project.DoesNotExist:
+                self.projects[project_id] = None
+
+        return self.projects[project_id]
+
+    def get_installation(self):
+        if self.installation is None:
+            self.installation = Installation.objects.get()
+
+        return self.installation
+
+
+class InstallationDigestCounter:
+    """
+    In-process running total of Project.digested_event_count over all projects, i.e. the installation-wide number of
+    digested events, as used for the installation-wide quota. Keeping it in-process saves us doing an aggregate over all
+    projects for each digested event.
+
+    The counter is only touched from inside (immediate_atomic) digest transactions, which are serialized (per process
+    by the semaphore, across processes by the DB), so no locking is needed. It's kept "good enough" as follows:
+
+    * increments are applied right away, i.e. also for digests that are later rolled back. Overestimation is harmless:
+      the counter is only used to decide when to do the (exact) quota check, and we resync before doing so.
+    * underestimation can happen when digests happen in another process (or when the DB is changed under our feet,
+      e.g. in tests); a periodic resync puts a time-bound on the effects of that.
+    """
+
+    RESYNC_INTERVAL = 60  # seconds
+
+    def __init__(self):
+        self.total = None
+        self.synced_at = None
+
+    def get(self):
+        if self.total is None or time.monotonic() - self.synced_at > self.RESYNC_INTERVAL:
+            return self.resync()
+        return self.total
+
+    def resync(self):
+        self.total = Project.objects.aggregate(total=Sum("digested_event_count"))["total"] or 0
+        self.synced_at = time.monotonic()
+        return self.total
+
+    def add(self, n):
+        if self.total is not None:
+            self.total += n
+
+
+installation_digest_counter = InstallationDigestCounter()
+
+
 @method_decorator(csrf_exempt, name='dispatch')
 class BaseIngestAPIView(View):
 
@@ -276,15 +416,26 @@ class BaseIngestAPIView(View):
         return cls.get_project(project_pk, sentry_key)
 
     @classmethod
-    def cleanup_ingestion_files(cls, ingestion_id):
+    def cleanup_ingestion_files(cls, ingestion_id, locations=None):
+        # locations: {filetype: location} for the segment layout, where unknown locations mean "left for recover_spool"
+        locations = locations or {}
         for filetype in ["event", "minidump"]:
-            filename = get_filename_for_event_id(ingestion_id, filetype=filetype)
+            if is_segmented() and filetype not in locations:
+                continue
             try:
-                os.unlink(filename)
+                remove_spooled(ingestion_id, locations.get(filetype), filetype)
             except FileNotFoundError:
                 pass
             except OSError as e:
-                logger.warning("Failed to clean up ingestion file %s", filename, exc_info=e)
+                logger.warning("Failed to clean up ingestion file %s (%s)", ingestion_id, filetype, exc_info=e)
+
+    @classmethod
+    def enqueue_digest(cls, event_metadata, locations):
+        # locations: {filetype: location} of the spooled entries (see filestore.py); the "meta" entry is what makes the
+        # event recoverable should the Task get lost.
+        set_spool_locations(event_metadata, locations)
+        accept_spooled(event_metadata)
+        digest.delay(event_metadata["event_id"], event_metadata)
 
     @classmethod
     def _minidump_post_data(cls, request):
@@ -315,7 +466,7 @@ class BaseIngestAPIView(View):
         return event_data
 
     @classmethod
-    def process_minidump(cls, ingested_at, ingestion_id, minidump_bytes, project, request):
+    def process_minidump(cls, ingested_at, ingestion_id, minidump_bytes, project, request, minidump_location=None):
         # This is for the "pure" minidump case, i.e. full separate event (however: event data/extra data _can_ be
         # provided via POST). TSTTCPW: convert the minidump data to an event and then proceed as usual.
         performance_logger.info("ingested minidump with %s bytes", len(minidump_bytes))
@@ -333,14 +484,11 @@ class BaseIngestAPIView(View):
         merge_minidump_event(event_data, minidump_bytes, project)
 
         # write the event data to disk:
-        filename = get_filename_for_event_id(ingestion_id)
-        b108_makedirs(os.path.dirname(filename))
-        with open(filename, 'w') as f:
-            json.dump(event_data, f)
+        location = write_spooled(ingestion_id, bugsink_json.dumpb(event_data))
 
         event_metadata = cls.get_event_meta(event_data["event_id"], ingested_at, ingestion_id, request, project)
         event_metadata["has_minidump"] = True
-        digest.delay(event_data["event_id"], event_metadata)
+        cls.enqueue_digest(event_metadata, {"event": location, "minidump": minidump_location})
 
         return event_id
 
@@ -412,9 +560,113 @@ class BaseIngestAPIView(View):
             except ValidationError as e:
                 logger.warning("event data validation failed: %s", e)
 
+    @classmethod
+    def prepare_event(cls, event_metadata, event_data, minidump_bytes=None):
+        # Digestion is split in 2 stages: prepare_event, which is done _before_ the digest transaction (i.e. without
+        # holding the write lock) and digest_event, which does the DB-mutations given the result of prepare_event.
+        #
+        # Returns None when there's nothing to prepare (the event will be dropped by digest_event), or when preparation
+        # is left to digest_event (which prepares whatever was not prepared yet)
+        project = cls.get_project_to_prepare_for(event_metadata)
+        if project is None:
+            return None  # the event will be dropped by digest_event, no need to do the work.
+
+        with time_to_logger(performance_logger, "digest prepare_event (outside of transaction)"):
+            return cls.prepare_event_for_project(project, event_data, minidump_bytes)
+
+    @classmethod
+    def get_project_to_prepare_for(cls, event_metadata):
+        # Preparing needs a few project-level settings (the grouping mechanisms, and the project itself for minidump
+        # merging); we read the project here (outside the transaction), i.e. digest_event must deal with any changes
+        # since (see e.g. PreparedEvent.get_key_with_mechanism). None: the event will be dropped by digest_event.
+        project = Project.objects.filter(pk=event_metadata["project_id"], is_deleted=False).first()
+        if project is None or cls.is_quota_still_exceeded(project, datetime.now(timezone.utc)):
+            return None
+        return project
+
+    @classmethod
+    def get_pool_preparation(cls, project, has_minidump):
+        # The args for prepare_event_data (other than event_data) if the event can be prepared without the DB, i.e. in
+        # snappea's process pool (see ingest/tasks.py); None if it can't.
+        if has_minidump or project.apply_sourcemaps_on_digest:
+            return None
+        return get_grouping_mechanisms(project), get_settings().VALIDATE_ON_DIGEST
+
+    @classmethod
+    def prepare_event_for_project(cls, project, event_data, minidump_bytes):
+        validate_on_digest = get_settings().VALIDATE_ON_DIGEST
+
+        grouping_mechanisms = get_grouping_mechanisms(project)
+
+        if minidump_bytes is None and not project.apply_sourcemaps_on_digest:
+            return prepare_event_data(event_data, grouping_mechanisms, validate_on_digest)
+
+        # minidumps and sourcemaps: these read the project's debug files from the DB, i.e. can't be done in the process
+        # pool.
+        if validate_on_digest in ["warn", "strict"]:
+            cls.validate_event_data(event_data, validate_on_digest)
+
+        # we merge after validation: validation is about what's provided _externally_, not our own merging.
+        event_data_changed = False
+        if minidump_bytes is not None:
+            # TODO error handling
+            merge_minidump_event(event_data, minidump_bytes, project)
+            event_data_changed = True
+
+        sourcemaps_applied = False
+        if project.apply_sourcemaps_on_digest:
+            # before prepare_event_data, such that grouping (and the denormalized fields) see the original locations.
+            try:
+                sourcemaps_applied = apply_sourcemaps_on_digest(event_data, project)
+            except Exception as e:
+                # sourcemaps are still experimental; a failure to apply them should not cost us the event. It's stored
+                # as-is (i.e. not marked sourcemaps_applied), which means rendering will try again.
+                capture_or_log_exception(e, logger)
+
+        prepared = prepare_event_data(event_data, grouping_mechanisms, validate_on_digest=None)
+
+        prepared.event_data_changed = event_data_changed or sourcemaps_applied
+        prepared.sourcemaps_applied = sourcemaps_applied
+        return prepared
+
+    @classmethod
+    @immediate_atomic()
+    def digest_event(cls, event_metadata, event_data, digested_at=None, minidump_bytes=None, prepared=None,
+                     raw_data=None):
+        # prepared: the result of prepare_event; when given, minidump_bytes (if any) are already merged into event_data
+        # and should not be passed. When not given, preparation is done inside the transaction.
+        #
+        # raw_data: the (str) JSON that event_data was parsed from, if available and if event_data is unchanged since
+        # (i.e. no minidump merged into it). It's stored as-is, which saves re-serializing the event.
+        cls._digest_event(DigestState(), event_metadata, event_data, digested_at, minidump_bytes, prepared, raw_data)
+
     @classmethod
     @immediate_atomic()
-    def digest_event(cls, event_metadata, event_data, digested_at=None, minidump_bytes=None):
+    def digest_events(cls, items):
+        # Batched version of digest_event: a single (immediate) transaction for many events, i.e. a single BEGIN/COMMIT
+        # (and fsync) for the whole batch. items are (event_metadata, event_data, minidump_bytes, prepared, raw_data)
+        # tuples.
+        #
+        # Each event gets its own savepoint, such that a single failing event (e.g. a duplicate event_id) does not take
+        # the rest of the batch down with it. The errors are handled as in the non-batched `digest` task (log a warning
+        # for ValidationError) or the Foreman (capture_or_log_exception).
+        state = DigestState()
+        for event_metadata, event_data, minidump_bytes, prepared, raw_data in items:
+            try:
+                with transaction.atomic():
+                    cls._digest_event(
+                        state, event_metadata, event_data, minidump_bytes=minidump_bytes, prepared=prepared,
+                        raw_data=raw_data)
+            except ValidationError as e:
+                logger.warning("ValidationError in digest_event", exc_info=e)
+                state.reset()
+            except Exception as e:
+                capture_or_log_exception(e, logger)
+                state.reset()
+
+    @classmethod
+    def _digest_event(cls, state, event_metadata, event_data, digested_at=None, minidump_bytes=None, prepared=None,
+                      raw_data=None):
         # ingested_at is passed from the point-of-ingestion; digested_at is determined here. Because this happens inside
         # `immediate_atomic`, we know digestions are serialized, and assuming non-decreasing server clocks, not decrea-
         # sing. (no so for ingestion times: clock-watching happens outside the snappe transaction, and threading in the
@@ -431,9 +683,8 @@ class BaseIngestAPIView(View):
         ingested_at = parse_timestamp(event_metadata["ingested_at"])
         digested_at = datetime.now(timezone.utc) if digested_at is None else digested_at  # explicit passing: test only
 
-        try:
-            project = Project.objects.get(pk=event_metadata["project_id"], is_deleted=False)
-        except Project.DoesNotExist:
+        project = state.get_project(event_metadata["project_id"])
+        if project is None:
             # we may get here if the project was deleted after the event was ingested, but before it was digested
             # (covers both "deletion in progress (is_deleted=True)" and "fully deleted").
             return
@@ -444,32 +695,25 @@ class BaseIngestAPIView(View):
                 delay_on_commit(delete_by_age_until_under_retention_max, project.id)
             return
 
-        installation = Installation.objects.get()
+        installation = state.get_installation()
         if (not cls.count_installation_periods_and_act_on_it(installation, digested_at)
                 or not cls.count_project_periods_and_act_on_it(project, digested_at)):
 
             return  # if over-quota: just return (any cleanup is done calling-side)
 
-        if get_settings().VALIDATE_ON_DIGEST in ["warn", "strict"]:
-            cls.validate_event_data(event_data, get_settings().VALIDATE_ON_DIGEST)
-
-        if minidump_bytes is not None:
-            # we merge after validation: validation is about what's provided _externally_, not our own merging.
-            # TODO error handling
-            # TODO should not be inside immediate_atomic if it turns out to be slow
-            merge_minidump_event(event_data, minidump_bytes, project)
+        if prepared is None:
+            # not prepared outside of the transaction (direct calls, e.g. in tests; or in the rare cases described in
+            # prepare_event): prepare now.
+            prepared = cls.prepare_event_for_project(project, event_data, minidump_bytes)
 
-        # I resisted the temptation to put `get_denormalized_fields_for_data` in an if-statement: you basically "always"
-        # need this info... except when duplicate event-ids are sent. But the latter is the exception, and putting this
-        # in an if-statement would require more rework (and possibly extra queries) than it's worth.
-        denormalized_fields = get_denormalized_fields_for_data(event_data)
+        if prepared.event_data_changed:
+            raw_data = None  # e.g. minidump merged into event_data, i.e. raw_data no longer matches it.
 
-        # the 3 lines below are suggestive of a further inlining of the get_type_and_value_for_data function
-        calculated_type, calculated_value = get_type_and_value_for_data(event_data)
-        denormalized_fields["calculated_type"] = calculated_type
-        denormalized_fields["calculated_value"] = calculated_value
+        denormalized_fields = prepared.denormalized_fields
+        calculated_type = denormalized_fields["calculated_type"]
+        calculated_value = denormalized_fields["calculated_value"]
 
-        grouping_path, path_context = get_grouping_path_for_event(project, event_data, digested_at)
+        grouping_path, path_context = get_grouping_path_for_event(project, event_data, digested_at, prepared)
 
         if grouping_path in [GroupingPath.FOUND, GroupingPath.ATTACH]:
             if grouping_path == GroupingPath.FOUND:
@@ -522,7 +766,17 @@ class BaseIngestAPIView(View):
             # cron-like. (not exactly the same, because for cron-like time savings are possible if the cron-likeness
             # causes the work to be outside of the 'rush hour' -- OTOH this also introduces a lot of complexity about
             # "what is a limit anyway, if you can go either over it, or work is done before the limit is reached")
-            evicted = evict_for_max_events(project, digested_at, project_stored_event_count)
+            # EVICTION_WATERMARKS is the opt-in for exactly that "go over it" approach, for setups where the eviction
+            # spikes in digest latency are the bigger problem.
+            if get_settings().EVICTION_WATERMARKS is not None:
+                cls._request_background_eviction(project, digested_at)
+                if project_stored_event_count > get_hard_ceiling(project):
+                    # background eviction is not keeping up; evict here (as without watermarks) to stay bounded.
+                    evicted = evict_for_max_events(project, digested_at, project_stored_event_count)
+                else:
+                    evicted = EvictionCounts(0, {})
+            else:
+                evicted = evict_for_max_events(project, digested_at, project_stored_event_count)
 
             # digest_event() is responsible for this update because we have "issue" open (i.e. to "save a query" /
             # "avoid updating stale objects")
@@ -549,6 +803,8 @@ class BaseIngestAPIView(View):
             grouping,
             event_data,
             denormalized_fields,
+            raw_data=raw_data,
+            sourcemaps_applied=prepared.sourcemaps_applied,
         )
         if not event_created:
             if issue_created:
@@ -621,14 +877,16 @@ class BaseIngestAPIView(View):
             # call)
             event.save()
 
+        record_event_for_eviction(event)  # after the above, i.e. with the final value for never_evict
+
         if release.version + "\n" not in issue.events_at:
             issue.events_at += release.version + "\n"
 
         issue.save()
 
-        # intentionally at the end: possible future optimization is to push this out of the transaction (or even use
-        # a separate DB for this)
-        digest_tags(event_data, event, issue)
+        # intentionally at the end. With DEFERRED_TAG_DIGESTION the tags are only queued here, and stored (batched) by a
+        # separate task, i.e. outside of this transaction. (a possible further step would be a separate DB for this)
+        digest_tags(event_data, event, issue, prepared.tags)
 
     @classmethod
     def count_installation_periods_and_act_on_it(cls, installation, now):
@@ -641,13 +899,19 @@ class BaseIngestAPIView(View):
             return False
 
         # We don't do per-event-digest bookkeeping on the installation because doing so would tie us in further into
-        # "global locking"; the assumption is that a group by over (a few) projects is still quite cheap. The per-exceed
-        # bookkeeping _is_ done on the installation level (moments of exceeding are quite rare; cost is amortized).
-        # +1 because about-to-add and the installation-wide call precedes the per-project bookkeeping.
-        digested_event_count = (Project.objects.aggregate(total=Sum("digested_event_count"))["total"] or 0) + 1
+        # "global locking"; instead we keep an in-process total (see InstallationDigestCounter). Because that total is
+        # not guaranteed to be exact, we resync with the DB (a group by over all projects) before acting on it. The
+        # per-exceed bookkeeping _is_ done on the installation level (moments of exceeding are quite rare; cost is
+        # amortized). +1 because about-to-add and the installation-wide call precedes the per-project bookkeeping.
+        def check_is_due(digested_event_count):
+            return ((digested_event_count >= installation.next_quota_check) or
+                    (installation.next_quota_check - digested_event_count > min_threshold))
 
-        if ((digested_event_count >= installation.next_quota_check) or
-                (installation.next_quota_check - digested_event_count > min_threshold)):
+        digested_event_count = installation_digest_counter.get() + 1
+        if check_is_due(digested_event_count):
+            digested_event_count = installation_digest_counter.resync() + 1
+
+        if check_is_due(digested_event_count):
 
             states = check_for_thresholds_on_installation(Event.objects.all(), now, thresholds, 1)
 
@@ -660,7 +924,10 @@ class BaseIngestAPIView(View):
             installation.quota_exceeded_until = until  # note: never reset to None, but the `now <` will still just work
             installation.quota_exceeded_reason = json.dumps(threshold_info)
             installation.next_quota_check = digested_event_count + check_again_after
-            installation.save()  # conditional in the if-statement because no per-digest bookkeeping on the installation
+
+            # conditional in the if-statement because no per-digest bookkeeping on the installation. update_fields: the
+            # other fields (e.g. email quota) are not ours, and our copy of the installation may be batch-old.
+            installation.save(update_fields=["quota_exceeded_until", "quota_exceeded_reason", "next_quota_check"])
 
         return True
 
@@ -698,6 +965,7 @@ class BaseIngestAPIView(View):
             return False
 
         project.digested_event_count += 1
+        installation_digest_counter.add(1)
 
         if ((project.digested_event_count >= project.next_quota_check) or
                 (project.next_quota_check - project.digested_event_count > min_threshold)):
@@ -733,6 +1001,21 @@ class BaseIngestAPIView(View):
         project.save()
         return True
 
+    @classmethod
+    def _request_background_eviction(cls, project, digested_at):
+        # Over the high watermark (EVICTION_WATERMARKS): have evict_to_low_watermark do the actual work. We request this
+        # once (rather than once per event while over the watermark); eviction_requested_at is refreshed by the task for
+        # as long as it is busy. A request that has not been refreshed in a while is taken to be lost (e.g. a snappea
+        # restart), and is simply made again. The request's timestamp is passed along, such that an earlier chain of
+        # tasks (if it turns out to be still alive after all) notices it has been superseded and stops.
+        if project.eviction_requested_at is not None and \
+                project.eviction_requested_at > digested_at - BACKGROUND_EVICTION_REQUEST_TIMEOUT:
+            return
+
+        project.eviction_requested_at = digested_at
+        Project.objects.filter(pk=project.pk).update(eviction_requested_at=digested_at)
+        delay_on_commit(evict_to_low_watermark, str(project.pk), digested_at.isoformat())
+
     @classmethod
     def count_issue_periods_and_act_on_it(cls, issue, event, timestamp):
         # See the project-version for various off-by-one notes (not reproduced here).
@@ -794,20 +1077,19 @@ class IngestEventAPIView(BaseIngestAPIView):
         performance_logger.info("ingested event with %s bytes", len(event_data_bytes))
 
         try:
-            event_data = json.loads(event_data_bytes)
-        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            event_data = bugsink_json.loads(event_data_bytes)
+        except (bugsink_json.JSONDecodeError, UnicodeDecodeError) as e:
             raise ParseError("invalid JSON in event: %s" % e)
 
-        if "event_id" not in event_data:
-            event_data["event_id"] = uuid.uuid4().hex
-        filename = get_filename_for_event_id(ingestion_id)
-        b108_makedirs(os.path.dirname(filename))
-        with open(filename, 'w') as f:
-            json.dump(event_data, f)
+        if "event_id" not in event_data or bugsink_json.detect_encoding(event_data_bytes) != "utf-8":
+            # the body can't be spooled as-is (the spool is utf-8, and event_id is needed on digest): re-serialize.
+            event_data.setdefault("event_id", uuid.uuid4().hex)
+            event_data_bytes = bugsink_json.dumpb(event_data)
+        location = write_spooled(ingestion_id, event_data_bytes)
 
         event_metadata = self.get_event_meta(event_data["event_id"], ingested_at, ingestion_id, request, project)
 
-        digest.delay(event_data["event_id"], event_metadata)
+        self.enqueue_digest(event_metadata, {"event": location})
 
         return JsonResponse({"id": event_data["event_id"]})
 
@@ -920,11 +1202,9 @@ class IngestEnvelopeAPIView(BaseIngestAPIView):
                 raise ParseError("event_id in envelope headers is not a valid UUID")
 
             filetype = "event" if type_ == "event" else "minidump"
-            filename = get_filename_for_event_id(ingestion_id, filetype=filetype)
-            b108_makedirs(os.path.dirname(filename))
 
             size_conf = "MAX_EVENT_SIZE" if type_ == "event" else "MAX_ATTACHMENT_SIZE"
-            return MaxDataWriter(size_conf, open(filename, 'wb'))
+            return MaxDataWriter(size_conf, open_spooled_for_writing(ingestion_id, filetype=filetype))
 
         # We ingest the whole envelope first and organize by type; this enables "digest once" across envelope-parts
         items_by_type = defaultdict(list)
@@ -944,6 +1224,11 @@ class IngestEnvelopeAPIView(BaseIngestAPIView):
         event_count = len(items_by_type.get("event", []))
         minidump_count = len(items_by_type.get("attachment", [])) if get_settings().FEATURE_MINIDUMPS else 0
 
+        # (for the segment layout; in the file-per-entry layout there is no spool_location, the ingestion_id suffices)
+        locations = {
+            ("event" if type_ == "event" else "minidump"): getattr(output_stream, "spool_location", None)
+            for type_, output_streams in items_by_type.items() for output_stream in output_streams}
+
         if event_count + minidump_count == 0:
             logger.info("no event or minidump found in envelope, ignoring this envelope.")
             # event_id is only required in envelope headers when event/attachment items are present (enforced in
@@ -956,7 +1241,9 @@ class IngestEnvelopeAPIView(BaseIngestAPIView):
             logger.info(
                 "can only deal with one event/minidump per envelope but found %s/%s, ignoring this envelope.",
                 event_count, minidump_count)
-            self.cleanup_ingestion_files(ingestion_id)
+            # (with multiple items per type, only the last one's location is known in the segment layout; the others
+            # are left for recover_spool. Given the rarity of this case, not worth the bookkeeping)
+            self.cleanup_ingestion_files(ingestion_id, locations)
             return JsonResponse({"id": envelope_headers["event_id"]})
 
         event_metadata = self.get_event_meta(envelope_headers["event_id"], ingested_at, ingestion_id, request, project)
@@ -964,17 +1251,17 @@ class IngestEnvelopeAPIView(BaseIngestAPIView):
         if event_count == 1:
             if minidump_count == 1:
                 event_metadata["has_minidump"] = True
-            digest.delay(envelope_headers["event_id"], event_metadata)
+            self.enqueue_digest(event_metadata, locations)
 
         else:
             # as it stands, we implement the minidump->event path for the minidump-only case on-ingest; we could push
             # this to a task too if needed or for reasons of symmetry.
-            with open(get_filename_for_event_id(ingestion_id, filetype="minidump"), 'rb') as f:
-                minidump_bytes = f.read()
+            minidump_bytes = read_spooled(ingestion_id, locations.get("minidump"), filetype="minidump")
 
             # TODO: error handling
             # NOTE "The file should start with the MDMP magic bytes." is not checked yet.
-            self.process_minidump(ingested_at, ingestion_id, minidump_bytes, project, request)
+            self.process_minidump(ingested_at, ingestion_id, minidump_bytes, project, request,
+                                  minidump_location=locations.get("minidump"))
 
         return JsonResponse({"id": envelope_headers["event_id"]})
 
@@ -1039,8 +1326,8 @@ class IngestSecurityAPIView(BaseIngestAPIView):
         performance_logger.info("ingested CSP report with %s bytes", len(body_bytes))
 
         try:
-            payload = json.loads(body_bytes)
-        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            payload = bugsink_json.loads(body_bytes)
+        except (bugsink_json.JSONDecodeError, UnicodeDecodeError) as e:
             raise ParseError("invalid JSON in CSP report: %s" % e)
 
         if not isinstance(payload, dict) or not isinstance(payload.get("csp-report"), dict):
@@ -1051,13 +1338,10 @@ class IngestSecurityAPIView(BaseIngestAPIView):
         event_id = uuid.uuid4().hex
         event_data = self._csp_report_to_event_data(event_id, report, ingested_at)
 
-        filename = get_filename_for_event_id(ingestion_id)
-        b108_makedirs(os.path.dirname(filename))
-        with open(filename, 'w') as f:
-            json.dump(event_data, f)
+        location = write_spooled(ingestion_id, bugsink_json.dumpb(event_data))
 
         event_metadata = self.get_event_meta(event_id, ingested_at, ingestion_id, request, project)
-        digest.delay(event_id, event_metadata)
+        self.enqueue_digest(event_metadata, {"event": location})
 
         return HttpResponse()
 
@@ -580,6 +580,8 @@ class IssueQuerysetStateManager(object):
             return
 
         mark_issues_for_deletion(issue_project_pairs)
+
+        # (called from the issue-list views, i.e. inside an immediate_atomic: these end up in a single delay_many)
         for issue_id, project_id in issue_project_pairs:
             delay_on_commit(delete_issue_deps, str(project_id), str(issue_id))
 
@@ -12,6 +12,9 @@ from unittest.mock import patch
 from datetime import datetime, timedelta, timezone
 from zipfile import ZIP_DEFLATED, ZipFile
 
+import ecma426
+from ecma426.model import Mapping
+
 from django.test import TestCase as DjangoTestCase
 from django.contrib.auth import get_user_model
 from django.test import tag
@@ -33,6 +36,8 @@ from tags.models import store_tags
 from tags.tasks import vacuum_tagvalues
 from events.markdown_stacktrace import render_stacktrace_md
 from files.models import File, FileMetadata
+from files.sourcemap_cache import clear_sourcemap_cache
+from files.sourcemap_index import SOURCEMAP_INDEX_FILE_TYPE
 from events.usage import record_event_counts
 
 from .models import (
@@ -437,6 +442,7 @@ class ViewTests(TransactionTestCase):
         self.issue, _ = get_or_create_issue(self.project)
         self.event = create_event(self.project, self.issue, project_digest_order=1)
         self.client.force_login(self.user)
+        clear_sourcemap_cache()  # parsed sourcemaps are cached by checksum, whereas the tests mock the parsing
 
     def test_issue_list_view(self):
         response = self.client.get(f"/issues/{self.project.id}/")
@@ -693,7 +699,7 @@ class ViewTests(TransactionTestCase):
         response = self.client.get(f"/issues/issue/{self.issue.id}/events/")
         self.assertContains(response, self.issue.title())
 
-    @patch("events.utils.ecma426.loads")
+    @patch("files.sourcemap_cache.ecma426.loads")
     def test_use_sourcemap_in_stacktrace(self, mock_ecma426_loads):
         # Single integration test that covers all three sourcemap outcomes in one stacktrace:
         # * debug ID present but sourcemap missing
@@ -746,10 +752,14 @@ class ViewTests(TransactionTestCase):
                 self.original_column = original_column
 
         class BrokenSourceMap:
+            tokens = []
+
             def lookup_left(self, *_args, **_kwargs):
                 raise KeyError((10, 36758))
 
         class GoodSourceMap:
+            tokens = []
+
             def lookup_left(self, line, column):
                 if (line, column) == (5, 11):
                     return FakeMapping(10, 0)
@@ -761,10 +771,13 @@ class ViewTests(TransactionTestCase):
         def fake_loads(data):
             sm = json.loads(data)
             if sm["x_kind"] == "broken":
-                return BrokenSourceMap()
-            if sm["x_kind"] == "good":
-                return GoodSourceMap()
-            raise AssertionError(f"unknown sourcemap marker: {sm.get('x_kind')}")
+                result = BrokenSourceMap()
+            elif sm["x_kind"] == "good":
+                result = GoodSourceMap()
+            else:
+                raise AssertionError(f"unknown sourcemap marker: {sm.get('x_kind')}")
+            result.raw = sm  # like ecma426's MappingIndex, which keeps the parsed JSON around
+            return result
 
         mock_ecma426_loads.side_effect = fake_loads
 
@@ -813,7 +826,7 @@ class ViewTests(TransactionTestCase):
         self.assertContains(response, "zero-column.js</span> line <span class=\"font-bold\">5</span>.")
         self.assertContains(response, "no-column.js</span> line <span class=\"font-bold\">4</span>.")
 
-    @patch("events.utils.ecma426.loads")
+    @patch("files.sourcemap_cache.ecma426.loads")
     def test_use_sourcemap_in_stacktrace_with_null_sources_content(self, mock_ecma426_loads):
         debug_id = uuid.uuid4()
 
@@ -843,11 +856,18 @@ class ViewTests(TransactionTestCase):
             name = "mappedFunction"
 
         class GoodSourceMap:
+            tokens = []
+
             def lookup_left(self, line, column):
                 if (line, column) == (5, 11):
                     return FakeMapping()
 
-        mock_ecma426_loads.return_value = GoodSourceMap()
+        def fake_loads(data):
+            result = GoodSourceMap()
+            result.raw = json.loads(data)  # like ecma426's MappingIndex, which keeps the parsed JSON around
+            return result
+
+        mock_ecma426_loads.side_effect = fake_loads
 
         event_data = {
             "event_id": uuid.uuid4().hex,
@@ -877,20 +897,17 @@ class ViewTests(TransactionTestCase):
         self.assertContains(response, "good-source.ts")
         self.assertContains(response, "mappedFunction</span> line <span class=\"font-bold\">11:1</span>")
 
-    @patch("events.utils.ecma426.loads")
-    def test_sourcemap_uploads_are_project_scoped_when_rendering_events(self, mock_ecma426_loads):
+    def test_sourcemap_uploads_are_project_scoped_when_rendering_events(self):
         debug_id = uuid.uuid4()
         auth_token = AuthToken.objects.create()
         other_project = Project.objects.create(name="other")
         ProjectMembership.objects.create(project=other_project, user=self.user, accepted=True)
         other_issue, _ = get_or_create_issue(other_project)
-        sourcemap = json.dumps({
-            "version": 3,
-            "sources": ["other-project-source.ts"],
-            "sourcesContent": ["other project source"],
-            "names": [],
-            "mappings": "",
-        })
+
+        # a real (not mocked) sourcemap: on upload, it's turned into a lookup index, which is what rendering uses.
+        sourcemap = ecma426.encode([Mapping(5, 11, "other-project-source.ts", 0, 0, "mappedFunction")])
+        sourcemap["sourcesContent"] = ["other project source"]
+        sourcemap = json.dumps(sourcemap)
         bundle = BytesIO()
         with ZipFile(bundle, "w", compression=ZIP_DEFLATED) as zf:
             zf.writestr("manifest.json", json.dumps({
@@ -923,19 +940,8 @@ class ViewTests(TransactionTestCase):
             headers={"Authorization": f"Bearer {auth_token.token}"},
         )
         self.assertEqual(200, response.status_code)
-
-        class FakeMapping:
-            source = "other-project-source.ts"
-            original_line = 0
-            original_column = 0
-            name = "mappedFunction"
-
-        class GoodSourceMap:
-            def lookup_left(self, line, column):
-                if (line, column) == (5, 11):
-                    return FakeMapping()
-
-        mock_ecma426_loads.return_value = GoodSourceMap()
+        self.assertTrue(FileMetadata.objects.filter(
+            project=other_project, debug_id=debug_id, file_type=SOURCEMAP_INDEX_FILE_TYPE).exists())
 
         event_data = {
             "event_id": uuid.uuid4().hex,
@@ -1172,22 +1178,20 @@ class IssueDeletionTestCase(TransactionTestCase):
         self.project = Project.objects.create(
             name="Test Project", stored_event_count=1, issue_count=1)  # 1, in prep. of the below
         self.issue, _ = get_or_create_issue(self.project)
-        self.event = create_event(self.project, issue=self.issue, project_digest_order=1)
+        self.event = create_event(self.project, issue=self.issue, project_digest_order=1, never_evict=True)
 
         TurningPoint.objects.create(
             project=self.project,
             issue=self.issue, triggering_event=self.event, timestamp=self.event.ingested_at,
             kind=TurningPointKind.FIRST_SEEN)
 
-        self.event.never_evict = True
-        self.event.save()
-
         store_tags(self.event, self.issue, {"foo": "bar"})
         record_event_counts(self.project, self.issue, self.event.digested_at, self.event.digest_order)
 
     def test_delete_issue(self):
         models = [apps.get_model(app_label=s.split('.')[0], model_name=s.split('.')[1].lower()) for s in [
             'events.Event', 'events.IssueEventCountsPerHour', 'issues.Grouping', 'issues.TurningPoint', 'tags.EventTag',
+            'events.ProjectEventCountsForEviction',
             'issues.Issue', 'tags.IssueTag',
             'tags.TagValue',  # TagValue 'feels like' a vacuum_model (FKs reversed) but is cleaned up in `prune_orphans`
         ]]
@@ -1206,7 +1210,7 @@ class IssueDeletionTestCase(TransactionTestCase):
         # correct for bugsink/transaction.py's select_for_update for non-sqlite databases
         correct_for_select_for_update = 1 if 'sqlite' not in settings.DATABASES['default']['ENGINE'] else 0
 
-        with self.assertNumQueries(22 + correct_for_select_for_update):
+        with self.assertNumQueries(25 + correct_for_select_for_update):
             self.issue.delete_deferred()
 
         # tests run w/ TASK_ALWAYS_EAGER, so in the below we can just check the database directly
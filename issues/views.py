@@ -29,6 +29,7 @@ from events.ua_stuff import get_contexts_enriched_with_ua
 
 from projects.models import ProjectMembership, get_issue_accessible_project_ids
 from tags.search import search_issues, search_events, search_events_optimized
+from tags.models import DeferredEventTags
 from theme.templatetags.issues import timestamp_with_millis
 
 from .models import (
@@ -442,7 +443,8 @@ def issue_event_stacktrace(request, issue, event_pk=None, digest_order=None, nav
         sentry_sdk.capture_exception(e)
 
     try:
-        apply_sourcemaps(parsed_data, issue.project)
+        if not event.sourcemaps_applied:  # if applied on digest, the stored event is in applied form already
+            apply_sourcemaps(parsed_data, issue.project)
     except Exception as e:
         if settings.DEBUG or settings.I_AM_RUNNING == "TEST":
             # when developing/testing, I _do_ want to get notified
@@ -737,6 +739,8 @@ def issue_tags(request, issue):
         "tab": "tags",
         "project": issue.project,
         "issue": issue,
+        # DEFERRED_TAG_DIGESTION: events whose tags are not yet reflected below
+        "deferred_tags_count": DeferredEventTags.objects.filter(issue_id=issue.id).count(),
         "is_event_page": False,
         "request_repr": _request_repr(last_event.get_parsed_data()) if last_event is not None else "",
         "mute_options": GLOBAL_MUTE_OPTIONS,
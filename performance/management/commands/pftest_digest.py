@@ -0,0 +1,51 @@
+import json
+import time
+import uuid
+from datetime import datetime, timezone
+
+from django.core.management.base import BaseCommand
+
+from bugsink.transaction import get_stat
+from compat.timestamp import format_timestamp
+from ingest.views import BaseIngestAPIView
+from projects.models import Project
+
+
+class Command(BaseCommand):
+    help = """Measure the time spent holding the write lock while digesting (actually: inside the 'immediate' digest
+    transaction), with the event prepared inside of the transaction (as before the prepare/digest split) and outside of
+    it. Digests the given event (with fresh event_ids) into the given project; i.e. not for use on production data."""
+
+    def add_arguments(self, parser):
+        parser.add_argument("--project", type=int, required=True)
+        parser.add_argument("--events", type=int, default=100)
+        parser.add_argument("filename")
+
+    def handle(self, *args, **options):
+        project = Project.objects.get(pk=options["project"])
+
+        with open(options["filename"]) as f:
+            event_data_template = f.read()
+
+        for prepare_outside in [False, True]:
+            lock_time_before = get_stat("immediate_transaction")
+            t0 = time.time()
+
+            for i in range(options["events"]):
+                event_data = json.loads(event_data_template)
+                event_data["event_id"] = uuid.uuid4().hex
+                event_metadata = {
+                    "event_id": event_data["event_id"],
+                    "project_id": project.id,
+                    "ingested_at": format_timestamp(datetime.now(timezone.utc)),
+                }
+
+                prepared = BaseIngestAPIView.prepare_event(event_metadata, event_data) if prepare_outside else None
+                BaseIngestAPIView.digest_event(event_metadata, event_data, prepared=prepared)
+
+            total_time = (time.time() - t0) * 1000
+            lock_time = (get_stat("immediate_transaction") - lock_time_before) * 1000
+
+            print("prepared %s the transaction:" % ("outside" if prepare_outside else "inside"))
+            print("  under lock: %8.2fms total, %6.2fms per event" % (lock_time, lock_time / options["events"]))
+            print("  wall time:  %8.2fms total, %6.2fms per event" % (total_time, total_time / options["events"]))
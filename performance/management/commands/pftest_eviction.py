@@ -0,0 +1,155 @@
+import logging
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, reset_queries
+from django.test.utils import setup_databases, teardown_databases
+
+from bugsink.transaction import immediate_atomic
+from bugsink.utils import nc_rnd
+from performance.bursty_data import generate_bursty_data, buckets_to_points_in_time
+from performance.context_managers import time_and_query_count
+
+
+class Command(BaseCommand):
+    help = """Replay a (bursty) stream of synthetic events through the actual retention code (get_random_irrelevance,
+    should_evict, evict_for_max_events) against a scratch SQLite DB, and report on time and queries per eviction,
+    the worst-case time the write lock was held, and the resulting age/irrelevance distribution. Meant for comparing
+    retention tuning and index changes with numbers."""
+
+    def add_arguments(self, parser):
+        parser.add_argument("--events", type=int, default=100_000)
+        parser.add_argument("--max-event-count", type=int, default=10_000, help="The project's retention max")
+        parser.add_argument("--issues", type=int, default=100)
+        parser.add_argument("--days", type=int, default=30, help="The period over which the events are spread")
+        parser.add_argument("--bursts", type=int, default=10, help="Expected number of bursts in that period")
+        parser.add_argument(
+            "--db", default="/tmp/bugsink-pftest-eviction.sqlite3",
+            help="Scratch database (created, and thrown away at the end); use ':memory:' to not touch disk at all")
+
+    def handle(self, *args, **options):
+        if "sqlite" not in settings.DATABASES["default"]["ENGINE"]:
+            raise CommandError("This command only supports SQLite")
+
+        # we use Django's test-database machinery to get a fresh (migrated) DB that's guaranteed not to be the real one.
+        settings.DATABASES["default"].setdefault("TEST", {})["NAME"] = options["db"]
+        old_config = setup_databases(verbosity=0, interactive=False, aliases=["default"])
+        try:
+            self.simulate(options)
+        finally:
+            teardown_databases(old_config, verbosity=0)
+
+    def simulate(self, options):
+        # imports here, i.e. after the scratch DB is in place (not strictly needed, but it makes the point).
+        from events.factories import create_event_data
+        from events.models import Event
+        from events.retention import (
+            get_random_irrelevance, should_evict, evict_for_max_events, record_event_for_eviction,
+            get_epoch_bounds_with_irrelevance, get_eviction_histogram)
+        from issues.factories import get_or_create_issue
+        from projects.models import Project
+
+        connection.force_debug_cursor = True  # for the query counts of time_and_query_count
+        logging.getLogger("bugsink.performance").setLevel(logging.WARNING)  # we report ourselves, at the end
+
+        project = Project.objects.create(name="pftest_eviction", retention_max_event_count=options["max_event_count"])
+        issues = []
+        for i in range(options["issues"]):
+            issue, _ = get_or_create_issue(project, create_event_data(exception_type="Exception%d" % i))
+            issues.append((issue, issue.grouping_set.get()))
+
+        # a long-tail distribution of events over issues, as observed in practice: few issues with many events.
+        issue_weights = [1 / (i + 1) for i in range(len(issues))]
+
+        end = datetime.now(timezone.utc)
+        begin = end - timedelta(days=options["days"])
+        buckets = generate_bursty_data(
+            nr_of_waves=options["days"], expected_nr_of_bursts=options["bursts"], num_buckets=options["days"] * 24)
+        points = buckets_to_points_in_time(buckets, begin, end, options["events"])
+
+        stored_per_issue = {issue.id: 0 for issue, _ in issues}
+        digest_order_per_issue = {issue.id: 0 for issue, _ in issues}
+        stored_event_count = 0
+        evictions = []  # (took, query count, evicted) per eviction
+
+        print("replaying %d events over %d issues; max %d" % (len(points), len(issues), options["max_event_count"]))
+        for i, digested_at in enumerate(points):
+            issue, grouping = nc_rnd.choices(issues, weights=issue_weights)[0]
+
+            # the key bits of digest_event, in the same order
+            stored_event_count += 1
+            if should_evict(project, digested_at, stored_event_count):
+                reset_queries()
+                with time_and_query_count() as phase:
+                    with immediate_atomic():  # i.e. phase.took is the time the write lock is held
+                        evicted = evict_for_max_events(project, digested_at, stored_event_count)
+
+                evictions.append((phase.took, phase.count, evicted.total))
+                for issue_id, count in evicted.per_issue.items():
+                    stored_per_issue[issue_id] -= count
+                stored_event_count -= evicted.total
+
+            stored_per_issue[issue.id] += 1
+            digest_order_per_issue[issue.id] += 1
+
+            event = Event.objects.create(
+                project=project,
+                issue=issue,
+                grouping=grouping,
+                ingested_at=digested_at,
+                digested_at=digested_at,
+                timestamp=digested_at,
+                event_id=uuid.uuid4().hex,
+                data="",
+                digest_order=digest_order_per_issue[issue.id],
+                irrelevance_for_retention=get_random_irrelevance(stored_per_issue[issue.id]),
+            )
+            record_event_for_eviction(event)
+
+            if (i + 1) % 10_000 == 0:
+                print("  %d events, %d stored, %d evictions" % (i + 1, stored_event_count, len(evictions)))
+
+        self.report_evictions(evictions)
+
+        bounds = get_epoch_bounds_with_irrelevance(project, end, {})
+        self.report_distribution(bounds, get_eviction_histogram(project, bounds, include_never_evict=True))
+
+    def report_evictions(self, evictions):
+        if not evictions:
+            print("no evictions; use more --events or a lower --max-event-count")
+            return
+
+        tooks = sorted(took for took, _, _ in evictions)
+        counts = [count for _, count, _ in evictions]
+        evicted = sum(e for _, _, e in evictions)
+
+        print()
+        print("%d evictions, %d events evicted (%.1f per eviction)" % (
+            len(evictions), evicted, evicted / len(evictions)))
+        print("  queries per eviction: %6.1f avg, %d max" % (sum(counts) / len(counts), max(counts)))
+        print("  time per eviction:    %6.2fms avg, %6.2fms median, %6.2fms p99" % (
+            sum(tooks) / len(tooks), tooks[len(tooks) // 2], tooks[int(len(tooks) * .99)]))
+        print("  worst-case lock hold: %6.2fms" % tooks[-1])
+
+    def report_distribution(self, bounds, histogram):
+        # rows: event irrelevance; columns: age-based irrelevance (i.e. age buckets, newest first); cells: event counts.
+        max_irrelevance = max((event_irrelevance for _, event_irrelevance in histogram), default=0)
+
+        print()
+        print("stored events by irrelevance (rows) and age (columns, in hours)")
+        print("%5s " % "" + " ".join("%8s" % self.format_age_bucket(lb, ub, bounds[0][0][0]) for (lb, ub), _ in bounds))
+        for event_irrelevance in range(max_irrelevance + 1):
+            print("%5d " % event_irrelevance + " ".join(
+                "%8d" % histogram.get((age_based_irrelevance, event_irrelevance), 0)
+                for _, age_based_irrelevance in bounds))
+
+    def format_age_bucket(self, lb, ub, current_epoch):
+        if current_epoch is None:
+            return "all"
+        if ub is None:
+            return "0"
+        if lb is None:
+            return "%d+" % (current_epoch - ub + 1)
+        return "%d-%d" % (current_epoch - ub + 1, current_epoch - lb)
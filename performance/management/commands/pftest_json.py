@@ -0,0 +1,43 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from bugsink import json
+
+
+class Command(BaseCommand):
+    help = """Measure encoding/decoding time for each of the available JSON backends (see bugsink/json.py) on the given
+    event files (i.e. the same files you'd pass to send_json or stress_test)."""
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rounds", type=int, default=100)
+        parser.add_argument("filenames", nargs="+")
+
+    def handle(self, *args, **options):
+        rounds = options["rounds"]
+
+        samples = []
+        for filename in options["filenames"]:
+            with open(filename, "rb") as f:
+                raw = f.read()
+            samples.append((raw, json.loads(raw)))
+
+        total_size = sum(len(raw) for raw, _ in samples)
+        print("%d files, %d bytes in total, %d rounds" % (len(samples), total_size, rounds))
+
+        for backend in json.BACKENDS:
+            t0 = time.time()
+            for i in range(rounds):
+                for raw, _ in samples:
+                    backend.loads(raw)
+            loads_time = (time.time() - t0) * 1000
+
+            t0 = time.time()
+            for i in range(rounds):
+                for _, parsed in samples:
+                    backend.dumpb(parsed)
+            dumpb_time = (time.time() - t0) * 1000
+
+            print("%s:" % backend.name)
+            print("  loads: %8.2fms total, %6.3fms per file" % (loads_time, loads_time / (rounds * len(samples))))
+            print("  dumpb: %8.2fms total, %6.3fms per file" % (dumpb_time, dumpb_time / (rounds * len(samples))))
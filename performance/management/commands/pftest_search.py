@@ -142,6 +142,19 @@ class Command(BaseCommand):
             f"{Issue.objects.get(pk='ae3701e3-a240-4ece-b09c-f97222116155').event_set.all().count()} events"
             )
 
+        # the rarest term is last in the query; the intersection should start from it regardless (selectivity-order)
+        self._test_url(
+            '/issues/issue/ae3701e3-a240-4ece-b09c-f97222116155/event/last/?q=random%3Avalue-B+tag2%3Avalue-B+trace%3Af2984643c22379983eb20f1a13529bc5', # noqa E501
+            "Many-event issue, AND-ing common tags (50% each) with a single-event-matching tag (trace)",
+            f"{Issue.objects.get(pk='ae3701e3-a240-4ece-b09c-f97222116155').event_set.all().count()} events"
+            )
+
+        self._test_url(
+            '/issues/issue/ae3701e3-a240-4ece-b09c-f97222116155/events/?q=random%3Avalue-B+tag2%3Avalue-B+tag3%3Avalue-B', # noqa E501
+            "Many-event issue, AND-ing the tags (50% each); event-list page",
+            f"{Issue.objects.get(pk='ae3701e3-a240-4ece-b09c-f97222116155').event_set.all().count()} events"
+            )
+
         self._test_url(
             '/issues/issue/ae3701e3-a240-4ece-b09c-f97222116155/event/51773/prev/?q=random%3Avalue-B',
             "Many-event issue, search, prev",
@@ -10,6 +10,7 @@ from bugsink.utils import assert_
 from bugsink.app_settings import get_settings
 from issues.grouping_mechanisms import GROUPING_TRANSITION_PERIOD, get_grouping_mechanism
 from teams.models import TeamMembership
+from users.forms import TRUE_FALSE_CHOICES
 from bsmain.utils import yesno
 
 from .models import Project, ProjectMembership, ProjectRole
@@ -84,6 +85,12 @@ class ProjectForm(forms.ModelForm):
     slug = forms.CharField(label="Slug", disabled=True)
     dsn = forms.CharField(label="DSN", disabled=True)
 
+    # as in users.forms.PreferencesForm: a ChoiceField rather than a checkbox, for display purposes
+    apply_sourcemaps_on_digest = forms.TypedChoiceField(
+        label=_("Apply sourcemaps on digest"), choices=TRUE_FALSE_CHOICES, coerce=lambda value: value == "True",
+        required=False, empty_value=False, widget=forms.Select(),
+        help_text=Project._meta.get_field("apply_sourcemaps_on_digest").help_text)
+
     def __init__(self, *args, **kwargs):
         team_qs = kwargs.pop("team_qs", None)
         super().__init__(*args, **kwargs)
@@ -158,7 +165,8 @@ class ProjectForm(forms.ModelForm):
     class Meta:
         model = Project
 
-        fields = ["team", "name", "visibility", "retention_max_event_count", "grouping_mechanism"]
+        fields = ["team", "name", "visibility", "retention_max_event_count", "grouping_mechanism",
+                  "apply_sourcemaps_on_digest"]
         # slug is shown read-only via an explicit (declared) field for edit; creation auto-generates it on the model.
         # If we ever make slug editable, we'd want JS like django/contrib/admin/static/admin/js/prepopulate.js.
 
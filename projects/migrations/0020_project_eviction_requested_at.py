@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 07:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('projects', '0019_alter_project_name_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='eviction_requested_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+    ]
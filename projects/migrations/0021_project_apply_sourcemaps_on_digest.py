@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 08:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('projects', '0020_project_eviction_requested_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='apply_sourcemaps_on_digest',
+            field=models.BooleanField(default=False),
+        ),
+    ]
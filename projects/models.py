@@ -125,6 +125,7 @@ class Project(models.Model):
 
     # retention
     retention_max_event_count = models.PositiveIntegerField(_("Retention max event count"), default=10_000)
+    eviction_requested_at = models.DateTimeField(null=True, blank=True, editable=False)  # see EVICTION_WATERMARKS
 
     # grouping policy
     grouping_mechanism = models.CharField(
@@ -140,6 +141,14 @@ class Project(models.Model):
     )
     grouping_mechanism_upgraded_at = models.DateTimeField(blank=True, null=True)
 
+    # sourcemaps: applied once, when the event is digested (and stored as such) rather than on each view of the event.
+    # Grouping then uses the original (unminified) locations. Sourcemaps uploaded after the event was digested are not
+    # applied to it.
+    apply_sourcemaps_on_digest = models.BooleanField(
+        _("Apply sourcemaps on digest"), default=False,
+        help_text=_("Apply sourcemaps when events come in (rather than when viewing them); grouping will then use the "
+                    "original source locations. Sourcemaps must be uploaded before the events come in."))
+
     def __str__(self):
         return self.name
 
@@ -178,7 +178,7 @@ class ProjectDeletionTestCase(TransactionTestCase):
         self.project = Project.objects.create(
             name="Test Project", stored_event_count=1, issue_count=1)  # 1, in prep. of the below
         self.issue, _ = get_or_create_issue(self.project)
-        self.event = create_event(self.project, issue=self.issue)
+        self.event = create_event(self.project, issue=self.issue, never_evict=True)
         self.user = User.objects.create_user(username='test', password='test')
 
         TurningPoint.objects.create(
@@ -192,9 +192,6 @@ class ProjectDeletionTestCase(TransactionTestCase):
         file = File.objects.create(checksum="a" * 40, filename="test.js.map", size=0)
         FileMetadata.objects.create(project=self.project, file=file)
 
-        self.event.never_evict = True
-        self.event.save()
-
         store_tags(self.event, self.issue, {"foo": "bar"})
         record_event_counts(self.project, self.issue, self.event.digested_at, self.event.digest_order)
 
@@ -207,6 +204,7 @@ class ProjectDeletionTestCase(TransactionTestCase):
                   "issues.TurningPoint",
                   "events.IssueEventCountsPerHour",
                   "events.ProjectEventCountsPerHour",
+                  "events.ProjectEventCountsForEviction",
                   "events.Event",
                   "issues.Grouping",
                   "files.FileMetadata",
@@ -227,7 +225,7 @@ class ProjectDeletionTestCase(TransactionTestCase):
         # correct for bugsink/transaction.py's select_for_update for non-sqlite databases
         correct_for_select_for_update = 1 if 'sqlite' not in settings.DATABASES['default']['ENGINE'] else 0
 
-        with self.assertNumQueries(33 + correct_for_select_for_update):
+        with self.assertNumQueries(35 + correct_for_select_for_update):
             self.project.delete_deferred()
 
         # tests run w/ TASK_ALWAYS_EAGER, so in the below we can just check the database directly
@@ -275,6 +273,7 @@ class ProjectDeletionTestCase(TransactionTestCase):
             (apps.get_model('tags', 'EventTag'), 'event'),
             (apps.get_model('events', 'ProjectEventCountsPerHour'), 'project'),
             (apps.get_model('events', 'IssueEventCountsPerHour'), 'project'),
+            (apps.get_model('events', 'ProjectEventCountsForEviction'), 'project'),
             (apps.get_model('tags', 'TagKey'), 'project'),
             (apps.get_model('tags', 'TagValue'), 'key'),
             (apps.get_model('tags', 'EventTag'), 'value'),
@@ -296,6 +295,7 @@ class ProjectDeletionTestCase(TransactionTestCase):
             (apps.get_model('issues', 'TurningPoint'), 'project'),
             (apps.get_model('events', 'IssueEventCountsPerHour'), 'project'),
             (apps.get_model('events', 'ProjectEventCountsPerHour'), 'project'),
+            (apps.get_model('events', 'ProjectEventCountsForEviction'), 'project'),
             (apps.get_model('events', 'Event'), 'project'),
             (apps.get_model('issues', 'Grouping'), 'project'),
             (apps.get_model('alerts', 'MessagingServiceConfig'), 'project'),
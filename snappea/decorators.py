@@ -1,6 +1,6 @@
 import logging
-import json
 
+from bugsink import json
 from performance.context_managers import time_to_logger
 
 from . import registry
@@ -38,5 +38,51 @@ def shared_task(function):
 
     name = function.__module__ + "." + function.__name__
     function.delay = delayed_function
+    function.delay_many = lambda args_list, **kwargs: delay_many([(function, args, kwargs) for args in args_list])
     registry[name] = function
     return function
+
+
+def delay_many(calls):
+    """
+    Like calling function.delay(*args, **kwargs) for each of the given (function, args, kwargs) triples (which must be
+    shared_tasks), but with a single (bulk) INSERT and a single wake-up call for all of them. The Tasks are created in
+    the given order, i.e. the Foreman picks them up in that order too.
+    """
+    if get_settings().TASK_ALWAYS_EAGER:
+        for function, args, kwargs in calls:
+            function.delay(*args, **kwargs)
+        return
+
+    if not calls:
+        return
+
+    with time_to_logger(performance_logger, "Snappea Task.bulk_create() of %d" % len(calls)):
+        # As for a single Task.create(), no transaction of our own: bulk_create is a single statement (for batches
+        # below sqlite's max-variables; Django splits larger ones, and wraps them in a transaction of its own).
+        Task.objects.bulk_create([
+            Task(
+                task_name=function.__module__ + "." + function.__name__,
+                args=json.dumps(args),
+                kwargs=json.dumps(dict(kwargs, **add_task_kwargs())),
+            )
+            for function, args, kwargs in calls
+        ])
+
+    # a single wake-up call suffices: wake-up calls mean "there may be new Tasks now", and are coalesced anyway.
+    wakeup_server()
+
+
+def batch_handler(task):
+    """
+    Registers the decorated function as the batch-variant of `task`. When MAX_BATCH_SIZE > 1, the Foreman may hand a
+    run of consecutive Tasks for `task` to a single worker, which calls the batch-variant with a list of the Tasks' args
+    (one list per Task). Tasks are only combined when their kwargs are equal; those kwargs are passed once.
+
+    Note that "eager" calls (TASK_ALWAYS_EAGER) never batch: they are executed one-by-one at .delay() time.
+    """
+    def decorator(batch_function):
+        task.batch_function = batch_function
+        return batch_function
+
+    return decorator
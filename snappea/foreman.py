@@ -1,23 +1,17 @@
-import contextlib
 import os
-import glob
-
-import uuid
 import sys
-import json
 import logging
 import time
 import signal
 import threading
-from inotify_simple import INotify, flags
 import sentry_sdk
 
 from django.conf import settings
 from django.db import connections
-from django.utils._os import safe_join
 
 from sentry_sdk_extensions import capture_or_log_exception
 from performance.context_managers import time_to_logger
+from bugsink import json
 from bugsink.transaction import durable_atomic, get_stat
 from bsmain.utils import b108_makedirs
 
@@ -25,7 +19,9 @@ from . import registry
 from .models import Task
 from .datastructures import Workers
 from .settings import get_settings
-from .utils import run_task_context
+from .wakeup import get_wakeup_backend
+from .processes import start_process_pool, stop_process_pool
+from .utils import run_task_context, run_startup_hook
 from .stats import Stats
 
 
@@ -40,6 +36,37 @@ def short_id(task_id):
     return f"{task_id:06}"[-6:-3] + "-" + f"{task_id:06}"[-3:]
 
 
+def is_batchable(task):
+    try:
+        return hasattr(registry[task.task_name], "batch_function")
+    except Exception:
+        # unknown/unimportable tasks are not batchable; the error itself is dealt with in create_workers
+        return False
+
+
+def get_runs(tasks, max_batch_size, is_batchable):
+    """
+    Splits `tasks` (in order) into runs that can be handed to a single worker: consecutive batchable Tasks with the same
+    task_name and kwargs, up to max_batch_size. Non-batchable Tasks always form a run of their own.
+    """
+    run = []
+    for task in tasks:
+        if run and (len(run) >= max_batch_size or task.task_name != run[0].task_name or task.kwargs != run[0].kwargs):
+            yield run
+            run = []
+
+        run.append(task)
+
+        if not is_batchable(task):
+            # for non-batchable tasks, the run is closed immediately, i.e. the task_name check above guarantees that
+            # runs of more than one task are batchable.
+            yield run
+            run = []
+
+    if run:
+        yield run
+
+
 class Foreman:
     """
     The Foreman starts workers, as (threading.Thread) threads, based on snappea.Task objects it finds in the sqlite
@@ -68,10 +95,11 @@ class Foreman:
     laptop: 1000 trivial tasks are finished enqueue-to-finished in a few seconds.
 
     The main idea is this endless loop of checking for new work and doing it. This leaves the question of how we "go to
-    sleep" when there is no more work and how we wake up from that. This is implemented using inotify on a directory
-    created specifically for that purpose (for each Task a file is dropped there) (and a blocking read on the INotify
-    object). Note that this idea is somewhat incidental though (0MQ or polling the DB in a busy loop are some
-    alternatives). Performance: write/inotify/delete of a single wake-up call is in the order of n*e-5 on my laptop.
+    sleep" when there is no more work and how we wake up from that. By default this is implemented using inotify on a
+    directory created specifically for that purpose (for each Task a file is dropped there) (and a blocking read on the
+    INotify object). Note that this idea is somewhat incidental though: a UNIX domain socket and polling the DB are
+    available as alternatives (see wakeup.py). Performance: write/inotify/delete of a single wake-up call is in the
+    order of n*e-5 on my laptop (see `benchmark_wakeup` for a comparison of the alternatives).
     """
 
     def __init__(self):
@@ -88,10 +116,9 @@ class Foreman:
         signal.signal(signal.SIGINT, self.handle_signal)
         signal.signal(signal.SIGTERM, self.handle_signal)
 
-        # We use inotify to wake up the Foreman when a new Task is created.
-        b108_makedirs(self.settings.WAKEUP_CALLS_DIR)
-        self.wakeup_calls = INotify()
-        self.wakeup_calls.add_watch(self.settings.WAKEUP_CALLS_DIR, flags.CREATE)
+        # Wake-up calls (e.g. inotify, see wakeup.py) wake up the Foreman when a new Task is created.
+        self.wakeup_calls = get_wakeup_backend()
+        self.wakeup_calls.listen()
 
         # Pid stuff
         pid = os.getpid()
@@ -108,7 +135,9 @@ class Foreman:
 
         logger.info("Startup: pid is %s", pid)
         logger.info("Startup: DB-as-MQ location: %s", settings.DATABASES["snappea"]["NAME"])
-        logger.info("Startup: Wake up calls location: %s", self.settings.WAKEUP_CALLS_DIR)
+        logger.info("Startup: Wake up calls: %s", self.wakeup_calls)
+        logger.info("Startup: Process pool size: %s", self.settings.PROCESS_POOL_SIZE)
+        start_process_pool()
 
         # Counts the number of "wake up" signals that have not been dealt with yet. The main loop goes to sleep when
         # this is 0
@@ -245,11 +274,10 @@ class Foreman:
             self.stopping = True
             self.stop_deadline = time.time() + self.settings.GRACEFUL_TIMEOUT
 
-        # Ensure that anything we might be waiting for is unblocked. A single notification file and .release call is
-        # enough because after every wakeup_calls.read() /  acquire call in our codebase the first thing we do is
+        # Ensure that anything we might be waiting for is unblocked. A single interrupt and .release call is enough
+        # because after every wakeup_calls.wait() /  acquire call in our codebase the first thing we do is
         # check_for_stopping(), so the release cannot be inadvertently be "used up" by something else.
-        with open(safe_join(self.settings.WAKEUP_CALLS_DIR, str(uuid.uuid4())), "w"):
-            pass
+        self.wakeup_calls.interrupt()
         self.worker_semaphore.release()
 
     def run_forever(self):
@@ -267,18 +295,21 @@ class Foreman:
             raise
 
     def _run_forever(self):
-        pre_existing_wakeup_notifications = glob.glob(safe_join(self.settings.WAKEUP_CALLS_DIR, "*"))
-        if len(pre_existing_wakeup_notifications) > 0:
-            # We clear the wakeup_calls_dir on startup. Not strictly necessary because such files would be cleared by in
-            # the loop anyway, but it's more efficient to do it first.
-            logger.info("Startup: Clearing %s items from wakeup dir", len(pre_existing_wakeup_notifications))
-            for filename in pre_existing_wakeup_notifications:
-                os.remove(filename)
+        cleared = self.wakeup_calls.clear()
+        if cleared > 0:
+            logger.info("Startup: Cleared %s pending wakeup calls", cleared)
 
         # Before we do our regular sleep-wake-check-do loop, we clear any outstanding work. wake up signals coming in
         # during this time-period will simply "count up" the semaphore even though the work is already being done. This
         # is not really a problem, we'll just notice that there is "No task found" an equal amount of times and go into
         # deep sleep after.
+        try:
+            run_startup_hook()
+        except Exception as e:
+            # recovery is best-effort: better to work on what we have than not to start at all.
+            logger.error("Startup: Error in startup hook")
+            capture_or_log_exception(e, logger)
+
         logger.info("Startup: Clearing Task backlog")
         while self.create_workers() == self.settings.TASK_QS_LIMIT:
             # `== TASK_QS_LIMIT` means we may have more work to do, because the [:TASK_QS_LIMIT] slice may be the reason
@@ -288,26 +319,9 @@ class Foreman:
         logger.info("Startup: Task backlog empty now, proceeding to main loop")
         while True:
             logger.debug("Main loop: Waiting for wakeup call")
-            for event in self.wakeup_calls.read():
-                logger.debug("Main loop: Removing wakeup notification %s", event.name)
-                # I used to think we could just do os.unlink(), without being afraid of an error either here or on the
-                # side where we write the file. I don't have a link to the man page to back this up, but when running
-                # "many" calls (using 2 processes with each simple tight loop, one creating the files and one deleting
-                # them, I did not get any errors). However, later I did get an error in production:
-                # https://dogfood.bugsink.com/issues/issue/48055b00-ddc3-4148-b77a-52379d6d8233/event/last/
-                # I find it really hard to understand where this error came from... AFAICT the following would always
-                # happen in sequence:
-                # * if not exists
-                # * create          (optional on the previous)
-                # * creation detected through inotify
-                # * delete.
-                # A point of debuggin could be: adding the result of self.wakeup_calls.read() to the local variables
-                # such that dogfood Bugsink will pick up on it. But in the end it's not really that relevant (despite
-                # being interesting) so I just catch the error.
-                with contextlib.suppress(FileNotFoundError):
-                    os.unlink(safe_join(self.settings.WAKEUP_CALLS_DIR, event.name))
-
-            self.check_for_stopping()  # check after .read() - it may have unblocked via handle_signal()
+            self.wakeup_calls.wait()
+
+            self.check_for_stopping()  # check after .wait() - it may have unblocked via handle_signal()
             while self.create_workers() == self.settings.TASK_QS_LIMIT:
                 pass  # `== TASK_QS_LIMIT`: as documented above
 
@@ -346,9 +360,12 @@ class Foreman:
             # Note the list(...) in the below to ensure the QS is evaluated inside the transaction.
             tasks = list(Task.objects.all()[:self.settings.TASK_QS_LIMIT])
 
-        task_i = -1
-        for task_i, task in enumerate(tasks):
-            logger.debug("Create workers: Creating worker for with task %s", short_id(task.id))
+        task_count = 0
+        for run in get_runs(tasks, self.settings.MAX_BATCH_SIZE, is_batchable):
+            task_count += len(run)
+
+            task = run[0]
+            logger.debug("Create workers: Creating worker for with task %s (run of %s)", short_id(task.id), len(run))
             logger.debug("Create workers: Checking (maybe waiting) for available worker slots")
             self.worker_semaphore.acquire()
             logger.debug("Create workers: Worker slot available")
@@ -357,30 +374,38 @@ class Foreman:
             task_id = task.id
             try:
                 function = registry[task.task_name]
-                args = json.loads(task.args)
+                if len(run) > 1:
+                    # the batch-variant gets a single list-of-args (one per Task); kwargs are equal across the run
+                    function = function.batch_function
+                    args = [[json.loads(t.args) for t in run]]
+                else:
+                    args = json.loads(task.args)
                 kwargs = json.loads(task.kwargs)
             except Exception as e:
                 logger.error('Create workers: can\'t execute "%s": %s', task.task_name, e)
                 with time_to_logger(performance_logger, "Snappea delete Task"):
-                    task.delete()  # we delete the task because we can't do anything with it, and we don't want to hang
+                    # we delete the task(s) because we can't do anything with it, and we don't want to hang
+                    Task.objects.filter(id__in=[t.id for t in run]).delete()
                 capture_or_log_exception(e, logger)
                 self.worker_semaphore.release()
                 continue
 
             self.check_for_stopping()  # check_for_stopping() right before taking on the work
 
-            # notes on task.delete()  (mostly apply to task.delete in the except-statement above too)
-            # * no explicit transaction needed, autocommit is fine: we're the only ones touching this row in the DB
+            # notes on task deletion  (mostly apply to the delete in the except-statement above too)
+            # * no explicit transaction needed, autocommit is fine: we're the only ones touching these rows in the DB
             #       (see 'counterpoint' in decorators.py for a counterpoint)
-            # * delete-before-run is the implementation of our at-most-once guarantee
+            # * delete-before-run is the implementation of our at-most-once guarantee; for runs, the whole run is
+            #       deleted in a single query, i.e. batching also amortizes the cost of this delete.
             with time_to_logger(performance_logger, "Snappea Task.delete()"):
                 # observed timings: ~1.5ms, see also: https://www.bugsink.com/blog/snappea-design/#throughput
-                task.delete()
+                if len(run) > 1:
+                    Task.objects.filter(id__in=[t.id for t in run]).delete()
+                else:
+                    task.delete()
 
             self.run_in_thread(task_id, function, *args, **kwargs)
 
-        task_count = task_i + 1
-
         if task_count == 0:
             # We occassionally want to close the connection to the DB-as-MQ, to allow for cleanups of the WAL file. (It
             # is reopened automatically as needed). A good time for this is: when we had no work to do.
@@ -427,6 +452,9 @@ class Foreman:
                         "Stopping: %s did not die in %.1fs, proceeding to kill",
                         short_id(task_id), self.settings.GRACEFUL_TIMEOUT)
 
+        self.wakeup_calls.close()
+        stop_process_pool()
+
         if self.settings.PID_FILE is not None:
             logger.info("Stopping: removing PID file %s", self.settings.PID_FILE)
             os.remove(self.settings.PID_FILE)
@@ -0,0 +1,85 @@
+import os
+import tempfile
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+
+from snappea.wakeup import InotifyWakeup, SocketWakeup, PollingWakeup
+
+
+class Command(BaseCommand):
+    help = """Compare the wake-up call backends (see snappea/wakeup.py) on this system.
+
+    For each backend, measures the cost of notify() (i.e. what each Task.delay() pays) and the round trip (notify until
+    a waiting Foreman-side wait() returns). Uses its own temporary directory/socket, i.e. does not interfere with a
+    running Foreman."""
+
+    def add_arguments(self, parser):
+        parser.add_argument("--backend", nargs="+", choices=["inotify", "socket", "polling"],
+                            default=["inotify", "socket", "polling"])
+        parser.add_argument("--notifications", type=int, default=10_000)
+        parser.add_argument("--roundtrips", type=int, default=1_000)
+        parser.add_argument("--poll-interval", type=float, default=0.1)
+
+    def handle(self, *args, **options):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for name in options["backend"]:
+                if name == "inotify":
+                    backend = InotifyWakeup(os.path.join(tmpdir, "wakeup"))
+                elif name == "socket":
+                    backend = SocketWakeup(os.path.join(tmpdir, "wakeup.sock"))
+                else:
+                    backend = PollingWakeup(options["poll_interval"])
+
+                # polling round trips take POLL_INTERVAL by construction; no need to spend minutes on confirming that.
+                roundtrips = options["roundtrips"] if name != "polling" else min(options["roundtrips"], 10)
+
+                self.benchmark(backend, options["notifications"], roundtrips)
+
+    def benchmark(self, backend, notifications, roundtrips):
+        backend.listen()
+        try:
+            t0 = time.perf_counter()
+            for i in range(notifications):
+                backend.notify()
+            notify_time = time.perf_counter() - t0
+
+            # 'run' a Foreman-side loop in a thread, signalling each wake-up back to the measuring side.
+            backend.clear()
+            woken = threading.Event()
+            stopping = False
+
+            def foreman():
+                while True:
+                    backend.wait()
+                    if stopping:
+                        return
+                    woken.set()
+
+            foreman_thread = threading.Thread(target=foreman, daemon=True)
+            foreman_thread.start()
+
+            timings = []
+            for i in range(roundtrips):
+                woken.clear()
+                t0 = time.perf_counter()
+                backend.notify()
+                woken.wait()
+                timings.append(time.perf_counter() - t0)
+
+            stopping = True
+            backend.interrupt()
+            foreman_thread.join()
+
+        finally:
+            backend.close()
+
+        timings.sort()
+        print("%s" % backend)
+        print("  notify:     %.1fµs avg (%d calls)" % (notify_time / notifications * 1_000_000, notifications))
+        print("  round trip: %.1fµs avg, %.1fµs 50th, %.1fµs 99th (%d round trips)" % (
+            sum(timings) / len(timings) * 1_000_000,
+            timings[len(timings) // 2] * 1_000_000,
+            timings[int(len(timings) * 0.99)] * 1_000_000,
+            len(timings)))
@@ -1,11 +1,6 @@
-import os
-
 from django.db import models
-from django.utils._os import safe_join
-from bsmain.utils import b108_makedirs
 
-from .settings import get_settings
-from . import thread_uuid
+from .wakeup import get_wakeup_backend
 
 
 class Task(models.Model):
@@ -46,10 +41,4 @@ class Stat(models.Model):
 
 
 def wakeup_server():
-    wakeup_file = safe_join(get_settings().WAKEUP_CALLS_DIR, thread_uuid)
-
-    b108_makedirs(get_settings().WAKEUP_CALLS_DIR)
-
-    if not os.path.exists(wakeup_file):
-        with open(wakeup_file, "w"):
-            pass
+    get_wakeup_backend().notify()
@@ -0,0 +1,96 @@
+import logging
+import multiprocessing
+import signal
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from .settings import get_settings
+
+logger = logging.getLogger("snappea.foreman")
+
+
+# Snappea's workers are threads, i.e. any CPU-bound work they do is serialized by the GIL. Tasks can hand such work to
+# a pool of processes using `run_cpu_bound`. The worker thread stays in charge (at-most-once semantics, per-task Stats,
+# run_task_context, DB-access), and simply blocks on the result.
+#
+# The pool is only started by the Foreman, and only when PROCESS_POOL_SIZE > 0; in all other cases (the Foreman with
+# PROCESS_POOL_SIZE = 0, the server, TASK_ALWAYS_EAGER, tests) run_cpu_bound just calls the function. This means that
+# functions passed to run_cpu_bound must be correct in both places. In particular they must not touch the DB (a pool
+# process has its own connections, outside of the worker's transaction), and their args and results should be cheap to
+# pickle (i.e. ideally: the work done is large compared to its in- and output).
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _initialize_process():
+    # Signals are the Foreman's business (which shuts down the pool as part of its own graceful shutdown); a Ctrl-C in
+    # a terminal is sent to the whole process group though, so we must explicitly ignore it here.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    # "spawn" (see below) means our processes start from scratch, i.e. Django needs to be set up for any function that
+    # relies on settings or imports models. DJANGO_SETTINGS_MODULE is inherited through the environment.
+    import django
+    django.setup(set_prefix=False)
+
+
+def _create_pool():
+    # "spawn" rather than "fork": the Foreman is multi-threaded by the time the pool (re)starts its processes, and
+    # forking a multi-threaded process copies whatever locks happen to be held at that moment.
+    return ProcessPoolExecutor(
+        max_workers=get_settings().PROCESS_POOL_SIZE,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_initialize_process,
+    )
+
+
+def start_process_pool():
+    global _pool
+    if get_settings().PROCESS_POOL_SIZE > 0:
+        _pool = _create_pool()
+
+
+def stop_process_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def _replace_broken_pool(pool):
+    # a pool process died (OOM-killer, segfault in a C-extension); the pool is unusable from then on. We replace it
+    # (once, for all threads that notice); the Task itself fails, i.e. at-most-once as for any other error.
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            logger.error("Process pool broken, replacing it")
+            _pool = _create_pool()
+
+
+def run_cpu_bound(function, *args, **kwargs):
+    """Calls function(*args, **kwargs) in the process pool if there is one, and in the current thread otherwise."""
+    pool = _pool
+    if pool is None:
+        return function(*args, **kwargs)
+
+    try:
+        return pool.submit(function, *args, **kwargs).result()
+    except BrokenProcessPool:
+        _replace_broken_pool(pool)
+        raise
+
+
+def run_cpu_bound_many(function, args_list):
+    """Like run_cpu_bound, for a list of args-tuples; in the pool, the calls run in parallel. Returns a list."""
+    pool = _pool
+    if pool is None:
+        return [function(*args) for args in args_list]
+
+    try:
+        futures = [pool.submit(function, *args) for args in args_list]
+        return [future.result() for future in futures]
+    except BrokenProcessPool:
+        _replace_broken_pool(pool)
+        raise
@@ -6,9 +6,20 @@ DEFAULTS = {
 
     "PID_FILE": None,
 
+    # How the server tells the Foreman there's new work (see wakeup.py): "inotify" (a file per wake-up call in
+    # WAKEUP_CALLS_DIR), "socket" (a datagram on a UNIX domain socket at WAKEUP_SOCKET) or "polling" (no wake-up calls;
+    # the Foreman checks for Tasks every POLL_INTERVAL seconds). The server and the Foreman must use the same value.
+    "WAKEUP_BACKEND": "inotify",
+
     # no_bandit_expl: the usage of this path (in the foreman) is protected with `b108_makedirs`
     "WAKEUP_CALLS_DIR": "/tmp/snappea.wakeup",  # nosec
 
+    # no_bandit_expl: the usage of this path (in the foreman) is protected with `b108_makedirs`, which is applied to the
+    # socket's directory; hence a directory of its own (rather than /tmp itself, which is not ours to own).
+    "WAKEUP_SOCKET": "/tmp/snappea/wakeup.sock",  # nosec
+
+    "POLL_INTERVAL": 1,
+
     "NUM_WORKERS": 4,
 
     # Workaholic mode: I will not stop, even when I'm told to, until _all_ of my tasks are done. This was built for the
@@ -32,12 +43,23 @@ DEFAULTS = {
 
     "GRACEFUL_TIMEOUT": 10,
 
+    # Number of processes in the pool that Tasks can use for CPU-bound work (see processes.py). 0 means: no pool, i.e.
+    # such work is done in the worker threads themselves. Note that each pool process is a full (Django) Python process
+    # in terms of memory usage; and that NUM_WORKERS should be at least this number for the pool to be kept busy.
+    "PROCESS_POOL_SIZE": 0,
+
     "TASK_QS_LIMIT": 100,
 
+    # Tasks that have a batch-variant (see `batch_handler` in decorators.py) are handed to a single worker in runs of at
+    # most this many consecutive Tasks. 1 means "no batching". (Runs are also bounded by TASK_QS_LIMIT, because a run
+    # never spans more than a single query's worth of Tasks.)
+    "MAX_BATCH_SIZE": 1,
+
     "STATS_RETENTION_MINUTES": 60 * 24 * 7,
 
     "HOOK_ADD_TASK_KWARGS": "snappea.utils.dont_add_anything",
     "HOOK_RUN_TASK_CONTEXT": "snappea.utils.no_context",
+    "HOOK_STARTUP": "snappea.utils.do_nothing",
 }
 
 
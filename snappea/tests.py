@@ -1 +1,129 @@
-# Create your tests here.
+import os
+import math
+import tempfile
+from unittest import TestCase as RegularTestCase
+from unittest.mock import patch
+
+from .foreman import get_runs
+from .wakeup import InotifyWakeup, SocketWakeup, PollingWakeup
+from .processes import run_cpu_bound, run_cpu_bound_many, start_process_pool, stop_process_pool
+from .settings import get_settings
+
+
+class FakeTask:
+    def __init__(self, id, task_name, kwargs="{}"):
+        self.id = id
+        self.task_name = task_name
+        self.kwargs = kwargs
+
+
+class GetRunsTestCase(RegularTestCase):
+
+    def _runs(self, tasks, max_batch_size, batchable=("batchable",)):
+        return [[t.id for t in run] for run in get_runs(tasks, max_batch_size, lambda t: t.task_name in batchable)]
+
+    def test_no_batching(self):
+        tasks = [FakeTask(i, "batchable") for i in range(3)]
+        self.assertEqual([[0], [1], [2]], self._runs(tasks, 1))
+
+    def test_max_batch_size(self):
+        tasks = [FakeTask(i, "batchable") for i in range(5)]
+        self.assertEqual([[0, 1], [2, 3], [4]], self._runs(tasks, 2))
+
+    def test_non_batchable_tasks_break_runs(self):
+        tasks = [
+            FakeTask(0, "batchable"), FakeTask(1, "batchable"), FakeTask(2, "other"), FakeTask(3, "other"),
+            FakeTask(4, "batchable"),
+        ]
+        self.assertEqual([[0, 1], [2], [3], [4]], self._runs(tasks, 10))
+
+    def test_different_kwargs_break_runs(self):
+        tasks = [
+            FakeTask(0, "batchable", '{"TENANT_SUBDOMAIN": "a"}'),
+            FakeTask(1, "batchable", '{"TENANT_SUBDOMAIN": "a"}'),
+            FakeTask(2, "batchable", '{"TENANT_SUBDOMAIN": "b"}'),
+        ]
+        self.assertEqual([[0, 1], [2]], self._runs(tasks, 10))
+
+    def test_different_task_names_break_runs(self):
+        tasks = [FakeTask(0, "batchable"), FakeTask(1, "batchable2"), FakeTask(2, "batchable2")]
+        self.assertEqual([[0], [1, 2]], self._runs(tasks, 10, batchable=("batchable", "batchable2")))
+
+
+class WakeupBackendTestCase(RegularTestCase):
+
+    def _test_backend(self, backend):
+        backend.listen()
+        try:
+            backend.clear()
+
+            # pending wake-up calls are coalesced into a single wait()
+            backend.notify()
+            backend.notify()
+            backend.wait()
+
+            # interrupt() unblocks a wait(), even without any wake-up calls (as used for signal handling)
+            backend.interrupt()
+            backend.wait()
+        finally:
+            backend.close()
+
+    def test_inotify(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            backend = InotifyWakeup(os.path.join(tmpdir, "wakeup"))
+            self._test_backend(backend)
+
+            backend.listen()
+            backend.notify()
+            self.assertEqual(1, backend.clear())
+
+    def test_socket(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            backend = SocketWakeup(os.path.join(tmpdir, "wakeup.sock"))
+            self._test_backend(backend)
+
+            # no Foreman listening (socket closed): notify() must not fail
+            backend.notify()
+
+    def test_socket_listen_as_non_root_user(self):
+        # the default location must work for a non-root user (e.g. in our Docker image) that does not own /tmp. We use a
+        # stand-in for /tmp (root-owned when we're root, world-writable and sticky), and drop privileges in a child.
+        with tempfile.TemporaryDirectory() as shared_tmp:
+            os.chmod(shared_tmp, 0o1777)
+            socket_path = os.path.join(shared_tmp, os.path.relpath(get_settings().WAKEUP_SOCKET, "/tmp"))
+
+            pid = os.fork()
+            if pid == 0:
+                exit_code = 1
+                try:
+                    if os.geteuid() == 0:
+                        os.setgid(65534)
+                        os.setuid(65534)  # nobody
+                    backend = SocketWakeup(socket_path)
+                    backend.listen()
+                    backend.notify()
+                    exit_code = 0 if backend.clear() == 1 else 1
+                finally:
+                    os._exit(exit_code)
+
+            _, status = os.waitpid(pid, 0)
+            self.assertEqual(0, os.waitstatus_to_exitcode(status))
+
+    def test_polling(self):
+        self._test_backend(PollingWakeup(0.01))
+
+
+class ProcessPoolTestCase(RegularTestCase):
+
+    def test_no_pool_runs_in_current_process(self):
+        self.assertEqual(os.getpid(), run_cpu_bound(os.getpid))
+        self.assertEqual([os.getpid()], run_cpu_bound_many(os.getpid, [()]))
+
+    def test_pool_runs_in_other_process(self):
+        with patch.dict(get_settings(), {"PROCESS_POOL_SIZE": 2}):
+            start_process_pool()
+            try:
+                self.assertNotEqual(os.getpid(), run_cpu_bound(os.getpid))
+                self.assertEqual([6, 24], run_cpu_bound_many(math.factorial, [(3,), (4,)]))
+            finally:
+                stop_process_pool()
@@ -30,6 +30,15 @@ def run_task_context(task_args, task_kwargs):
     return run_task_context.func(task_args, task_kwargs)
 
 
+def run_startup_hook():
+    """Hook for the Foreman to call on startup, before it starts working on the Task backlog"""
+
+    hook = get_settings().HOOK_STARTUP
+    module_name, function_name = hook.rsplit('.', 1)
+    module = importlib.import_module(module_name)
+    return getattr(module, function_name)()
+
+
 def dont_add_anything():
     # no-op impl of add_task_kwargs
     return {}
@@ -39,3 +48,8 @@ def dont_add_anything():
 def no_context(task_args, task_kwargs):
     # no-op impl of run_task_context
     yield
+
+
+def do_nothing():
+    # no-op impl of run_startup_hook
+    pass
@@ -0,0 +1,238 @@
+import contextlib
+import glob
+import logging
+import os
+import socket
+import threading
+import uuid
+
+from django.utils._os import safe_join
+
+from bsmain.utils import b108_makedirs
+
+from . import thread_uuid
+from .settings import get_settings
+
+logger = logging.getLogger("snappea.foreman")
+
+
+# Wake-up calls: the way clients (the server, but also tasks that create further tasks) tell the Foreman that there is
+# new work in the DB-as-MQ. The Foreman goes to sleep when there are no more Tasks; any wake-up call means "there may be
+# new Tasks now", i.e. wake-up calls may be coalesced, as long as no call is "lost" in the window between the Foreman
+# clearing its pending wake-up calls and it querying for Tasks. (This is guaranteed by both sides doing things in
+# order: the client sends the call _after_ creating the Task, and the Foreman clears the calls _before_ querying).
+#
+# The backends all have the same interface:
+#
+# * notify(): the client side, called for each Task.delay().
+# * listen(), clear(), wait(), interrupt(), close(): the Foreman side; wait() blocks until there's at least one wake-up
+#   call, and consumes all calls that are pending. interrupt() is for signal handlers: it unblocks wait().
+#
+# The choice between them is made in the WAKEUP_BACKEND setting. All processes (server and Foreman) must use the same
+# backend; benchmark_wakeup can be used to compare them on your system.
+
+
+class InotifyWakeup:
+    """
+    Wake-up calls as files in a directory (WAKEUP_CALLS_DIR), which the Foreman watches using inotify. This is the
+    original mechanism; it costs a filesystem write (and delete) per wake-up call.
+    """
+
+    def __init__(self, wakeup_calls_dir):
+        self.wakeup_calls_dir = wakeup_calls_dir
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings.WAKEUP_CALLS_DIR)
+
+    def __str__(self):
+        return "inotify on %s" % self.wakeup_calls_dir
+
+    def notify(self):
+        # thread_uuid: see the notes in __init__.py
+        wakeup_file = safe_join(self.wakeup_calls_dir, thread_uuid)
+
+        b108_makedirs(self.wakeup_calls_dir)
+
+        if not os.path.exists(wakeup_file):
+            with open(wakeup_file, "w"):
+                pass
+
+    def listen(self):
+        from inotify_simple import INotify, flags
+
+        b108_makedirs(self.wakeup_calls_dir)
+        self.wakeup_calls = INotify()
+        self.wakeup_calls.add_watch(self.wakeup_calls_dir, flags.CREATE)
+
+    def clear(self):
+        # We clear the wakeup_calls_dir on startup. Not strictly necessary because such files would be cleared by in
+        # the loop anyway, but it's more efficient to do it first.
+        pre_existing_wakeup_notifications = glob.glob(safe_join(self.wakeup_calls_dir, "*"))
+        for filename in pre_existing_wakeup_notifications:
+            os.remove(filename)
+        return len(pre_existing_wakeup_notifications)
+
+    def wait(self):
+        for event in self.wakeup_calls.read():
+            logger.debug("Main loop: Removing wakeup notification %s", event.name)
+            # I used to think we could just do os.unlink(), without being afraid of an error either here or on the
+            # side where we write the file. I don't have a link to the man page to back this up, but when running
+            # "many" calls (using 2 processes with each simple tight loop, one creating the files and one deleting
+            # them, I did not get any errors). However, later I did get an error in production:
+            # https://dogfood.bugsink.com/issues/issue/48055b00-ddc3-4148-b77a-52379d6d8233/event/last/
+            # I find it really hard to understand where this error came from... AFAICT the following would always
+            # happen in sequence:
+            # * if not exists
+            # * create          (optional on the previous)
+            # * creation detected through inotify
+            # * delete.
+            # A point of debuggin could be: adding the result of self.wakeup_calls.read() to the local variables
+            # such that dogfood Bugsink will pick up on it. But in the end it's not really that relevant (despite
+            # being interesting) so I just catch the error.
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(safe_join(self.wakeup_calls_dir, event.name))
+
+    def interrupt(self):
+        with open(safe_join(self.wakeup_calls_dir, str(uuid.uuid4())), "w"):
+            pass
+
+    def close(self):
+        pass
+
+
+class SocketWakeup:
+    """
+    Wake-up calls as datagrams on a UNIX domain socket (WAKEUP_SOCKET) that the Foreman binds to. No filesystem churn:
+    a wake-up call is a single non-blocking sendto(). When the Foreman is not running, calls are dropped (which is fine:
+    the Foreman clears the Task backlog on startup); when its receive buffer is full, likewise (there are plenty of
+    unread calls already).
+    """
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self.client_socket = None
+        self.client_lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings.WAKEUP_SOCKET)
+
+    def __str__(self):
+        return "unix socket at %s" % self.socket_path
+
+    def _send(self, sock):
+        try:
+            sock.sendto(b"\0", self.socket_path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            pass  # Foreman not running
+        except BlockingIOError:
+            pass  # receive buffer full, i.e. the Foreman has unread wake-up calls already
+
+    def notify(self):
+        if self.client_socket is None:
+            with self.client_lock:
+                if self.client_socket is None:
+                    client_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                    client_socket.setblocking(False)
+                    self.client_socket = client_socket
+
+        self._send(self.client_socket)
+
+    def listen(self):
+        b108_makedirs(os.path.dirname(self.socket_path))
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.socket_path)  # left behind by a previous (killed) Foreman
+
+        self.server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.server_socket.bind(self.socket_path)
+
+    def _drain(self):
+        count = 0
+        self.server_socket.setblocking(False)
+        try:
+            while True:
+                self.server_socket.recv(16)
+                count += 1
+        except BlockingIOError:
+            pass
+        finally:
+            self.server_socket.setblocking(True)
+        return count
+
+    def clear(self):
+        return self._drain()
+
+    def wait(self):
+        self.server_socket.recv(16)
+        self._drain()
+
+    def interrupt(self):
+        # a fresh socket, because interrupt() is called from a signal handler, i.e. "in between" any other calls.
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.setblocking(False)
+            self._send(sock)
+
+    def close(self):
+        self.server_socket.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.socket_path)
+
+
+class PollingWakeup:
+    """
+    No wake-up calls at all: the Foreman checks for new Tasks every POLL_INTERVAL seconds. The fallback for setups in
+    which the server and the Foreman cannot share a directory or socket; the price is latency (and a query per interval
+    when idle).
+    """
+
+    def __init__(self, poll_interval):
+        self.poll_interval = poll_interval
+        self.interrupted = threading.Event()
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings.POLL_INTERVAL)
+
+    def __str__(self):
+        return "polling every %ss" % self.poll_interval
+
+    def notify(self):
+        pass
+
+    def listen(self):
+        pass
+
+    def clear(self):
+        return 0
+
+    def wait(self):
+        self.interrupted.wait(self.poll_interval)
+        self.interrupted.clear()
+
+    def interrupt(self):
+        self.interrupted.set()
+
+    def close(self):
+        pass
+
+
+WAKEUP_BACKENDS = {
+    "inotify": InotifyWakeup,
+    "socket": SocketWakeup,
+    "polling": PollingWakeup,
+}
+
+
+_backend = None
+
+
+def get_wakeup_backend():
+    global _backend
+    if _backend is None:
+        name = get_settings().WAKEUP_BACKEND
+        if name not in WAKEUP_BACKENDS:
+            raise ValueError('Unknown WAKEUP_BACKEND "%s"; choose from: %s' % (name, ", ".join(WAKEUP_BACKENDS)))
+        _backend = WAKEUP_BACKENDS[name].from_settings(get_settings())
+
+    return _backend
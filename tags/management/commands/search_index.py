@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from bugsink.transaction import immediate_atomic
+from tags.search_index import get_search_index, create_search_index, drop_search_index
+
+
+class Command(BaseCommand):
+    help = """Create (or recreate) or drop the optional full-text index for plain-text search on issues and events (see
+    tags/search_index.py). Creating it indexes all existing issues and events, which may take a while on large
+    installations; search uses the index automatically once it exists."""
+
+    def add_arguments(self, parser):
+        parser.add_argument("action", choices=["create", "drop"])
+
+    def handle(self, *args, **options):
+        if get_search_index() is None:
+            raise CommandError("The search index is not supported for this database backend")
+
+        with immediate_atomic():
+            if options["action"] == "create":
+                create_search_index()
+            else:
+                drop_search_index()
+
+        self.stdout.write("Search index %s" % ("created" if options["action"] == "create" else "dropped"))
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-17 07:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tags', '0005_alter_eventtag_project_alter_issuetag_project_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeferredEventTags',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False)),
+                ('event_id', models.UUIDField()),
+                ('issue_id', models.UUIDField()),
+                ('tags', models.TextField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['issue_id'], name='tags_deferr_issue_i_9cbb4f_idx')],
+            },
+        ),
+    ]
@@ -19,15 +19,21 @@ https://docs.sentry.io/platforms/python/enriching-events/tags/
 
 
 import logging
+from collections import Counter, defaultdict
 
 from django.db import models
-from django.db.models import F, Q
+from django.db.models import F, Q, Case, When, Value
 from django.db import connection
 
 from projects.models import Project
 from tags.utils import deduce_tags, is_mostly_unique
 from bugsink.moreiterutils import batched
 from bugsink.app_settings import get_settings
+from bugsink.transaction import delay_once_on_commit
+from bugsink import json
+
+from .tag_counts import coalesce_issue_tag_counts
+from .tag_cache import get_cached_tag_values, get_cached_tag_value_ids, remember_tag_values, forget_tag_values
 
 logger = logging.getLogger("bugsink.ingest")
 
@@ -151,6 +157,24 @@ class IssueTag(models.Model):
         ]
 
 
+class DeferredEventTags(models.Model):
+    """
+    The tags of a digested event, waiting to be stored by tags.tasks.digest_deferred_tags (DEFERRED_TAG_DIGESTION).
+    """
+
+    # No FKs: the event (or its issue) may be deleted before we get to it, in which case the tags are simply dropped.
+    # This also means that the deletion-code (dependency graphs etc.) does not need to know about this model.
+    event_id = models.UUIDField(blank=False, null=False)
+    issue_id = models.UUIDField(blank=False, null=False)
+    tags = models.TextField(blank=False, null=False)  # JSON: {key: value}
+    created_at = models.DateTimeField(auto_now_add=True, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['issue_id']),  # for "how many events of this issue are pending" (UI)
+        ]
+
+
 # copy/pasta from _and_join; we could move both to a utils module
 def _or_join(q_objects):
     if len(q_objects) == 0:
@@ -164,13 +188,19 @@ def _or_join(q_objects):
     return result
 
 
-def digest_tags(event_data, event, issue):
+def get_tags_for_data(event_data):
     # The max length of 200 is from TFM for user-provided tags. Still, we just apply it on deduced tags as well;
     # It's a reasonably safe guess that this will not terribly confuse people, and avoids triggering errors on-save.
-    tags = {
+    return {
         k: str(v)[:200] for k, v in deduce_tags(event_data).items()
     }
 
+
+def digest_tags(event_data, event, issue, tags=None):
+    # tags: the result of get_tags_for_data(event_data) if the caller already has it (it's computed outside of the
+    # digest transaction, i.e. w/o holding the write lock); the parts below depend on the event and are done here.
+    tags = get_tags_for_data(event_data) if tags is None else dict(tags)
+
     for key in "user.ip_address", "user":
         if tags.get(key) == "{{auto}}":
             if event.remote_addr is None:
@@ -188,7 +218,24 @@ def digest_tags(event_data, event, issue):
         logger.warning("event has %d tags; storing %d and dropping the rest", len(tags), max_tags)
         tags = dict(list(tags.items())[:max_tags])
 
-    store_tags(event, issue, tags)
+    if get_settings().DEFERRED_TAG_DIGESTION:
+        defer_tags(event, issue, tags)
+    else:
+        store_tags(event, issue, tags)
+
+
+def defer_tags(event, issue, tags):
+    from tags.tasks import digest_deferred_tags  # avoid circular import
+
+    if not tags:
+        return
+
+    DeferredEventTags.objects.create(event_id=event.id, issue_id=issue.id, tags=json.dumps(tags))
+
+    # a task per digest transaction (rather than per event, which matters for digest_batch); when digest is backlogged
+    # these pile up behind it, and the first one to run picks up the whole batch (the others find little or nothing to
+    # do). That's where the coalescing comes from.
+    delay_once_on_commit(digest_deferred_tags)
 
 
 def store_tags(event, issue, tags):
@@ -203,6 +250,118 @@ def store_tags(event, issue, tags):
 
 
 def _store_tags(event, issue, tags):
+    if not tags:
+        return  # short-circuit; which is a performance optimization which also avoids some the need for further guards
+
+    cached = get_cached_tag_values(event.project_id, issue.id, tags)
+    if cached is not None:
+        missing = _store_tags_cached(event, issue, tags, cached)
+        if not missing:
+            return
+
+        # the cache was out of date for some of the tags (deleted in the meantime, by another process); for those we
+        # fall back to the uncached path (which re-creates whatever is needed, and re-populates the cache).
+        forget_tag_values(event.project_id, issue.id, missing)
+        tags = missing
+
+    _store_tags_uncached(event, issue, tags)
+
+
+def _store_tags_cached(event, issue, tags, cached):
+    # The steady-state: all TagValues & IssueTags are known, i.e. it's just the counter update and the EventTag insert.
+    # The counter update doubles as validation of the cache (see tag_cache.py): IssueTag implies TagValue. Returns the
+    # tags that could not be stored this way.
+    tag_value_ids = [tag_value_id for tag_value_id, _ in cached.values()]
+    issue_tags = IssueTag.objects.filter(value_id__in=tag_value_ids, issue=issue)
+
+    coalesce = get_settings().COALESCE_ISSUE_TAG_COUNTS
+    if coalesce:
+        # the counts are updated later (see tag_counts.py), i.e. we validate with the (read-only) equivalent.
+        found = issue_tags.count()
+    else:
+        found = issue_tags.update(count=F('count') + 1)
+
+    if found != len(tag_value_ids):
+        # rare; we find out which ones are still there, and store the event for those (their counts were updated above)
+        present = set(issue_tags.values_list('value_id', flat=True))
+        missing = {key: value for key, value in tags.items() if cached[key][0] not in present}
+        tag_value_ids = [tag_value_id for tag_value_id in tag_value_ids if tag_value_id in present]
+    else:
+        missing = {}
+
+    if coalesce:
+        _increment_issue_tags(issue.id, [(key, cached[key][0]) for key in tags if key not in missing])
+
+    EventTag.objects.bulk_create([
+        EventTag(
+            project_id=event.project_id,
+            value_id=tag_value_id,
+            event=event,
+            issue=issue,
+            digest_order=event.digest_order,
+        ) for tag_value_id in tag_value_ids
+    ], ignore_conflicts=True)
+
+    return missing
+
+
+def _store_tags_uncached(event, issue, tags):
+    entries = _upsert_tag_values(event.project_id, tags)
+
+    EventTag.objects.bulk_create([
+        EventTag(
+            project_id=event.project_id,
+            value_id=tag_value_id,
+            event=event,
+            issue=issue,
+            digest_order=event.digest_order,
+        ) for _, _, tag_value_id, _ in entries
+    ], ignore_conflicts=True)
+
+    IssueTag.objects.bulk_create([
+        IssueTag(
+            project_id=event.project_id,
+            key_id=tag_key_id,
+            value_id=tag_value_id,
+            issue=issue,
+        ) for _, _, tag_value_id, tag_key_id in entries
+    ], ignore_conflicts=True)
+
+    _increment_issue_tags(issue.id, [(key, tag_value_id) for key, _, tag_value_id, _ in entries])
+
+    remember_tag_values(event.project_id, issue.id, entries)
+
+
+def _increment_issue_tags(issue_id, entries):
+    # entries: (key, tag_value_id). With COALESCE_ISSUE_TAG_COUNTS most of these are counted later (see tag_counts.py)
+    if get_settings().COALESCE_ISSUE_TAG_COUNTS:
+        entries = coalesce_issue_tag_counts(issue_id, entries)
+
+    if entries:
+        # Re 'project_id': this is not needed here, because it's already implied by both the tag values and issue.
+        IssueTag.objects.filter(value_id__in=[tag_value_id for _, tag_value_id in entries], issue_id=issue_id).update(
+            count=F('count') + 1
+        )
+
+
+def update_issue_tag_counts(counts):
+    """Adds the counts ({(issue_id, tag_value_id): n}) to the IssueTags; a single UPDATE per issue (per 500 tags)."""
+    per_issue = defaultdict(dict)
+    for (issue_id, tag_value_id), n in counts.items():
+        per_issue[issue_id][tag_value_id] = n
+
+    for issue_id, n_per_value in per_issue.items():
+        for batch in batched(n_per_value.items(), 500):
+            IssueTag.objects.filter(value_id__in=[tag_value_id for tag_value_id, _ in batch], issue_id=issue_id).update(
+                count=F('count') + Case(
+                    *[When(value_id=tag_value_id, then=Value(n)) for tag_value_id, n in batch],
+                    output_field=models.PositiveIntegerField(),
+                ))
+
+
+def _upsert_tag_values(project_id, tags):
+    # Gets-or-creates the TagKeys and TagValues for the (key => value) tags of a single project; returns a list of
+    # (key, value, tag_value_id, tag_key_id) entries.
     def _uf(fields):
         # mysql "does not support updating conflicts with specifying unique fields that can trigger the upsert.";
         # But for sqlite and postgres the value _is_ required. So empty for mysql, passed fields for the others.
@@ -210,9 +369,6 @@ def _store_tags(event, issue, tags):
             return []
         return fields
 
-    if not tags:
-        return  # short-circuit; which is a performance optimization which also avoids some the need for further guards
-
     # The below is commented-out because in practice each get_or_create() triggers 4(!) queries (savepoint-related)
     # It's left here for reference, because it provides a readable equivalent to the bulk_create approach.
     # if len(tags) <= 1:
@@ -222,12 +378,12 @@ def _store_tags(event, issue, tags):
     #
     #     for key, value in tags.items():
     #         tag_key, _ = TagKey.objects.get_or_create(
-    #             project_id=event.project_id, key=key, mostly_unique=is_mostly_unique(key))
-    #         tag_value, _ = TagValue.objects.get_or_create(project_id=event.project_id, key=tag_key, value=value)
-    #         EventTag.objects.get_or_create(project_id=event.project_id, value=tag_value, event=event,
+    #             project_id=project_id, key=key, mostly_unique=is_mostly_unique(key))
+    #         tag_value, _ = TagValue.objects.get_or_create(project_id=project_id, key=tag_key, value=value)
+    #         EventTag.objects.get_or_create(project_id=project_id, value=tag_value, event=event,
     #             defaults={'issue': issue, 'digest_order': event.digest_order})
     #         IssueTag.objects.get_or_create(
-    #            project_id=event.project_id, key_id=tag_value.key_id, value=tag_value, issue=issue)
+    #            project_id=project_id, key_id=tag_value.key_id, value=tag_value, issue=issue)
     #
     #     # the 0-case is implied here too, which avoids some further guards in the code below
     #     return
@@ -236,7 +392,7 @@ def _store_tags(event, issue, tags):
     # is not formalized in our datbase schema; it "just happens to work correctly" (at least as long as we don't change
     # the list of mostly unique keys, at which point we'll have to do a datamigration).
     tag_key_objects = [
-        TagKey(project_id=event.project_id, key=key, mostly_unique=is_mostly_unique(key)) for key in tags.keys()
+        TagKey(project_id=project_id, key=key, mostly_unique=is_mostly_unique(key)) for key in tags.keys()
     ]
     TagKey.objects.bulk_create(
         tag_key_objects, update_conflicts=True, unique_fields=_uf(['project', 'key']), update_fields=['mostly_unique'])
@@ -245,10 +401,10 @@ def _store_tags(event, issue, tags):
         # In mysql, bulk_create does not actually set pk on the created objects, so we need to re-query.
         # 'project_id': in the selection-queries below the non-necessity of the project_id is mentioned a number of
         # times, but that's precisly _because_ we encode the link to project in TagKay. i.e. here it is needed.
-        tag_key_objects = TagKey.objects.filter(project_id=event.project_id, key__in=tags.keys())
+        tag_key_objects = TagKey.objects.filter(project_id=project_id, key__in=tags.keys())
 
     tag_value_objects = [
-        TagValue(project_id=event.project_id, key=key_obj, value=tags[key_obj.key]) for key_obj in tag_key_objects
+        TagValue(project_id=project_id, key=key_obj, value=tags[key_obj.key]) for key_obj in tag_key_objects
     ]
 
     # 'project' is not part of the unique constraint, which means it goes into update_fields.
@@ -262,29 +418,62 @@ def _store_tags(event, issue, tags):
         tag_value_objects = TagValue.objects.filter(_or_join([
             Q(key=key_obj, value=tags[key_obj.key]) for key_obj in tag_key_objects]))
 
+    key_by_id = {key_obj.id: key_obj.key for key_obj in tag_key_objects}
+    return [
+        (key_by_id[tag_value.key_id], tag_value.value, tag_value.id, tag_value.key_id)
+        for tag_value in tag_value_objects]
+
+
+def store_tags_for_events(events_and_tags):
+    """
+    Stores the tags for many events at once (DEFERRED_TAG_DIGESTION): EventTags and IssueTags are created in bulk, and
+    the IssueTag counts are coalesced over the events, i.e. a tag that's common to many of the events is counted with a
+    single update rather than once per event.
+    """
+    # The TagValue-part of the cache is validated once, for the whole batch (the per-event IssueTag-count-based
+    # validation of _store_tags_cached is not available here: we create the IssueTags in bulk ourselves).
+    resolved = [(event, tags, get_cached_tag_value_ids(event.project_id, tags)) for event, tags in events_and_tags]
+    cached_ids = {
+        tag_value_id for _, _, cached in resolved if cached is not None for tag_value_id, _ in cached.values()}
+    existing_ids = set(TagValue.objects.filter(id__in=cached_ids).values_list('id', flat=True)) if cached_ids else set()
+
+    rows = []  # (event, tag_value_id, tag_key_id)
+    for event, tags, cached in resolved:
+        if cached is not None and all(tag_value_id in existing_ids for tag_value_id, _ in cached.values()):
+            rows.extend((event, tag_value_id, tag_key_id) for tag_value_id, tag_key_id in cached.values())
+            continue
+
+        if cached is not None:
+            forget_tag_values(event.project_id, event.issue_id, tags)
+
+        for kv_batch in batched(tags.items(), 64):  # for the 64, see store_tags()
+            entries = _upsert_tag_values(event.project_id, {k: v for k, v in kv_batch})
+            rows.extend((event, tag_value_id, tag_key_id) for _, _, tag_value_id, tag_key_id in entries)
+            remember_tag_values(event.project_id, event.issue_id, entries)  # IssueTags: created below
+
+    if not rows:
+        return
+
     EventTag.objects.bulk_create([
         EventTag(
             project_id=event.project_id,
-            value=tag_value,
-            event=event,
-            issue=issue,
+            value_id=tag_value_id,
+            event_id=event.id,
+            issue_id=event.issue_id,
             digest_order=event.digest_order,
-        ) for tag_value in tag_value_objects
+        ) for event, tag_value_id, _ in rows
     ], ignore_conflicts=True)
 
-    IssueTag.objects.bulk_create([
-        IssueTag(
+    IssueTag.objects.bulk_create(list({
+        (event.issue_id, tag_value_id): IssueTag(
             project_id=event.project_id,
-            key_id=tag_value.key_id,
-            value=tag_value,
-            issue=issue,
-        ) for tag_value in tag_value_objects
-    ], ignore_conflicts=True)
+            key_id=tag_key_id,
+            value_id=tag_value_id,
+            issue_id=event.issue_id,
+        ) for event, tag_value_id, tag_key_id in rows}.values()
+    ), ignore_conflicts=True)
 
-    # Re 'project_id': this is not needed here, because it's already implied by both tag_value_objects and issue.
-    IssueTag.objects.filter(value__in=tag_value_objects, issue=issue).update(
-        count=F('count') + 1
-    )
+    update_issue_tag_counts(Counter((event.issue_id, tag_value_id) for event, tag_value_id, _ in rows))
 
 
 def prune_tagvalues(ids_to_check):
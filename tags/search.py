@@ -5,13 +5,14 @@ least it means we have all of this together in a separate file this way.
 """
 
 import re
-from django.db.models import Q, Subquery, Count
+from django.db.models import Q, Subquery, Exists, OuterRef
 from collections import namedtuple
 
 from bugsink.moreiterutils import tuplewise
 from events.models import Event
 
 from .models import TagValue, IssueTag, EventTag, _or_join
+from .search_index import get_plain_text_filter
 
 
 ParsedQuery = namedtuple("ParsedQ", ["tags", "plain_text"])
@@ -62,33 +63,59 @@ def parse_query(q):
     return ParsedQuery(tags, plain_text_q)
 
 
+def _get_tag_value_ids(project, tags):
+    """
+    Returns the ids of the TagValues for the (key, value) pairs of the query, looked up in a single query; None if any
+    of them does not exist.
+    """
+    if not tags:
+        return []
+
+    # Since we have project as a field on TagValue, we _could_ filter on project directly; with our current set of
+    # indexes the below formulation is a nice way to reuse the index on TagKey (project, key) though.
+    tag_value_ids = TagValue.objects.filter(key__project=project).filter(_or_join([
+        Q(key__key=key, value=value) for key, value in tags.items()])).values_list("id", flat=True)
+
+    tag_value_ids = list(tag_value_ids)
+    if len(tag_value_ids) < len(tags):
+        # if the tag doesn't exist, we can't have any issues with it; the short-circuit (by the caller) is fine, I think
+        # (I mean: we _could_ say "tag x is to blame" but that's not what one does generally in search, is it?
+        return None
+
+    return tag_value_ids
+
+
+def _order_by_selectivity(issue, tag_value_ids):
+    """
+    Orders the tag values by how many of the issue's events have them, rarest first. IssueTag.count is a "seen count"
+    (it includes evicted events) so this is an estimate, but a cheap one: a single lookup on IssueTag's unique index.
+    Values without an IssueTag are put first (there are, in all likelihood, no events to match).
+    """
+    counts = dict(IssueTag.objects.filter(issue=issue, value_id__in=tag_value_ids).values_list("value_id", "count"))
+    return sorted(tag_value_ids, key=lambda tag_value_id: counts.get(tag_value_id, 0))
+
+
 def _search(m2m_qs, fk_fieldname, project, obj_list, q):
     if not q:
         return obj_list
 
     parsed = parse_query(q)
 
-    clauses = []
-    for key, value in parsed.tags.items():
-        try:
-            # Since we have project as a field on TagValue, we _could_ filter on project directly; with our current set
-            # of indexes the below formulation is a nice way to reuse the index on TagKey (project, key) though.
-            tag_value_obj = TagValue.objects.get(key__project=project, key__key=key, value=value)
-        except TagValue.DoesNotExist:
-            # if the tag doesn't exist, we can't have any issues with it; the below short-circuit is fine, I think (I
-            # mean: we _could_ say "tag x is to blame" but that's not what one does generally in search, is it?
-            return obj_list.none()
+    tag_value_ids = _get_tag_value_ids(project, parsed.tags)
+    if tag_value_ids is None:
+        return obj_list.none()
 
-        clauses.append(
-            Q(id__in=Subquery(m2m_qs.filter(value=tag_value_obj).values_list(fk_fieldname, flat=True))))
+    clauses = [
+        Q(id__in=Subquery(m2m_qs.filter(value_id=tag_value_id).values_list(fk_fieldname, flat=True)))
+        for tag_value_id in tag_value_ids]
 
     # this is really TSTTCPW (or more like a "fake it till you make it" thing); but I'd rather "have something" and then
     # have really-good-search than to have either nothing at all, or half-baked search. Note that we didn't even bother
     # to set indexes on the fields we search on (nor create a single searchable field for the whole of 'title').
     # Some notes on the current limitations and ways to improve:
     # * performance-wise: icontains queries are expensive (the "%" is on two sides, hence no index can be used); for
-    #   limited data, this may be fine, but for anything over a few thousand records, this will be slow. (We might want
-    #   to just do prefix-matching; or do the "both sides" thing only for small datasets).
+    #   limited data, this may be fine, but for anything over a few thousand records, this will be slow. The optional
+    #   full-text index (search_index.py) addresses this: when present, it narrows down the rows to apply icontains on.
     #
     # * performance-wise: the initial impl. only supported Issue-search; we now also allow Event-search; but there are
     #   often many more events than issues.
@@ -96,6 +123,10 @@ def _search(m2m_qs, fk_fieldname, project, obj_list, q):
     # * the current implementation does not work for plain text queries that span the type/value boundary; nor does it
     #   work for searching on "message" (for log messages).
     if parsed.plain_text:
+        index_clause = get_plain_text_filter(obj_list.model, parsed.plain_text)
+        if index_clause is not None:
+            clauses.append(index_clause)
+
         clauses.append(
             Q(Q(calculated_type__icontains=parsed.plain_text) | Q(calculated_value__icontains=parsed.plain_text)))
 
@@ -118,30 +149,27 @@ def search_event_tags(project, issue, parsed):
     if parsed.plain_text or not parsed.tags:
         raise ValueError("Only works for at least one tag and no plain text")
 
-    clauses = []
-    for key, value in parsed.tags.items():
-        try:
-            # Since we have project as a field on TagValue, we _could_ filter on project directly; with our current set
-            # of indexes the below formulation is a nice way to reuse the index on TagKey (project, key) though.
-            tag_value_obj = TagValue.objects.get(key__project=project, key__key=key, value=value)
-        except TagValue.DoesNotExist:
-            # if the tag doesn't exist, we can't have any issues with it; the below short-circuit is fine, I think (I
-            # mean: we _could_ say "tag x is to blame" but that's not what one does generally in search, is it?
-            return EventTag.objects.none()
-
-        clauses.append(Q(issue=issue, value=tag_value_obj))
-
-    if len(clauses) == 1:
-        return EventTag.objects.filter(clauses[0])
-
-    # We have multiple clauses; we need to find the events that have all of these tags; we can't just do a filter() with
-    # and _and_join of the clauses, because ANDing 2 disjoint sets of tags will never match anything. So we need to do a
-    # count of the number of events that have each of the tags, and then filter on the ones that have all of them.
-    # Note that grouping-by/counting on the digest_order (rather than just event_id) works because the digest_order is
-    # unique per event (in the context of a single issue); its use allows for a covering index on the OR-ed parts.
-    # Note that pulling the match on issue out of the OR-ed parts to a single AND was tried, but found to be 2x slower.
-    return EventTag.objects.filter(
-        _or_join(clauses)).values("digest_order").annotate(count=Count("digest_order")).filter(count=len(clauses))
+    tag_value_ids = _get_tag_value_ids(project, parsed.tags)
+    if tag_value_ids is None:
+        return EventTag.objects.none()
+
+    if len(tag_value_ids) == 1:
+        return EventTag.objects.filter(issue=issue, value_id=tag_value_ids[0])
+
+    # We have multiple tags; we need to find the events that have all of them. We start from the EventTags of the rarest
+    # tag, and keep those for which an EventTag exists for each of the other tags (for the same event, i.e. the same
+    # digest_order, which is unique per event in the context of a single issue). Each of those is a lookup on the
+    # (value, issue, digest_order) index, i.e. the work is proportional to the number of events with the rarest tag
+    # rather than to the sum of the number of events of each tag (which is what the previous implementation, an OR of
+    # all tags with a GROUP BY/HAVING on the count, did).
+    rarest, *others = _order_by_selectivity(issue, tag_value_ids)
+
+    qs = EventTag.objects.filter(issue=issue, value_id=rarest)
+    for tag_value_id in others:
+        qs = qs.filter(Exists(EventTag.objects.filter(
+            issue=issue, value_id=tag_value_id, digest_order=OuterRef("digest_order"))))
+
+    return qs
 
 
 def search_events_optimized(project, issue, q):
@@ -0,0 +1,185 @@
+"""
+Optional full-text index for the plain-text part of search (see tags/search.py), which is otherwise an icontains on
+calculated_type and calculated_value, i.e. a scan of all of the project's issues (or the issue's events).
+
+The index is not part of the migrations (it's backend-specific, and costs space and write-time on every digest, which
+not everyone wants to pay); it's created (and dropped) with the `search_index` management command, and search uses it
+automatically when it's present. In all cases, the index is used as a pre-filter only: the icontains is still applied
+to what it returns, i.e. the results are the same with or without the index.
+
+* sqlite: FTS5 with the trigram tokenizer, which supports substring-matching (of 3 characters or more). Kept in sync
+  with the issues/events tables by triggers (i.e. on digest and on any update of the title), through a separate
+  content-table with a stable (INTEGER PRIMARY KEY) rowid. Migrations that rebuild a table drop its triggers; we don't
+  use an index without its triggers (and our migrate command recreates it).
+* postgres: trigram (pg_trgm) GIN indexes on exactly the expressions Django generates for icontains; no changes to the
+  query are needed, Postgres picks up the index by itself.
+* mysql: not supported. FULLTEXT (with the ngram parser) is the obvious candidate, but with the default stopword
+  settings it silently skips ngrams containing stopwords (e.g. "a"), i.e. it would not be a reliable pre-filter.
+"""
+
+from django.db import connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+
+SEARCHABLE_TABLES = ["issues_issue", "events_event"]
+
+
+class SqliteSearchIndex:
+    MIN_LENGTH = 3  # the trigram tokenizer can't match anything shorter
+
+    def _statements(self, table):
+        search, fts = table + "_search", table + "_search_fts"
+        return [
+            f"CREATE TABLE {search} (id INTEGER PRIMARY KEY, obj_id TEXT NOT NULL UNIQUE, "
+            f"calculated_type TEXT NOT NULL, calculated_value TEXT NOT NULL)",
+
+            f"CREATE VIRTUAL TABLE {fts} USING fts5(calculated_type, calculated_value, content='{search}', "
+            f"content_rowid='id', tokenize='trigram')",
+
+            # keeping the FTS-index in sync with its content table: as per https://sqlite.org/fts5.html (4.4.3)
+            f"CREATE TRIGGER {search}_ai AFTER INSERT ON {search} BEGIN "
+            f"INSERT INTO {fts}(rowid, calculated_type, calculated_value) "
+            f"VALUES (new.id, new.calculated_type, new.calculated_value); END",
+
+            f"CREATE TRIGGER {search}_ad AFTER DELETE ON {search} BEGIN "
+            f"INSERT INTO {fts}({fts}, rowid, calculated_type, calculated_value) "
+            f"VALUES ('delete', old.id, old.calculated_type, old.calculated_value); END",
+
+            f"CREATE TRIGGER {search}_au AFTER UPDATE ON {search} BEGIN "
+            f"INSERT INTO {fts}({fts}, rowid, calculated_type, calculated_value) "
+            f"VALUES ('delete', old.id, old.calculated_type, old.calculated_value); "
+            f"INSERT INTO {fts}(rowid, calculated_type, calculated_value) "
+            f"VALUES (new.id, new.calculated_type, new.calculated_value); END",
+
+            # keeping the content table in sync with the actual table
+            f"CREATE TRIGGER {table}_to_search_ai AFTER INSERT ON {table} BEGIN "
+            f"INSERT INTO {search}(obj_id, calculated_type, calculated_value) "
+            f"VALUES (new.id, new.calculated_type, new.calculated_value); END",
+
+            f"CREATE TRIGGER {table}_to_search_ad AFTER DELETE ON {table} BEGIN "
+            f"DELETE FROM {search} WHERE obj_id = old.id; END",
+
+            f"CREATE TRIGGER {table}_to_search_au AFTER UPDATE OF calculated_type, calculated_value ON {table} BEGIN "
+            f"UPDATE {search} SET calculated_type = new.calculated_type, calculated_value = new.calculated_value "
+            f"WHERE obj_id = old.id; END",
+
+            f"INSERT INTO {search}(obj_id, calculated_type, calculated_value) "
+            f"SELECT id, calculated_type, calculated_value FROM {table}",
+        ]
+
+    def _triggers(self, table):
+        search = table + "_search"
+        return [search + "_ai", search + "_ad", search + "_au", table + "_to_search_ai", table + "_to_search_ad",
+                table + "_to_search_au"]
+
+    def create(self, cursor, table):
+        self.drop(cursor, table)
+        for statement in self._statements(table):
+            cursor.execute(statement)
+
+    def drop(self, cursor, table):
+        for trigger in self._triggers(table):
+            cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        cursor.execute(f"DROP TABLE IF EXISTS {table}_search_fts")
+        cursor.execute(f"DROP TABLE IF EXISTS {table}_search")
+
+    def exists(self, cursor, table):
+        cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = %s", [table + "_search_fts"])
+        return cursor.fetchone()[0] > 0
+
+    def is_current(self, cursor, table):
+        cursor.execute(
+            "SELECT COUNT(*) FROM sqlite_master WHERE type = 'trigger' AND name IN (%s)" % ", ".join(
+                ["%s"] * len(self._triggers(table))), self._triggers(table))
+        return cursor.fetchone()[0] == len(self._triggers(table))
+
+    def filter_q(self, table, plain_text):
+        if len(plain_text) < self.MIN_LENGTH:
+            return None
+
+        phrase = '"%s"' % plain_text.replace('"', '""')
+        return Q(id__in=RawSQL(
+            f"SELECT obj_id FROM {table}_search WHERE id IN "
+            f"(SELECT rowid FROM {table}_search_fts WHERE {table}_search_fts MATCH %s)", [phrase]))
+
+
+class PostgresSearchIndex:
+
+    def _indexes(self, table):
+        # the expressions must be exactly those of Django's icontains (UPPER("col"::text) LIKE UPPER(...)) to be used.
+        return [(f"{table}_{column}_trgm", f'UPPER(("{column}")::text) gin_trgm_ops')
+                for column in ["calculated_type", "calculated_value"]]
+
+    def create(self, cursor, table):
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        for name, expression in self._indexes(table):
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} USING gin ({expression})")
+
+    def drop(self, cursor, table):
+        for name, _ in self._indexes(table):
+            cursor.execute(f"DROP INDEX IF EXISTS {name}")
+
+    def exists(self, cursor, table):
+        cursor.execute("SELECT COUNT(*) FROM pg_indexes WHERE indexname = %s", [self._indexes(table)[0][0]])
+        return cursor.fetchone()[0] > 0
+
+    def is_current(self, cursor, table):
+        return True
+
+    def filter_q(self, table, plain_text):
+        return None  # the icontains itself uses the index
+
+
+def get_search_index():
+    # None for unsupported backends
+    return {
+        "sqlite": SqliteSearchIndex,
+        "postgresql": PostgresSearchIndex,
+    }.get(connection.vendor, lambda: None)()
+
+
+def get_plain_text_filter(model, plain_text):
+    """Returns a Q to narrow down the plain-text search on model using the index, or None if no index is available."""
+    table = model._meta.db_table
+    if table not in SEARCHABLE_TABLES:
+        return None
+
+    index = get_search_index()
+    q = None if index is None else index.filter_q(table, plain_text)
+    if q is None:
+        return None
+
+    with connection.cursor() as cursor:
+        if not (index.exists(cursor, table) and index.is_current(cursor, table)):
+            return None
+
+    return q
+
+
+def create_search_index():
+    index = get_search_index()
+    with connection.cursor() as cursor:
+        for table in SEARCHABLE_TABLES:
+            index.create(cursor, table)
+
+
+def drop_search_index():
+    index = get_search_index()
+    with connection.cursor() as cursor:
+        for table in SEARCHABLE_TABLES:
+            index.drop(cursor, table)
+
+
+def recreate_search_index_if_stale():
+    """Recreates the index if it exists but is not current (i.e. a migration has dropped the triggers); see migrate."""
+    index = get_search_index()
+    if index is None:
+        return []
+
+    with connection.cursor() as cursor:
+        stale = [table for table in SEARCHABLE_TABLES
+                 if index.exists(cursor, table) and not index.is_current(cursor, table)]
+        for table in stale:
+            index.create(cursor, table)
+
+    return stale
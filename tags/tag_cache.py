@@ -0,0 +1,99 @@
+from django.db import transaction
+
+from bugsink.app_settings import get_settings
+from bugsink.lru import LRUCache
+
+
+# In-process caches for the write-path of tags (store_tags), used in digest:
+#
+# * (project_id, key, value) => (tag_value_id, tag_key_id)
+# * (issue_id, tag_value_id) => True, i.e. "the IssueTag exists"
+#
+# Most tag key/value pairs repeat constantly (release, environment, server_name, ...); when all of an event's tags are
+# known in both caches, store_tags skips the TagKey/TagValue upserts and the IssueTag creation, leaving the counter
+# update and the EventTag insert.
+#
+# The caches live in the digesting process, whereas TagValues and IssueTags may be deleted from elsewhere (issue
+# deletion, vacuum_tags). The cache is validated in the same go as the counter update: an IssueTag
+# (issue, value) that exists implies that the TagValue exists (FK), so "the number of updated IssueTags equals the
+# number of tags" means all cached ids are still good. If it doesn't, store_tags falls back to the uncached path for
+# whatever was missing (see _store_tags_cached).
+#
+# Entries are only added when the transaction that read/created the rows commits; invalidation is done immediately.
+_value_cache = None
+_issue_tag_cache = None
+
+
+def _get_caches():
+    global _value_cache, _issue_tag_cache
+    if _value_cache is None:
+        _value_cache = LRUCache(get_settings().TAG_CACHE_SIZE)
+        _issue_tag_cache = LRUCache(get_settings().TAG_CACHE_SIZE)
+    return _value_cache, _issue_tag_cache
+
+
+def get_cached_tag_values(project_id, issue_id, tags):
+    """
+    Returns {key: (tag_value_id, tag_key_id)} if all of the tags (and their IssueTags for the issue) are in the cache;
+    None otherwise (i.e. it's all-or-nothing: partial hits would need the uncached path anyway).
+    """
+    result = get_cached_tag_value_ids(project_id, tags)
+    if result is None:
+        return None
+
+    _, issue_tag_cache = _get_caches()
+    if any(issue_tag_cache.get((issue_id, tag_value_id)) is None for tag_value_id, _ in result.values()):
+        return None
+
+    return result
+
+
+def get_cached_tag_value_ids(project_id, tags):
+    """Like get_cached_tag_values, but for the TagValues only; validating the result is up to the caller."""
+    if get_settings().TAG_CACHE_SIZE == 0:
+        return None
+
+    value_cache, _ = _get_caches()
+
+    result = {}
+    for key, value in tags.items():
+        cached = value_cache.get((project_id, key, value))
+        if cached is None:
+            return None
+        result[key] = cached
+
+    return result
+
+
+def remember_tag_values(project_id, issue_id, entries):
+    """
+    Adds the (key, value, tag_value_id, tag_key_id) entries (and the implied IssueTags for the issue) to the cache,
+    once (and if) the current transaction commits.
+    """
+    if get_settings().TAG_CACHE_SIZE == 0:
+        return
+
+    value_cache, issue_tag_cache = _get_caches()
+
+    def put():
+        for key, value, tag_value_id, tag_key_id in entries:
+            value_cache.put((project_id, key, value), (tag_value_id, tag_key_id))
+            issue_tag_cache.put((issue_id, tag_value_id), True)
+
+    transaction.on_commit(put)
+
+
+def forget_tag_values(project_id, issue_id, tags):
+    if _value_cache is None:
+        return
+
+    for key, value in tags.items():
+        cached = _value_cache.pop((project_id, key, value))
+        if cached is not None:
+            _issue_tag_cache.pop((issue_id, cached[0]))
+
+
+def clear_tag_cache():
+    global _value_cache, _issue_tag_cache
+    _value_cache = None
+    _issue_tag_cache = None
@@ -0,0 +1,80 @@
+from collections import Counter
+from functools import partial
+import threading
+
+from django.db import transaction
+
+from bugsink.transaction import delay_on_commit
+from tags.utils import is_mostly_unique
+
+
+# In-process accumulator of IssueTag count increments (COALESCE_ISSUE_TAG_COUNTS): (issue_id, tag_value_id) => n.
+#
+# During a burst on a single issue the same few IssueTag rows (release, environment, server_name, ...) would otherwise
+# be updated once per event; with the accumulator they are updated once per flush. A flush is requested (as a snappea
+# task) when the first increment after a flush comes in; since that task is queued behind the digest tasks of the
+# burst, a flush typically covers "the whole backlog" and counts are exact again once digest has caught up.
+#
+# Only committed increments are accumulated (on_commit). Counts that are in the accumulator when the process dies are
+# lost; IssueTag counts being "seen counts" (see IssueTag.count) that's a tradeoff we can live with in this (opt-in)
+# mode. Tags with mostly-unique keys are not accumulated: their values rarely repeat, so there's nothing to coalesce,
+# and accumulating them would just fill up memory.
+MAX_PENDING = 100_000
+
+_pending = Counter()
+_flush_requested = False
+_lock = threading.Lock()
+
+
+def coalesce_issue_tag_counts(issue_id, entries):
+    """
+    Takes the (key, tag_value_id) entries of the issue for coalesced counting where possible; returns the remaining
+    entries, which the caller must count directly.
+    """
+    with _lock:
+        room = MAX_PENDING - len(_pending)
+
+    taken, remaining = [], []
+    for key, tag_value_id in entries:
+        if len(taken) < room and not is_mostly_unique(key):
+            taken.append(tag_value_id)
+        else:
+            remaining.append((key, tag_value_id))
+
+    if taken:
+        transaction.on_commit(partial(_add, issue_id, taken))
+
+    return remaining
+
+
+def _add(issue_id, tag_value_ids):
+    from tags.tasks import flush_issue_tag_counts  # avoid circular import
+    global _flush_requested
+
+    with _lock:
+        for tag_value_id in tag_value_ids:
+            _pending[issue_id, tag_value_id] += 1
+
+        request_flush = not _flush_requested
+        _flush_requested = True
+
+    if request_flush:
+        delay_on_commit(flush_issue_tag_counts)
+
+
+def take_pending_issue_tag_counts():
+    """Empties the accumulator; returns what was in it."""
+    global _flush_requested
+
+    with _lock:
+        result = dict(_pending)
+        _pending.clear()
+        _flush_requested = False
+
+    return result
+
+
+def restore_pending_issue_tag_counts(counts):
+    """Puts back what take_pending_issue_tag_counts() returned (e.g. when the flush failed)."""
+    with _lock:
+        _pending.update(counts)
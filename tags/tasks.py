@@ -2,15 +2,67 @@ from django.db.models import Q
 
 from snappea.decorators import shared_task
 
+from bugsink import json
 from bugsink.moreiterutils import batched
-from bugsink.transaction import immediate_atomic, delay_on_commit
-from tags.models import TagValue, TagKey, EventTag, IssueTag, _or_join, prune_tagvalues
+from bugsink.transaction import immediate_atomic, durable_atomic, delay_on_commit
+from tags.models import (
+    TagValue, TagKey, EventTag, IssueTag, DeferredEventTags, _or_join, prune_tagvalues, store_tags_for_events,
+    update_issue_tag_counts)
+from tags.tag_counts import take_pending_issue_tag_counts, restore_pending_issue_tag_counts
 
+DIGEST_DEFERRED_TAGS_BATCH_SIZE = 100  # events, i.e. up to 100 * MAX_EVENT_TAGS tags
 VACUUM_TAGS_BATCH_SIZE = 10_000
 VACUUM_EVENTLESS_ISSUETAGS_BATCH_SIZE = 2048
 VACUUM_EVENTLESS_ISSUETAGS_INNER_BATCH_SIZE = 64
 
 
+@shared_task
+def digest_deferred_tags():
+    # Stores the tags of a batch of events that were digested with DEFERRED_TAG_DIGESTION (see defer_tags), and
+    # re-enqueues itself if there may be more.
+    from events.models import Event  # avoid circular import
+
+    with durable_atomic():
+        # check before taking the write lock: most of these tasks find that an earlier one already did their work
+        if not DeferredEventTags.objects.exists():
+            return
+
+    with immediate_atomic():
+        batch = list(DeferredEventTags.objects.order_by("id")[:DIGEST_DEFERRED_TAGS_BATCH_SIZE])
+
+        # events that are gone by now (evicted, deleted), or that are about to be (their issue or project is being
+        # deleted, which implies deleting the EventTags) are skipped, i.e. their tags are dropped.
+        events = {
+            event.id: event for event in Event.objects.filter(
+                id__in=[deferred.event_id for deferred in batch], issue__is_deleted=False, project__is_deleted=False,
+            ).only("id", "project_id", "issue_id", "digest_order")}
+
+        store_tags_for_events([
+            (events[deferred.event_id], json.loads(deferred.tags)) for deferred in batch
+            if deferred.event_id in events])
+
+        DeferredEventTags.objects.filter(id__in=[deferred.id for deferred in batch]).delete()
+
+        if len(batch) == DIGEST_DEFERRED_TAGS_BATCH_SIZE:
+            delay_on_commit(digest_deferred_tags)
+
+
+@shared_task
+def flush_issue_tag_counts():
+    # COALESCE_ISSUE_TAG_COUNTS: writes the accumulated IssueTag count increments (see tag_counts.py). Must run in the
+    # process that does the digesting, which it does, because that's the snappea process (or: EAGER mode).
+    counts = take_pending_issue_tag_counts()
+    if not counts:
+        return
+
+    try:
+        with immediate_atomic():
+            update_issue_tag_counts(counts)
+    except Exception:
+        restore_pending_issue_tag_counts(counts)
+        raise
+
+
 @shared_task
 def vacuum_tagvalues(min_id=0):
     # Known limitation:
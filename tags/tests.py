@@ -1,18 +1,23 @@
 from unittest import TestCase as RegularTestCase
+from unittest.mock import patch
 from django.test import TestCase as DjangoTestCase
 from django.conf import settings
+from django.db import connection
 
 from bugsink.app_settings import override_settings as override_bugsink_settings
 from bugsink.test_utils import TransactionTestCase25251 as TransactionTestCase
+from bugsink.transaction import immediate_atomic
 from projects.models import Project
 from issues.factories import get_or_create_issue, denormalized_issue_fields
 from events.factories import create_event, create_event_data
 from issues.models import Issue
 
-from .models import store_tags, EventTag, IssueTag, TagValue, digest_tags
+from .models import store_tags, EventTag, IssueTag, TagValue, DeferredEventTags, digest_tags
 from .utils import deduce_tags
 from .search import search_events, search_issues, parse_query, search_events_optimized
-from .tasks import vacuum_eventless_issuetags
+from .tasks import vacuum_eventless_issuetags, digest_deferred_tags
+from .tag_cache import clear_tag_cache
+from .search_index import create_search_index, drop_search_index, get_plain_text_filter, recreate_search_index_if_stale
 
 
 class DeduceTagsTestCase(RegularTestCase):
@@ -144,6 +149,130 @@ class StoreTagsTestCase(DjangoTestCase):
         self.assertEqual(IssueTag.objects.filter(issue=self.issue).count(), 512)
 
 
+class TagCacheTestCase(TransactionTestCase):
+    # TransactionTestCase, because the cache is only populated on-commit.
+
+    def setUp(self):
+        super().setUp()
+        clear_tag_cache()
+        self.project = Project.objects.create(name="Test Project")
+        self.issue, _ = get_or_create_issue(self.project)
+
+    def _store(self, tags):
+        with immediate_atomic():
+            store_tags(create_event(self.project, issue=self.issue), self.issue, tags)
+
+    def test_known_tags_skip_the_upserts(self):
+        tags = {f"k-{i}": f"v-{i}" for i in range(5)}
+        self._store(tags)
+
+        with immediate_atomic():
+            event = create_event(self.project, issue=self.issue)
+            with self.assertNumQueries(2):  # counter update, EventTag insert
+                store_tags(event, self.issue, tags)
+
+        self.assertEqual(5, event.tags.count())
+        self.assertEqual({2}, set(IssueTag.objects.filter(issue=self.issue).values_list("count", flat=True)))
+
+    def test_stale_cache_falls_back(self):
+        self._store({"foo": "bar", "baz": "qux"})
+
+        # as would happen when cleaning up from another process (the cache is not told)
+        EventTag.objects.filter(value__key__key="foo").delete()
+        IssueTag.objects.filter(value__key__key="foo").delete()
+        TagValue.objects.filter(key__key="foo").delete()
+
+        self._store({"foo": "bar", "baz": "qux"})
+
+        self.assertEqual(
+            {"foo": 1, "baz": 2},
+            dict(IssueTag.objects.filter(issue=self.issue).values_list("value__key__key", "count")))
+        self.assertEqual(3, EventTag.objects.count())
+
+
+class CoalescedIssueTagCountsTestCase(TransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        clear_tag_cache()
+        self.project = Project.objects.create(name="Test Project")
+        self.issue, _ = get_or_create_issue(self.project)
+
+    def _counts(self):
+        return dict(self.issue.tags.values_list("value__key__key", "count"))
+
+    def test_counts_are_flushed_after_commit(self):
+        with override_bugsink_settings(COALESCE_ISSUE_TAG_COUNTS=True):
+            with immediate_atomic():
+                for i in range(3):
+                    store_tags(create_event(self.project, issue=self.issue), self.issue, {"foo": "bar"})
+                self.assertEqual({"foo": 0}, self._counts())
+
+            # (in EAGER mode the flush has run by now)
+            self.assertEqual({"foo": 3}, self._counts())
+
+            with immediate_atomic():
+                # the tag cache is populated by now, i.e. this goes through _store_tags_cached
+                store_tags(create_event(self.project, issue=self.issue), self.issue, {"foo": "bar"})
+            self.assertEqual({"foo": 4}, self._counts())
+
+    def test_mostly_unique_tags_are_counted_directly(self):
+        with override_bugsink_settings(COALESCE_ISSUE_TAG_COUNTS=True):
+            with immediate_atomic():
+                store_tags(create_event(self.project, issue=self.issue), self.issue, {"foo": "bar", "trace": "t1"})
+                self.assertEqual({"foo": 0, "trace": 1}, self._counts())
+
+            self.assertEqual({"foo": 1, "trace": 1}, self._counts())
+
+
+class DeferredTagDigestionTestCase(TransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        clear_tag_cache()
+        self.project = Project.objects.create(name="Test Project")
+        self.issue, _ = get_or_create_issue(self.project)
+        self.other_issue, _ = get_or_create_issue(self.project, event_data=create_event_data("other_issue"))
+
+    def test_tags_are_stored_after_the_digest_transaction(self):
+        with override_bugsink_settings(DEFERRED_TAG_DIGESTION=True):
+            with immediate_atomic():
+                for issue in [self.issue, self.issue, self.other_issue]:
+                    event = create_event(self.project, issue=issue)
+                    digest_tags(create_event_data(), event, issue, {"foo": "bar", "baz": "qux"})
+
+                self.assertEqual(0, EventTag.objects.count())
+                self.assertEqual(3, DeferredEventTags.objects.count())
+
+        # (in EAGER mode the task has run by now)
+        self.assertEqual(0, DeferredEventTags.objects.count())
+        self.assertEqual(6, EventTag.objects.count())
+        self.assertEqual(
+            {("foo", 2), ("baz", 2)}, set(self.issue.tags.values_list("value__key__key", "count")))
+        self.assertEqual(
+            {("foo", 1), ("baz", 1)}, set(self.other_issue.tags.values_list("value__key__key", "count")))
+
+    def test_a_single_task_per_transaction(self):
+        with override_bugsink_settings(DEFERRED_TAG_DIGESTION=True), \
+                patch.object(digest_deferred_tags, "delay") as delay:
+            with immediate_atomic():
+                for i in range(3):
+                    event = create_event(self.project, issue=self.issue)
+                    digest_tags(create_event_data(), event, self.issue, {"foo": "bar"})
+
+        self.assertEqual(1, delay.call_count)
+
+    def test_tags_of_deleted_events_are_dropped(self):
+        event = create_event(self.project, issue=self.issue)
+        DeferredEventTags.objects.create(event_id=event.id, issue_id=self.issue.id, tags='{"foo": "bar"}')
+        event.delete()
+
+        digest_deferred_tags()
+
+        self.assertEqual(0, DeferredEventTags.objects.count())
+        self.assertEqual(0, IssueTag.objects.count())
+
+
 class DigestTagsTestCase(DjangoTestCase):
     def test_auto_ip_address(self):
         project = Project.objects.create(name="Test Project")
@@ -318,6 +447,24 @@ class SearchTestCase(DjangoTestCase):
     def test_search_events_optimized(self):
         self._test_search(lambda query: search_events_optimized(self.project, self.global_issue, query))
 
+    def test_search_event_tags_queries(self):
+        # resolving the TagValues and estimating their selectivity: a single query each, no matter the number of tags
+        with self.assertNumQueries(3):
+            qs = search_events_optimized(self.project, self.global_issue, "k-0:v-0 k-1:v-1 k-2:v-2")
+            self.assertEqual(qs.count(), 2)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(search_events_optimized(self.project, self.global_issue, "k-0:v-0 k-1:nosuch").count(), 0)
+
+    def test_search_event_tags_rarest_first(self):
+        # a tag that only one of the events has; whatever the order in the query, the result is that single event
+        event = EventTag.objects.filter(issue=self.global_issue).first().event
+        store_tags(event, self.global_issue, {"rare": "value"})
+
+        for q in ["rare:value k-0:v-0", "k-0:v-0 rare:value", "k-0:v-0 k-1:v-1 rare:value"]:
+            self.assertEqual(list(search_events_optimized(self.project, self.global_issue, q).values_list(
+                "event_id", flat=True)), [event.id])
+
     def test_search_events_wrong_issue(self):
         issue_without_events = Issue.objects.create(project=self.project, **denormalized_issue_fields())
 
@@ -334,6 +481,44 @@ class SearchTestCase(DjangoTestCase):
         self._test_search(lambda query: search_issues(self.project, Issue.objects.all(), query))
 
 
+class SearchIndexTestCase(SearchTestCase):
+    """Same tests as SearchTestCase, but with the (optional) search index in place."""
+
+    def setUp(self):
+        create_search_index()  # before super().setUp(), i.e. the triggers must do the work
+        super().setUp()
+
+    def tearDown(self):
+        drop_search_index()
+        super().tearDown()
+
+    def test_index_is_used(self):
+        if connection.vendor != "sqlite":
+            self.skipTest("the index only changes the query on sqlite")
+
+        self.assertIsNotNone(get_plain_text_filter(Issue, "findable"))
+        self.assertIsNone(get_plain_text_filter(Issue, "fi"))  # too short for trigrams; icontains only
+
+    def test_index_follows_updates_and_deletes(self):
+        issue = Issue.objects.create(project=self.project, **denormalized_issue_fields())
+        issues = lambda query: search_issues(self.project, Issue.objects.all(), query)
+
+        issue.calculated_value = "findable value"
+        issue.save()
+        self.assertEqual(issues("findable value").count(), 3)
+
+        issue.calculated_value = "renamed value"
+        issue.save()
+        self.assertEqual(issues("findable value").count(), 2)
+        self.assertEqual(list(issues("renamed value")), [issue])
+
+        issue.delete()
+        self.assertEqual(issues("renamed value").count(), 0)
+
+    def test_recreate_if_stale(self):
+        self.assertEqual(recreate_search_index_if_stale(), [])  # the index is current: nothing to do
+
+
 class VacuumEventlessIssueTagsTestCase(TransactionTestCase):
     # Note: this test depends on EAGER mode in both the setup (delete_derred to trigger cascading deletes) and the
     # testing of the thing under test (vacuum_eventless_issuetags).